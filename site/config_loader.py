@@ -2,13 +2,89 @@ import configparser
 import os
 import sys
 import yaml
+import yaml_loader
+from collections import ChainMap
 from pathlib import Path
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, Mapping, MutableMapping
+
+from env_expand import Expander, UnresolvedError
+
+
+def load_overrides(overrides_path: str, environ: Optional[Mapping[str, str]] = None,
+                   context: Optional[Dict[str, str]] = None, expand_vars: bool = True) -> Dict[str, str]:
+    """
+    Load an override file with key=value pairs. Values are expanded from
+    environ (default os.environ), then ${VAR} from context and the other
+    overrides, each earlier one as expanded. Undefined variables are errors.
+    """
+    if not os.path.exists(overrides_path):
+        raise FileNotFoundError(f"Override file not found: {overrides_path}")
+
+    environ = environ if environ is not None else os.environ
+    expansion_context = dict(context or {})
+    overrides: Dict[str, str] = {}
+
+    try:
+        with open(overrides_path, 'r') as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+
+                if not line or line.startswith('#'):
+                    continue
+
+                # key=value only
+                if '=' not in line:
+                    raise ValueError(f"Invalid format at line {line_num}: {line}")
+
+                key, value = line.split('=', 1)
+                key = key.strip()
+                value = value.strip()
+
+                # Remove quotes if present
+                if value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                elif value.startswith("'") and value.endswith("'"):
+                    value = value[1:-1]
+
+                # Store raw override first
+                overrides[key] = value
+                # Also add to expansion context for subsequent overrides
+                expansion_context[key] = value
+
+        if not expand_vars:
+            return overrides
+
+        # Now expand all override values in the context of config + previous overrides
+        env_expander = Expander(environ=environ, bare=True, missing='keep')
+        for key, value in overrides.items():
+            # First expand using environment variables, then ${VAR} using
+            # our context (for variables not in environment)
+            try:
+                overrides[key] = Expander(environ=ChainMap(environ, expansion_context)).expand(
+                    env_expander.expand(value))
+            except UnresolvedError as e:
+                # Error on undefined variables
+                names = ', '.join(f"${{{name}}}" for name in e.names)
+                raise ValueError(f"Undefined variable in override: {names} in override file {overrides_path}") from None
+            # Update context with expanded value
+            expansion_context[key] = overrides[key]
+
+    except ValueError:
+        # Re-raise ValueError (including variable expansion errors) without wrap
+        raise
+    except Exception as e:
+        raise ValueError(f"Failed to load override file {overrides_path}: {e}")
+
+    return overrides
 
 
 class ConfigLoader:
-    def __init__(self, cfg_path: str, *, expand_vars: bool = True, overrides_path: Optional[str] = None, search_paths: Optional[list[str]] = None):
+    def __init__(self, cfg_path: str, *, expand_vars: bool = True, overrides_path: Optional[str] = None, search_paths: Optional[list[str]] = None, environ: Optional[MutableMapping[str, str]] = None):
         self.cfg_path = cfg_path
+        # Environment variables are expanded from, and loaded into
+        self.environ = environ if environ is not None else os.environ
+        # $VAR and ${VAR} from the environment, leaving unset ones as written
+        self._env_expander = Expander(environ=self.environ, bare=True, missing='keep')
         self.overrides_path = overrides_path
         self.expand_vars = expand_vars
         # Support additional include search path
@@ -94,7 +170,7 @@ class ConfigLoader:
 
             try:
                 with open(path, 'r') as f:
-                    yaml_data = yaml.safe_load(f) or {}
+                    yaml_data = yaml_loader.safe_load(f) or {}
             except yaml.YAMLError as e:
                 raise ValueError(f"Failed to parse YAML file {path}: {e}")
 
@@ -162,9 +238,6 @@ class ConfigLoader:
         if not self.overrides_path:
             return
 
-        if not os.path.exists(self.overrides_path):
-            raise FileNotFoundError(f"Override file not found: {self.overrides_path}")
-
         # Build context for variable expansion from config data
         expansion_context = {}
         for section_name, section_data in self.data.items():
@@ -172,76 +245,10 @@ class ConfigLoader:
                 env_key = self._env_key(section_name, key)
                 expansion_context[env_key] = self._expand(value)
 
-        try:
-            with open(self.overrides_path, 'r') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-
-                    if not line or line.startswith('#'):
-                        continue
-
-                    # key=value only
-                    if '=' not in line:
-                        raise ValueError(f"Invalid format at line {line_num}: {line}")
-
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip()
-
-                    # Remove quotes if present
-                    if value.startswith('"') and value.endswith('"'):
-                        value = value[1:-1]
-                    elif value.startswith("'") and value.endswith("'"):
-                        value = value[1:-1]
-
-                    # Store raw override first
-                    self.overrides[key] = value
-                    # Also add to expansion context for subsequent overrides
-                    expansion_context[key] = value
-
-            # Now expand all override values in the context of config + previous overrides
-            for key, value in self.overrides.items():
-                try:
-                    self.overrides[key] = self._expand_with_context(value, expansion_context)
-                    # Update context with expanded value
-                    expansion_context[key] = self.overrides[key]
-                except ValueError as ve:
-                    # Re-raise variable expansion errors
-                    raise ValueError(f"{ve} in override file {self.overrides_path}") from None
-
-        except ValueError:
-            # Re-raise ValueError (including variable expansion errors) without wrap
-            raise
-        except Exception as e:
-            raise ValueError(f"Failed to load override file {self.overrides_path}: {e}")
-
-    def _expand_with_context(self, value: str, context: Dict[str, str]) -> str:
-        """Expand variables using both environment and provided context"""
-        if not self.expand_vars:
-            return value
-
-        # First expand using environment variables
-        expanded = os.path.expandvars(value)
-
-        # Now expand using our context (for variables not in environment)
-        import re
-        def replace_var(match):
-            var_name = match.group(1)
-            if var_name in os.environ:
-                return os.environ[var_name]
-            elif var_name in context:
-                return context[var_name]
-            else:
-                # Error on undefined variables
-                raise ValueError(f"Undefined variable in override: ${{{var_name}}}")
-
-        # Handle ${VAR} format
-        expanded = re.sub(r'\$\{([^}]+)\}', replace_var, expanded)
-
-        return expanded
+        self.overrides = load_overrides(self.overrides_path, self.environ, expansion_context, self.expand_vars)
 
     def _expand(self, value: str) -> str:
-        return os.path.expandvars(value) if self.expand_vars else value
+        return self._env_expander.expand(value) if self.expand_vars else value
 
     def _env_key(self, section: str, key: str) -> str:
         return f"IGconf_{section.lower()}_{key.lower()}"
@@ -277,21 +284,21 @@ class ConfigLoader:
         return None
 
     def _set_env_if_unset(self, env_key: str, value: str):
-        if env_key not in os.environ:
+        if env_key not in self.environ:
             # Check if this value is overridden
             if env_key in self.overrides:
                 final_value = self._expand(self.overrides[env_key])
-                os.environ[env_key] = final_value
+                self.environ[env_key] = final_value
                 print(f"OVR {env_key}={final_value}")
             else:
                 final_value = self._expand(value)
-                os.environ[env_key] = final_value
+                self.environ[env_key] = final_value
                 print(f"CFG {env_key}={final_value}")
         else:
             print(f"{env_key} already set, skipping")
 
     def _get_value(self, env_key: str, cfg_value: str) -> str:
-        return os.environ.get(env_key, self._expand(cfg_value))
+        return self.environ.get(env_key, self._expand(cfg_value))
 
     def load_section(self, section: str):
         if section not in self.data:
@@ -328,8 +335,8 @@ class ConfigLoader:
         env_key = self._env_key(section, key)
 
         # Check precedence: environment -> override -> config
-        if env_key in os.environ:
-            effective_value = os.environ[env_key]
+        if env_key in self.environ:
+            effective_value = self.environ[env_key]
             source = "env"
         elif env_key in self.overrides:
             effective_value = self._expand(self.overrides[env_key])
@@ -371,8 +378,8 @@ class ConfigLoader:
     def _write_override_only_var(self, file_handle, override_key: str, section_filter: Optional[str]):
         """Write an override-only variable that doesn't exist in config file"""
         # Check precedence: environment -> override
-        if override_key in os.environ:
-            effective_value = os.environ[override_key]
+        if override_key in self.environ:
+            effective_value = self.environ[override_key]
             source = "env"
         else:
             effective_value = self._expand(self.overrides[override_key])
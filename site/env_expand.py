@@ -0,0 +1,273 @@
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+
+_NAME = r'[A-Za-z_][A-Za-z0-9_]*'
+
+# References as ${NAME}, or also as $NAME, each optionally escaped by a backslash
+_BRACED_REF = re.compile(rf'(\\?)\$\{{({_NAME})\}}')
+_ANY_REF = re.compile(rf'(\\?)\$(?:\{{({_NAME})\}}|({_NAME}))')
+
+# The start of a shell ${NAME-word}, ${NAME:-word}, ${NAME+word} or ${NAME:+word}
+_PARAM_REF = re.compile(rf'\$\{{({_NAME})(:?[-+])')
+
+# Parameters a shell expands after $ other than variable names, and
+# characters inside double quotes a backslash escapes
+_SHELL_EXPANSIONS = '({0123456789@*#?$!-'
+_SHELL_ESCAPES = '$`"\\'
+
+# What to do with a reference to an unset variable
+MISSING_POLICIES = ('error', 'keep', 'keep-bare')
+
+
+class Ref(NamedTuple):
+    """A reference to a variable in a string."""
+    name: str
+    text: str  # As written, eg ${NAME} or $NAME
+
+    @property
+    def braced(self) -> bool:
+        return self.text.startswith('${')
+
+
+class Param(NamedTuple):
+    """A shell reference to a variable with a default or alternative value."""
+    name: str
+    op: str  # -, :-, + or :+
+    word: 'Segments'  # The default or alternative, parsed
+    text: str  # As written, eg ${NAME:-word}
+
+
+Segments = Tuple[Union[str, Ref, Param], ...]
+
+
+class UnresolvedError(ValueError):
+    """Raised when a string references variables which aren't set."""
+
+    def __init__(self, names: Iterable[str]):
+        self.names = sorted(set(names))
+        super().__init__(f"Unresolved environment variables: {', '.join(self.names)}")
+
+
+class ReferenceCycleError(ValueError):
+    """Raised when a variable's value refers back to itself, directly or through others."""
+
+    def __init__(self, cycle: List[str]):
+        self.cycle = cycle
+        super().__init__(f"Variable reference cycle: {' -> '.join(cycle)}")
+
+
+@lru_cache(maxsize=8192)
+def parse(text: str, bare: bool = False, escapes: bool = False) -> Segments:
+    """
+    Split text into literal strings and references to variables, as ${NAME},
+    or also as $NAME if bare is set. With escapes, a reference preceded by a
+    backslash is literal text, without the backslash. Adjacent literals are
+    merged and empty ones dropped, so text without references is returned
+    as one literal.
+    """
+    if '$' not in text:
+        return (text,) if text else ()
+
+    segments: List[Union[str, Ref]] = []
+    literal = ''
+    pos = 0
+    for match in (_ANY_REF if bare else _BRACED_REF).finditer(text):
+        backslash, name = match.group(1), match.group(2) or (match.group(3) if bare else None)
+        literal += text[pos:match.start()]
+        ref_text = match.group(0)[len(backslash):]
+        if backslash and escapes:
+            literal += ref_text
+        else:
+            literal += backslash
+            if literal:
+                segments.append(literal)
+            literal = ''
+            segments.append(Ref(name, ref_text))
+        pos = match.end()
+    literal += text[pos:]
+    if literal:
+        segments.append(literal)
+    return tuple(segments)
+
+
+@lru_cache(maxsize=8192)
+def parse_shell(text: str) -> Optional[Segments]:
+    """
+    Split the text of a double quoted shell string into literal strings and
+    references to variables as the shell would, with ${NAME} and $NAME
+    references, ${NAME:-word} and ${NAME:+word} with or without the colon,
+    and backslash escapes. Returns None if the text uses any other
+    expansion, eg $(command), `command`, ${NAME#pattern} or $1, or quotes
+    or escapes in a word, which only a shell can evaluate.
+    """
+    segments: List[Union[str, Ref]] = []
+    literal: List[str] = []
+    pos, end = 0, len(text)
+    while pos < end:
+        c = text[pos]
+        if c == '\\' and pos + 1 < end and text[pos + 1] in _SHELL_ESCAPES + '\n':
+            if text[pos + 1] != '\n':
+                literal.append(text[pos + 1])
+            pos += 2
+            continue
+        if c == '`' or c == '"':
+            return None
+        if c == '$':
+            match = _ANY_REF.match(text, pos)
+            if match:
+                if literal:
+                    segments.append(''.join(literal))
+                    literal = []
+                segments.append(Ref(match.group(2) or match.group(3), match.group(0)))
+                pos = match.end()
+                continue
+            match = _PARAM_REF.match(text, pos)
+            if match:
+                close = _closing_brace(text, match.end())
+                word = parse_shell(text[match.end():close]) if close is not None else None
+                if word is None:
+                    return None
+                if literal:
+                    segments.append(''.join(literal))
+                    literal = []
+                segments.append(Param(match.group(1), match.group(2), word, text[pos:close + 1]))
+                pos = close + 1
+                continue
+            if pos + 1 < end and text[pos + 1] in _SHELL_EXPANSIONS:
+                return None
+        literal.append(c)
+        pos += 1
+    if literal:
+        segments.append(''.join(literal))
+    return tuple(segments)
+
+
+def _closing_brace(text: str, pos: int) -> Optional[int]:
+    """Index of the brace closing a ${NAME...} whose word starts at pos, or None if quoted or escaped text is in the way"""
+    depth = 0
+    for i in range(pos, len(text)):
+        c = text[i]
+        if c in '\\"\'`':
+            return None
+        if c == '{' and text[i - 1] == '$':
+            depth += 1
+        elif c == '}':
+            if not depth:
+                return i
+            depth -= 1
+    return None
+
+
+def references(text: str, bare: bool = False) -> List[str]:
+    """Names of the variables text refers to, in order of first reference"""
+    return list(dict.fromkeys(seg.name for seg in parse(text, bare) if isinstance(seg, Ref)))
+
+
+class Expander:
+    """
+    Expands variable references in strings.
+
+    Variables in definitions have values which may themselves refer to other
+    variables. They are expanded on first use, after the variables they refer
+    to, and the result is kept, so each is expanded at most once however
+    often it is referred to. A variable whose value refers back to itself is
+    reported as a ReferenceCycleError. Variables in environ are used as they
+    are, taking precedence over definitions.
+
+    References to variables which are in neither raise an UnresolvedError
+    naming all of them with missing='error', are kept as written with
+    missing='keep', and with missing='keep-bare' only $NAME references are
+    kept. With missing='keep' cycles are also kept as written. A variable
+    with a default or alternative value, as parsed by parse_shell, may be
+    unset.
+    """
+
+    def __init__(self, definitions: Optional[Mapping[str, str]] = None,
+                 environ: Optional[Mapping[str, str]] = None,
+                 bare: bool = False, escapes: bool = False, missing: str = 'error'):
+        if missing not in MISSING_POLICIES:
+            raise ValueError(f"Unknown missing variable policy '{missing}'")
+        self.definitions = definitions if definitions is not None else {}
+        self.environ = environ if environ is not None else {}
+        self.bare = bare
+        self.escapes = escapes
+        self.missing = missing
+        # Expanded definitions, with the unset variables they refer to
+        self._expanded: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        # Definitions being expanded, in order of reference
+        self._active: Dict[str, None] = {}
+
+    def expand(self, text: str) -> str:
+        """Return text with the variables it refers to expanded"""
+        return self.expand_segments(parse(text, self.bare, self.escapes))
+
+    def expand_segments(self, segments: Segments) -> str:
+        """Return parsed text with the variables it refers to expanded"""
+        value, unresolved = self._expand_segments(segments)
+        if unresolved and self.missing != 'keep':
+            raise UnresolvedError(unresolved)
+        return value
+
+    def value(self, name: str) -> Optional[str]:
+        """Return the expanded value of a variable, or None if it isn't set"""
+        value, unresolved = self._lookup(name)
+        if unresolved and self.missing != 'keep':
+            raise UnresolvedError(unresolved)
+        return value
+
+    def expand_all(self) -> Dict[str, str]:
+        """Expand every definition, returning the values in definition order"""
+        return {name: self.value(name) for name in self.definitions}
+
+    def _lookup(self, name: str) -> Tuple[Optional[str], Tuple[str, ...]]:
+        expanded = self._expanded.get(name)
+        if expanded is not None:
+            return expanded
+        value = self.environ.get(name)
+        if value is not None:
+            return value, ()
+        raw = self.definitions.get(name)
+        if raw is None:
+            return None, ()
+        if name in self._active:
+            if self.missing != 'keep':
+                cycle = list(self._active)
+                raise ReferenceCycleError(cycle[cycle.index(name):] + [name])
+            return None, ()
+
+        self._active[name] = None
+        try:
+            expanded = self._expand_segments(parse(raw, self.bare, self.escapes))
+        finally:
+            del self._active[name]
+        self._expanded[name] = expanded
+        return expanded
+
+    def _expand_segments(self, segments: Segments) -> Tuple[str, Tuple[str, ...]]:
+        parts: List[str] = []
+        unresolved: Tuple[str, ...] = ()
+        for seg in segments:
+            if seg.__class__ is str:
+                parts.append(seg)
+                continue
+            if seg.__class__ is Param:
+                value, nested = self._lookup(seg.name)
+                is_set = value is not None and (value != '' or not seg.op.startswith(':'))
+                if is_set == seg.op.endswith('+'):
+                    value, nested = self._expand_segments(seg.word)
+                elif seg.op.endswith('+'):
+                    value, nested = '', ()
+                unresolved += nested
+                parts.append(value)
+                continue
+            value, nested = self._lookup(seg.name)
+            if nested:
+                unresolved += nested
+            if value is None:
+                if self.missing != 'keep-bare' or seg.braced:
+                    unresolved += (seg.name,)
+                value = seg.text
+            parts.append(value)
+        return ''.join(parts), unresolved
@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import json
+import shlex
+import subprocess
+import tempfile
+import contextlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional, Tuple
+
+from env_expand import Expander, UnresolvedError, parse_shell
+
+
+# Lines of an env file as written by ig, a variable assignment, optionally
+# exported, or a comment
+_ASSIGNMENT = re.compile(r'^(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*)$', re.DOTALL)
+_UNQUOTED_WORD = re.compile(r'^[^\s\'"\\;&|<>()`~*?\[\]]*$')
+
+# Evaluates NUL terminated commands read from stdin in turn, without
+# letting them read the rest. Like sourcing, any failure ends the shell.
+_SHELL_LOOP = 'set -aeu; while IFS= read -r -d "" _ig_cmd; do eval "$_ig_cmd" </dev/null; done'
+
+# Prints NAME=value for each variable bash has set, then an empty record
+_SHELL_VARIABLES = ('for _ig_var in $(compgen -v); do if [[ -v $_ig_var ]]; then '
+                    'printf "%s=%s\\0" "$_ig_var" "${!_ig_var}"; fi; done; printf "\\0"')
+
+
+def _continued(text: str) -> bool:
+    """Whether bash would read on past the end of text, in a quoted string or after a backslash"""
+    quote = None
+    pos, end = 0, len(text)
+    while pos < end:
+        c = text[pos]
+        if quote == "'":
+            if c == "'":
+                quote = None
+        elif c == '\\':
+            pos += 1
+            if pos == end:
+                return True
+        elif quote == '"':
+            if c == '"':
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '#' and (pos == 0 or text[pos - 1].isspace()):
+            break
+        pos += 1
+    return quote is not None
+
+
+def _statements(env_file: str) -> Iterator[Tuple[int, str]]:
+    """Yield (line number, text) for each statement in env_file, joining the lines of multi-line values"""
+    with open(env_file, 'r', encoding='utf-8') as f:
+        lines = enumerate(f, 1)
+        for lineno, line in lines:
+            text = line.lstrip().rstrip('\n')
+            if not text.strip() or text.startswith('#'):
+                continue
+            while _continued(text):
+                following = next(lines, None)
+                if following is None:
+                    raise ValueError(f"{env_file}:{lineno}: unterminated quoted value")
+                text += '\n' + following[1].rstrip('\n')
+            yield lineno, text.strip()
+
+
+class _Shell:
+    """
+    A bash started on first use in an empty environment, as env -i bash
+    would be, which evaluates the assignments ig can't, eg with a command
+    substitution, and gives the variables bash sets itself, eg PATH, PWD
+    and SHLVL. One shell serves every assignment in a file.
+    """
+
+    def __init__(self):
+        self._proc: Optional[subprocess.Popen] = None
+        # Errors go to a file so that a chatty command can't fill a pipe nobody reads
+        self._errors = None
+        self._buffer = b''
+        # Values of the variables bash was given
+        self._given: Dict[str, str] = {}
+        self._variables: Optional[Dict[str, str]] = None
+
+    def variables(self) -> Dict[str, str]:
+        """Variables bash sets itself on starting"""
+        if self._variables is None:
+            self._variables = {}
+            self._send(_SHELL_VARIABLES)
+            for record in iter(self._read, ''):
+                name, _, value = record.partition('=')
+                if not name.startswith('_ig_'):
+                    self._variables[name] = value
+        return self._variables
+
+    def evaluate(self, name: str, statement: str, env: Mapping[str, str]) -> str:
+        """Evaluate an assignment after the variables in env, and return the value it sets"""
+        self.variables()
+        given = [f"{var}={shlex.quote(value)}" for var, value in env.items() if self._given.get(var) != value]
+        self._given.update(env)
+        self._send('\n'.join([*given, statement, f'printf "%s\\0" "${{{name}}}"']))
+        value = self._read()
+        self._given[name] = value
+        return value
+
+    def close(self):
+        if self._proc is not None:
+            self._stop()
+            self._errors.close()
+
+    def _stop(self) -> int:
+        proc, self._proc = self._proc, None
+        with contextlib.suppress(BrokenPipeError):
+            proc.stdin.close()
+        returncode = proc.wait()
+        proc.stdout.close()
+        return returncode
+
+    def _send(self, command: str):
+        if self._proc is None:
+            self._errors = tempfile.TemporaryFile()
+            self._proc = subprocess.Popen(['bash', '-c', _SHELL_LOOP], env={}, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE, stderr=self._errors)
+        try:
+            self._proc.stdin.write(command.encode() + b'\0')
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            self._failed()
+
+    def _read(self) -> str:
+        while b'\0' not in self._buffer:
+            chunk = os.read(self._proc.stdout.fileno(), 65536)
+            if not chunk:
+                self._failed()
+            self._buffer += chunk
+        record, self._buffer = self._buffer.split(b'\0', 1)
+        return record.decode(errors='replace')
+
+    def _failed(self):
+        returncode = self._stop()
+        self._errors.seek(0)
+        error = self._errors.read().decode(errors='replace').strip().splitlines()
+        self._errors.close()
+        reason = f": {error[-1]}" if error else ""
+        raise ValueError(f"evaluation failed with exit status {returncode}{reason}")
+
+
+class _Variables(Mapping):
+    """The variables assigned so far, then those bash sets itself, only asked for when needed"""
+
+    def __init__(self, assigned: Mapping[str, str], shell: _Shell):
+        self.assigned = assigned
+        self.shell = shell
+
+    def __getitem__(self, name: str) -> str:
+        if name in self.assigned:
+            return self.assigned[name]
+        return self.shell.variables()[name]
+
+    def __iter__(self):
+        return iter({**self.shell.variables(), **self.assigned})
+
+    def __len__(self):
+        return len({**self.shell.variables(), **self.assigned})
+
+
+def expand_env_file(env_file: str) -> Dict[str, str]:
+    """
+    Return the final value of each variable assigned in env_file, in order
+    of first assignment, as if the file were sourced by env -i bash with
+    set -u. A variable assigned more than once is given once.
+
+    Assignments are evaluated in turn, each against the variables assigned
+    before it and those bash sets itself. Double quoted and unquoted values
+    referring to variables as ${NAME} or $NAME, or with a default or
+    alternative value as ${NAME:-word} or ${NAME:+word}, are expanded
+    in-process, and single quoted values are taken as they are. Any other
+    value, eg with a command substitution, needs a shell and is evaluated
+    by a single bash kept for the file.
+    Assignments may be exported and values may span lines. A reference to
+    a variable which isn't assigned before it is an error naming the
+    variable and where it was referred to.
+    """
+    env: Dict[str, str] = OrderedDict()
+    shell = _Shell()
+    expander = Expander(environ=_Variables(env, shell))
+    try:
+        for lineno, statement in _statements(env_file):
+            match = _ASSIGNMENT.match(statement)
+            if not match:
+                raise ValueError(f"{env_file}:{lineno}: expected NAME=value, got '{statement}'")
+            name, value = match.groups()
+
+            segments = None
+            if len(value) >= 2 and value[0] == value[-1] == "'" and "'" not in value[1:-1]:
+                segments = (value[1:-1],)
+            elif len(value) >= 2 and value[0] == value[-1] == '"':
+                segments = parse_shell(value[1:-1])
+            elif _UNQUOTED_WORD.match(value):
+                segments = parse_shell(value)
+
+            try:
+                if segments is None:
+                    value = shell.evaluate(name, statement, env)
+                else:
+                    value = expander.expand_segments(segments)
+            except UnresolvedError as e:
+                raise ValueError(f"{env_file}:{lineno}: {name}: unbound variable {', '.join(e.names)}") from None
+            except (OSError, ValueError) as e:
+                raise ValueError(f"{env_file}:{lineno}: {name}: {e}") from None
+
+            # Reassignment keeps the variable's place in the order
+            env[name] = value
+    finally:
+        shell.close()
+    return env
+
+
+def write_env_file(env: Dict[str, str], output: str):
+    """Write variables to output as NAME="value" lines, as read by runenv"""
+    with open(output, 'w', encoding='utf-8') as f:
+        for name, value in env.items():
+            f.write(f'{name}="{value}"\n')
+
+
+def runenv_value(value: str) -> str:
+    """Return the value runenv gives a later stage for a variable written by write_env_file"""
+    # runenv drops every double quote in the file
+    return value.replace('"', '')
+
+
+def EnvFile_register_parser(subparsers):
+    parser = subparsers.add_parser("env", help="Environment file utilities")
+    parser.add_argument("--expand", metavar="FILE", required=True,
+                        help="Expand all variables in FILE as bash would when sourcing it with set -u")
+    parser.add_argument("--write-to", metavar="FILE",
+                        help="Write the expanded variables as NAME=\"value\" lines to FILE instead of stdout")
+    parser.add_argument("--json", metavar="FILE",
+                        help="Also write the expanded variables to FILE as a JSON object")
+    parser.set_defaults(func=_main)
+
+
+def _main(args):
+    try:
+        env = expand_env_file(args.expand)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.write_to:
+        write_env_file(env, args.write_to)
+    else:
+        for name, value in env.items():
+            print(f'{name}="{value}"')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(env, f, indent=2)
+            f.write("\n")
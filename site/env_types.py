@@ -1,6 +1,8 @@
 import re
-from typing import List, Optional, Dict, Any, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
 from validators import BaseValidator, parse_validator
+from env_expand import Expander
 
 
 # X-Env field helpers
@@ -186,6 +188,11 @@ class XEnv:
         """Build layer conflicts field: X-Env-Layer-Conflicts"""
         return f"{cls.LAYER_PREFIX}Conflicts"
 
+    @classmethod
+    def layer_parallel_safe(cls) -> str:
+        """Build layer parallel safe field: X-Env-Layer-ParallelSafe"""
+        return f"{cls.LAYER_PREFIX}ParallelSafe"
+
     @classmethod
     def is_layer_field(cls, field_name: str) -> bool:
         """Check if field name is an X-Env-Layer field."""
@@ -300,7 +307,7 @@ class EnvLayer:
     def __init__(self, name: str, description: str = "", version: str = "1.0.0",
                  category: str = "general", deps: List[str] = None,
                  provides: List[str] = None, requires_provider: List[str] = None,
-                 conflicts: List[str] = None, config_file: str = ""):
+                 conflicts: List[str] = None, config_file: str = "", parallel_safe: bool = False):
         self.name = name
         self.description = description
         self.version = version
@@ -310,11 +317,13 @@ class EnvLayer:
         self.requires_provider = requires_provider or []
         self.conflicts = conflicts or []
         self.config_file = config_file
+        self.parallel_safe = parallel_safe
 
     @classmethod
     def from_metadata_fields(cls, metadata_dict: Dict[str, str],
-                           filepath: str = "", doc_mode: bool = False) -> Optional['EnvLayer']:
-        """Create an EnvLayer from metadata fields."""
+                           filepath: str = "", doc_mode: bool = False,
+                           environ: Optional[Mapping[str, str]] = None) -> Optional['EnvLayer']:
+        """Create an EnvLayer from metadata fields, expanding ${VAR} in dependencies from environ (default os.environ)."""
         # Check if this has layer information
         layer_name = metadata_dict.get(XEnv.layer_name(), "")
         if not layer_name:
@@ -329,16 +338,19 @@ class EnvLayer:
 
         # Parse dependency lists
         requires_str = metadata_dict.get(XEnv.layer_requires(), "")
-        requires = cls._parse_dependency_list(requires_str, doc_mode)
+        requires = cls._parse_dependency_list(requires_str, doc_mode, environ)
 
         provides_str = metadata_dict.get(XEnv.layer_provides(), "")
-        provides = cls._parse_dependency_list(provides_str, doc_mode)
+        provides = cls._parse_dependency_list(provides_str, doc_mode, environ)
 
         requires_provider_str = metadata_dict.get(XEnv.layer_requires_provider(), "")
-        requires_provider = cls._parse_dependency_list(requires_provider_str, doc_mode)
+        requires_provider = cls._parse_dependency_list(requires_provider_str, doc_mode, environ)
 
         conflicts_str = metadata_dict.get(XEnv.layer_conflicts(), "")
-        conflicts = cls._parse_dependency_list(conflicts_str, doc_mode)
+        conflicts = cls._parse_dependency_list(conflicts_str, doc_mode, environ)
+
+        parallel_safe_str = metadata_dict.get(XEnv.layer_parallel_safe(), "")
+        parallel_safe = parallel_safe_str.strip().lower() in ("true", "1", "yes", "y")
 
         # Infer config file from filepath if not provided
         import os
@@ -353,23 +365,31 @@ class EnvLayer:
             provides=provides,
             requires_provider=requires_provider,
             conflicts=conflicts,
-            config_file=config_file
+            config_file=config_file,
+            parallel_safe=parallel_safe
         )
 
     @staticmethod
-    def _parse_dependency_list(depends_str: str, doc_mode: bool = False) -> List[str]:
+    def _parse_dependency_list(depends_str: str, doc_mode: bool = False,
+                               environ: Optional[Mapping[str, str]] = None) -> List[str]:
         """Parse dependency string into list of layer names/IDs with environment variable evaluation."""
         if not depends_str.strip():
             return []
 
         import re
+        import os
+        # Expand ${VAR} placeholders using environ (default os.environ), each
+        # variable once per list. Raises on missing variables unless doc_mode
+        # (in which case placeholders are kept).
+        expander = Expander(definitions=environ if environ is not None else os.environ,
+                            missing='keep' if doc_mode else 'error')
         deps = []
         for dep in depends_str.split(','):
             dep_name = dep.strip()
             if dep_name:
                 # Find and evaluate environment variables in dependency names
                 if '${' in dep_name:
-                    dep_name = EnvLayer._evaluate_env_variables(dep_name, doc_mode)
+                    dep_name = expander.expand(dep_name)
 
                 # Validate dependency name format
                 if re.search(r"\s", dep_name):
@@ -383,34 +403,6 @@ class EnvLayer:
                 deps.append(dep_name)
         return deps
 
-    @staticmethod
-    def _evaluate_env_variables(text: str, doc_mode: bool = False) -> str:
-        """Expand ${VAR} placeholders using environment variables.
-        Raises on missing variables unless doc_mode=True (in which case placeholders are kept).
-        - Iteratively expands (with cap) to support nested placeholders.
-        """
-        import os
-        # Vatiables much conform to this regex
-        pattern = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
-
-        previous = text
-        max_iterations = 10
-
-        for _ in range(max_iterations):
-            current = pattern.sub(lambda m: os.environ.get(m.group(1), m.group(0)), previous)
-            if current == previous:
-                break
-            previous = current
-
-        # If any ${...} remain:
-        if pattern.search(previous):
-            if doc_mode:
-                return previous
-            remaining = sorted({m.group(1) for m in pattern.finditer(previous)})
-            raise ValueError(f"Unresolved environment variables: {', '.join(remaining)}")
-
-        return previous
-
     @classmethod
     def _validate_layer_fields(cls, metadata_dict: Dict[str, str], filepath: str = "") -> None:
         """Validate that all X-Env-Layer fields are supported according to the schema"""
@@ -456,6 +448,7 @@ class EnvLayer:
             "config_file": self.config_file,
             "provides": self.provides,
             "provider_requires": self.requires_provider,
+            "parallel_safe": self.parallel_safe,
         }
 
     def __repr__(self) -> str:
@@ -476,8 +469,9 @@ class MetadataContainer:
 
     @classmethod
     def from_metadata_dict(cls, metadata_dict: Dict[str, str],
-                          filepath: str = "", doc_mode: bool = False) -> 'MetadataContainer':
-        """Create a MetadataContainer from a metadata dictionary."""
+                          filepath: str = "", doc_mode: bool = False,
+                          environ: Optional[Mapping[str, str]] = None) -> 'MetadataContainer':
+        """Create a MetadataContainer from a metadata dictionary, expanding layer dependencies from environ."""
         container = cls(filepath)
         container.raw_metadata = metadata_dict.copy()
 
@@ -488,7 +482,7 @@ class MetadataContainer:
         container.var_prefix = container.raw_metadata.get(XEnv.var_prefix(), "").lower()
 
         # Extract layer information
-        container.layer = EnvLayer.from_metadata_fields(container.raw_metadata, filepath, doc_mode)
+        container.layer = EnvLayer.from_metadata_fields(container.raw_metadata, filepath, doc_mode, environ)
 
         # Extract variables
         for key in container.raw_metadata.keys():
@@ -540,20 +534,13 @@ class MetadataContainer:
         }
 
     def _substitute_placeholders(self, text: str, placeholders: Dict[str, str]) -> str:
-        """Replace ${NAME} in text with corresponding placeholder."""
+        """Replace ${NAME} in text with corresponding placeholder. Every \\${ is left as ${."""
         if "${" not in text:
             return text
 
-        # Handle escaped \${...}
-        ESCAPE_TOKEN = "<<LITERAL_DOLLAR_BRACE>>"
-        text_escaped = text.replace("\\${", ESCAPE_TOKEN)
-
-        def _repl(match):
-            key = match.group(1)
-            return placeholders.get(key, match.group(0))
-
-        substituted = re.sub(r"\$\{([A-Z][A-Z0-9_]*)\}", _repl, text_escaped)
-        return substituted.replace(ESCAPE_TOKEN, "${")
+        # Handle escaped \${...}, which can't start a reference
+        expander = Expander(environ=placeholders, missing='keep')
+        return "${".join(expander.expand(part) for part in text.split("\\${"))
 
     def apply_placeholders(self):
         """Walk metadata and substitute placeholders in all string fields."""
@@ -571,89 +558,126 @@ class MetadataContainer:
         return f"MetadataContainer(vars={len(self.variables)}, layer={self.layer is not None})"
 
 
+class ResolvedVariable(NamedTuple):
+    """The definition of a variable chosen by VariableResolver and the layer it came from."""
+    var: EnvVariable
+    source_layer: str
+    set_policy: str  # The definition's policy, or "already_set" if left to the environment
+
+    @property
+    def name(self) -> str:
+        return self.var.name
+
+    @property
+    def value(self) -> str:
+        return self.var.value
+
+
+class EnvDecision(NamedTuple):
+    """What resolution did with one variable."""
+    tag: str  # SET, FORCE, LAZY or SKIP
+    name: str
+    value: Optional[str]
+    source_layer: str
+    reason: str = ""  # Why a variable was skipped
+
+
+class Resolution(NamedTuple):
+    """The outcome of resolving layer variables against an input environment."""
+    env: Dict[str, str]  # The input environment with the variables set applied
+    changes: Dict[str, str]  # Variables set, in the order they were set
+    log: List[EnvDecision]
+
+
 class VariableResolver:
-    """Resolves final variable values from multiple definitions using policy rules."""
+    """
+    Resolves final variable values from multiple definitions using policy rules.
+
+    resolve_env() is pure: it reads the environment it is given and returns
+    the result, so resolutions against different environments can run side
+    by side. Applying a Resolution to os.environ is left to the caller.
+    """
 
     def __init__(self):
         pass
 
-    def resolve(self, variable_definitions: Dict[str, List[EnvVariable]]) -> Dict[str, EnvVariable]:
+    def resolve_env(self, layers: Iterable[Tuple[str, Mapping[str, EnvVariable]]],
+                    environ: Mapping[str, str]) -> Resolution:
+        """Resolve the variables of layers, given in build order, against environ"""
+        return self.apply(self.resolve(layers, environ), environ)
+
+    def apply(self, resolved: Dict[str, ResolvedVariable], environ: Mapping[str, str]) -> Resolution:
+        """Apply resolved variables to a copy of environ, recording each decision"""
+        env = dict(environ)
+        changes: Dict[str, str] = OrderedDict()
+        log: List[EnvDecision] = []
+
+        for res in resolved.values():
+            name, value, policy = res.name, res.value, res.set_policy
+            if policy == "force" or (policy in ("immediate", "lazy") and name not in env):
+                env[name] = value
+                changes[name] = value
+                tag = {"force": "FORCE", "immediate": "SET", "lazy": "LAZY"}[policy]
+                log.append(EnvDecision(tag, name, value, res.source_layer))
+            elif policy == "skip" and name not in env:
+                log.append(EnvDecision("SKIP", name, None, res.source_layer, "Set: false/skip"))
+            else:
+                # Already in the environment
+                log.append(EnvDecision("SKIP", name, None, res.source_layer, "already set"))
+
+        return Resolution(env, changes, log)
+
+    def resolve(self, layers: Iterable[Tuple[str, Mapping[str, EnvVariable]]],
+                environ: Optional[Mapping[str, str]] = None) -> Dict[str, ResolvedVariable]:
         """
         Resolve final variable values using policy rules:
         a) If any variable is defined as force, use the last force definition.
         b) Else if any immediate, use the first one provided the variable is not set in the env.
         c) If lazy, use the last one provided the variable is not set in the env.
 
+        Definitions are folded in a single pass over the layers, keeping the
+        deciding definition of each policy as it goes, without copying them.
+
         Args:
-            variable_definitions: Dict mapping variable names to lists of EnvVariable definitions
+            layers: (layer name, variables defined by the layer) in build order
+            environ: Environment the variables are resolved against (default os.environ)
 
         Returns:
-            Dict mapping variable names to the resolved EnvVariable instance in layer dependency order
+            Dict mapping variable names to the resolved definition, in the order
+            variables are first defined. A variable set in the env which no
+            definition overrides resolves to its first definition with the
+            policy "already_set".
         """
         import os
-        resolved = {}
-
-        # Get all variables and sort by their earliest position to maintain layer dependency order
-        all_vars = []
-        for var_name, definitions in variable_definitions.items():
-            if definitions:
-                earliest_position = min(d.position for d in definitions)
-                all_vars.append((var_name, definitions, earliest_position))
-
-        # Sort by earliest position to maintain layer dependency order
-        all_vars.sort(key=lambda x: x[2])
-
-        for var_name, definitions, _ in all_vars:
-            resolved_var = self._resolve_single_variable(var_name, definitions)
-            if resolved_var:
-                resolved[var_name] = resolved_var
-            elif var_name in os.environ:
-                # Variable is in environment - create a special entry for skip message
-                # Use the first definition for source layer info
-                first_def = definitions[0]
-                env_var = EnvVariable(
-                    name=var_name,
-                    value=os.environ[var_name],
-                    description=first_def.description,
-                    required=first_def.required,
-                    validator=first_def.validator,
-                    set_policy="already_set",  # Special policy for environment variables
-                    source_layer=first_def.source_layer,
-                    position=first_def.position
-                )
-                resolved[var_name] = env_var
-
-        return resolved
-
-    def _resolve_single_variable(self, var_name: str, definitions: List[EnvVariable]) -> Optional[EnvVariable]:
-        """Resolve a single variable using policy rules."""
-        import os
-
-        # Separate definitions by policy
-        force_defs = [d for d in definitions if d.set_policy == "force"]
-        immediate_defs = [d for d in definitions if d.set_policy == "immediate"]
-        lazy_defs = [d for d in definitions if d.set_policy == "lazy"]
-
-        # Rule a: If any variable is defined as force, use the last force definition
-        if force_defs:
-            return self._get_last_by_position(force_defs)
 
-        # Rule b: Else if any immediate, use the first one provided the variable is not set in the env
-        elif immediate_defs and var_name not in os.environ:
-            return self._get_first_by_position(immediate_defs)
+        # name -> [first definition, first immediate, last force, last lazy], each (var, layer)
+        slots: Dict[str, list] = {}
+        for layer_name, variables in layers:
+            for var_name, env_var in variables.items():
+                slot = slots.get(var_name)
+                if slot is None:
+                    slot = slots[var_name] = [(env_var, layer_name), None, None, None]
+                policy = env_var.set_policy
+                if policy == "force":
+                    slot[2] = (env_var, layer_name)
+                elif policy == "immediate":
+                    if slot[1] is None:
+                        slot[1] = (env_var, layer_name)
+                elif policy == "lazy":
+                    slot[3] = (env_var, layer_name)
 
-        # Rule c: If lazy, use the last one provided the variable is not set in the env
-        elif lazy_defs and var_name not in os.environ:
-            return self._get_last_by_position(lazy_defs)
-
-        # Variable is set in environment or no applicable definitions
-        return None
-
-    def _get_first_by_position(self, definitions: List[EnvVariable]) -> EnvVariable:
-        """Get the definition with the earliest position (first in dependency order)."""
-        return min(definitions, key=lambda d: d.position)
+        resolved = {}
+        in_env = set(os.environ if environ is None else environ)
+        for var_name, (first, immediate, force, lazy) in slots.items():
+            if force is not None:
+                resolved[var_name] = ResolvedVariable(force[0], force[1], "force")
+            elif var_name in in_env:
+                # Variable is in environment - keep the first definition for the skip message
+                resolved[var_name] = ResolvedVariable(first[0], first[1], "already_set")
+            elif immediate is not None:
+                resolved[var_name] = ResolvedVariable(immediate[0], immediate[1], "immediate")
+            elif lazy is not None:
+                resolved[var_name] = ResolvedVariable(lazy[0], lazy[1], "lazy")
 
-    def _get_last_by_position(self, definitions: List[EnvVariable]) -> EnvVariable:
-        """Get the definition with the latest position (last in dependency order)."""
-        return max(definitions, key=lambda d: d.position)
+        return resolved
 
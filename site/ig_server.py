@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import glob
+import socket
+import signal
+import tempfile
+import traceback
+from typing import Callable, Dict, List, Optional
+
+
+# Protocol
+#
+# The client connects to the UNIX socket and sends a single byte carrying
+# its stdin, stdout and stderr as SCM_RIGHTS ancillary data, followed by one
+# newline terminated JSON request:
+#   {"root": IGROOT, "argv": [...], "cwd": DIR, "env": {...}}
+# The server forks a worker per request which runs the command against the
+# client's cwd, environment and file descriptors, then replies with one
+# newline terminated JSON response:
+#   {"status": EXIT_CODE}  or  {"error": REASON}
+# An error response means the request was not run and the client should run
+# it locally instead. Once the request has been sent, any other failure is
+# reported as one, never by running the command locally, as it may already
+# have run.
+
+PROTOCOL_VERSION = 1
+
+# Set to 1 to run commands locally even when a server is running
+NO_SERVER_ENV = 'IG_NO_SERVER'
+
+
+def default_socket_path() -> str:
+    """Return the socket path from IG_SOCKET, else a per-user default"""
+    path = os.environ.get('IG_SOCKET')
+    if path:
+        return path
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(rundir, f'ig-{os.getuid()}.sock')
+
+
+def _read_line(conn: socket.socket) -> Optional[bytes]:
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _send_json(conn: socket.socket, obj: dict):
+    conn.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+def _code_fingerprint(root: str) -> Dict[str, int]:
+    """mtimes of the code a server is running, to detect it going stale"""
+    files = [os.path.join(root, 'bin', 'ig')] + glob.glob(os.path.join(root, 'site', '*.py'))
+    stamps = {}
+    for path in files:
+        try:
+            stamps[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+    return stamps
+
+
+def forward(argv: List[str], root: str) -> Optional[int]:
+    """
+    Run argv on a running server and return its exit status, or None if
+    forwarding is disabled, no server is listening or it declined the
+    request, eg because it runs another ig root or older code.
+    """
+    if os.environ.get(NO_SERVER_ENV) == '1' or (argv and argv[0] == 'serve'):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(default_socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    try:
+        request = {
+            'version': PROTOCOL_VERSION,
+            'root': root,
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }
+        try:
+            socket.send_fds(sock, [b'\0'], [0, 1, 2])
+            _send_json(sock, request)
+        except OSError:
+            return None
+
+        # The command may have started from here on
+        try:
+            reply = _read_line(sock)
+        except OSError as e:
+            print(f"Error: lost connection to ig server: {e}", file=sys.stderr)
+            return 1
+    finally:
+        sock.close()
+
+    if reply is None:
+        # Worker died without replying, so the command may have partly run
+        print("Error: ig server worker exited unexpectedly", file=sys.stderr)
+        return 1
+
+    try:
+        response = json.loads(reply)
+    except ValueError:
+        response = None
+    if not isinstance(response, dict):
+        print("Error: malformed reply from ig server", file=sys.stderr)
+        return 1
+    if 'error' in response:
+        return None
+    status = response.get('status')
+    if not isinstance(status, int):
+        print("Error: malformed reply from ig server", file=sys.stderr)
+        return 1
+    return status
+
+
+def _run_command(handler: Callable[[List[str]], None], argv: List[str]) -> int:
+    """Run a command and return its exit status as the interpreter would"""
+    try:
+        handler(argv)
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def _worker(conn: socket.socket, fds: List[int], request: dict,
+            handler: Callable[[List[str]], None]):
+    """Run one request in a forked child. Never returns."""
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        # Rebind the standard streams so buffering follows the client's
+        # descriptors rather than the server's
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        sys.argv = [sys.argv[0]] + request['argv']
+
+        status = _run_command(handler, request['argv'])
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+        try:
+            _send_json(conn, {'status': status})
+        except Exception:
+            pass
+        os._exit(status & 0xff)
+
+
+def _check_peer(conn: socket.socket) -> bool:
+    """Only serve requests from our own user, refusing any that can't be checked"""
+    try:
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+    except (AttributeError, OSError):
+        return False
+    uid = int.from_bytes(creds[4:8], sys.byteorder)
+    return uid == os.getuid()
+
+
+def _reap_workers():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def serve(socket_path: str, root: str, handler: Callable[[List[str]], None],
+          idle_timeout: Optional[float] = None, warm: Optional[Callable[[], None]] = None):
+    """
+    Serve ig commands on socket_path until terminated, idle for
+    idle_timeout seconds, or the code under root changes. Each request is
+    run by handler(argv) in a worker forked from this already initialised
+    process. If given, warm() is called at startup and whenever the server
+    is idle after a request to refresh state inherited by workers.
+    """
+    # Refuse to steal the socket from a live server, but clear a stale one
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+        raise ValueError(f"An ig server is already listening on {socket_path}")
+    except (FileNotFoundError, ConnectionRefusedError):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    finally:
+        probe.close()
+
+    fingerprint = _code_fingerprint(root)
+    if warm:
+        warm()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    # Wake periodically to reap workers and check for idleness
+    server.settimeout(1.0)
+
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, _terminate)
+
+    print(f"ig server listening on {socket_path}", file=sys.stderr)
+    idle = 0.0
+    stale = False
+    try:
+        while True:
+            _reap_workers()
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if stale and warm:
+                    # Refresh while idle rather than competing with workers
+                    warm()
+                    stale = False
+                idle += 1.0
+                if idle_timeout and idle >= idle_timeout:
+                    print("ig server idle, exiting", file=sys.stderr)
+                    return
+                continue
+            idle = 0.0
+            stale = True
+
+            with conn:
+                conn.settimeout(None)
+                if not _handle(conn, root, fingerprint, handler):
+                    return
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+
+def _handle(conn: socket.socket, root: str, fingerprint: Dict[str, int],
+            handler: Callable[[List[str]], None]) -> bool:
+    """Dispatch a connection to a worker. Returns False if the server should exit."""
+    fds: List[int] = []
+    try:
+        _, fds, _, _ = socket.recv_fds(conn, 1, 3)
+        line = _read_line(conn)
+        request = json.loads(line) if line else None
+    except (OSError, ValueError):
+        request = None
+
+    try:
+        if not isinstance(request, dict) or len(fds) != 3 or not _check_peer(conn):
+            _send_json(conn, {'error': 'bad request'})
+            return True
+        if request.get('version') != PROTOCOL_VERSION or request.get('root') != root:
+            _send_json(conn, {'error': f'server runs a different ig ({root})'})
+            return True
+        if _code_fingerprint(root) != fingerprint:
+            # Let the client run the new code itself and stop serving the old
+            _send_json(conn, {'error': 'server code is out of date'})
+            print("ig code changed, exiting", file=sys.stderr)
+            return False
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            _worker(conn, fds, request, handler)
+        return True
+    except OSError:
+        return True
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def Server_register_parser(subparsers, handler: Callable[[List[str]], None], root: str,
+                           warm: Optional[Callable[[], None]] = None):
+    parser = subparsers.add_parser(
+        "serve",
+        help="Run a resident server which bin/ig forwards commands to",
+        description=("Keep ig loaded and answer commands on a UNIX socket. While it runs, "
+                     "bin/ig forwards commands for the same ig root and code to it instead of "
+                     f"starting a new interpreter, unless {NO_SERVER_ENV}=1 is set."))
+    parser.add_argument("--socket", metavar="PATH", default=default_socket_path(),
+                        help="Socket to listen on (default: $IG_SOCKET or a per-user runtime path)")
+    parser.add_argument("--idle-timeout", type=float, metavar="SECONDS", default=None,
+                        help="Exit after this many seconds without a request")
+    parser.set_defaults(func=lambda args: _serve_main(args, handler, root, warm))
+
+
+def _serve_main(args, handler, root, warm):
+    try:
+        serve(args.socket, root, handler, idle_timeout=args.idle_timeout, warm=warm)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
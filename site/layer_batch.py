@@ -0,0 +1,121 @@
+import io
+import re
+import contextlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config_loader import ConfigLoader
+from env_file import runenv_value
+
+
+# Config file suffixes recognised in a batch target
+CONFIG_SUFFIXES = ('.yaml', '.yml', '.ini', '.cfg', '.conf')
+
+# Config variables naming the layers to build, as collected by rpi-image-gen
+_LAYER_VAR = re.compile(r'^IGconf_(device_layer|image_layer|layer_.+)$')
+
+
+def parse_target(target: str) -> Tuple[Optional[str], Dict[str, str], List[str]]:
+    """
+    Split a batch target into (config file, variable assignments, layers).
+    A target is a comma separated list of at most one config file, any
+    number of NAME=VALUE assignments and any number of layer names.
+    """
+    config = None
+    assignments: Dict[str, str] = OrderedDict()
+    layers: List[str] = []
+    for item in (i.strip() for i in target.split(',')):
+        if not item:
+            continue
+        if '=' in item:
+            name, value = item.split('=', 1)
+            assignments[name.strip()] = value
+        elif item.lower().endswith(CONFIG_SUFFIXES):
+            if config is not None:
+                raise ValueError(f"More than one config file in batch target '{target}'")
+            config = item
+        else:
+            layers.append(item)
+
+    if config is None and not layers:
+        raise ValueError(f"Batch target '{target}' names no config file or layers")
+    return config, assignments, layers
+
+
+def _load_config(config: str, config_paths: List[str], assignments: Dict[str, str],
+                 environ: Dict[str, str]) -> Dict[str, str]:
+    """
+    Load a config file into environ, as ig config does, and return the
+    variables it defines in file order. Assignments take precedence over
+    the config file and are also returned.
+    """
+    loader = ConfigLoader(config, search_paths=config_paths, environ=environ)
+    with contextlib.redirect_stdout(io.StringIO()):
+        loader.load_all()
+
+    names = [loader._env_key(section, key) for section, keys in loader.data.items() for key in keys]
+    names += [name for name in assignments if name not in names]
+    # Later stages see config values via runenv
+    config_env = OrderedDict((name, runenv_value(environ[name])) for name in names if name in environ)
+    environ.update(config_env)
+    return config_env
+
+
+def plan_batch(manager, targets: List[str], config_paths: Optional[List[str]] = None,
+               base_layers: Optional[List[str]] = None) -> Dict[str, dict]:
+    """
+    Plan every target with a single LayerManager and return the results keyed
+    by target. Each target is planned against its own copy of the manager's
+    environment, plus its assignments and config file, as if it were the
+    only one. Layer files unaffected by those changes are not parsed again
+    and the parsed layers are shared between targets. Layers in base_layers
+    are built first for every target with a config file.
+
+    A planned target gives its layers, build order, the path of each layer
+    and the variables set by its config and layers. A target which can't be
+    planned gives its status as 'failed' and the reasons.
+    """
+    config_paths = config_paths or ['./config']
+    base_layers = base_layers or []
+    base_env = dict(manager.environ)
+    results: Dict[str, dict] = OrderedDict()
+
+    for target in targets:
+        result: dict = {'status': 'failed'}
+        results[target] = result
+
+        environ = dict(base_env)
+        try:
+            config, assignments, layers = parse_target(target)
+            environ.update(assignments)
+            env = OrderedDict(assignments)
+            if config:
+                env = _load_config(config, config_paths, assignments, environ)
+                layers = base_layers + [value for name, value in env.items()
+                                        if _LAYER_VAR.match(name) and value] + layers
+        except (OSError, ValueError) as e:
+            result['errors'] = [str(e)]
+            continue
+        result['layers'] = layers
+
+        # Picks up dependencies expanded from this target's variables
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                target_manager = manager.for_environ(environ)
+                build_order = target_manager.plan_layers(layers)
+            except ValueError as e:
+                result['errors'] = [str(e)]
+                continue
+
+        if build_order is None:
+            result['errors'] = target_manager.errors
+            continue
+
+        env.update(target_manager.write_log)
+        result['status'] = 'ok'
+        result['build_order'] = build_order
+        result['paths'] = {layer: target_manager.layer_files[layer] for layer in build_order}
+        result['env'] = env
+
+    return results
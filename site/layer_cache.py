@@ -0,0 +1,236 @@
+import os
+import json
+import hashlib
+import tempfile
+from typing import Any, Dict, Optional, Set, Tuple
+
+import yaml_loader
+from env_expand import references
+from logger import log_warning
+
+
+def file_digest(path: str) -> str:
+    """Return the sha256 hex digest of a file's content"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def env_references(texts, environ=None) -> Set[str]:
+    """Collect env var names referenced by ${VAR} in texts, following nested references."""
+    if environ is None:
+        environ = os.environ
+    found: Set[str] = set()
+    pending = [t for t in texts if t]
+    while pending:
+        for name in references(pending.pop()):
+            if name in found:
+                continue
+            found.add(name)
+            value = environ.get(name)
+            if value and '${' in value:
+                pending.append(value)
+    return found
+
+
+def env_snapshot(names, environ=None) -> Dict[str, Optional[str]]:
+    """Capture the current value (None if unset) of each named variable"""
+    if environ is None:
+        environ = os.environ
+    return {name: environ.get(name) for name in sorted(names)}
+
+
+class LayerCache:
+    """
+    Persistent cache of parsed layer files.
+
+    Entries are keyed on the absolute file path and validated against the
+    file's mtime, size and content hash. An entry holds the raw X-Env fields
+    as parsed from the file (environment independent), plus derived results
+    (layer info and lint results) per doc mode. Derived results depend on the
+    environment via ${VAR} dependency expansion and lazy variable overrides,
+    so each records a snapshot of the variables it was computed against and
+    is only reused if that snapshot still matches.
+
+    Build orders are held alongside, keyed on the fingerprint of the layer
+    graph they were resolved against and the targets. The fingerprint covers
+    every layer's expanded dependency fields, so a layer file edit or a
+    change to a variable referenced by ${VAR} which affects the graph gives
+    a different key.
+
+    A cache created without a path is held in memory only.
+    """
+
+    VERSION = 2
+
+    # Most recently stored build orders kept
+    MAX_ORDERS = 256
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: Dict[str, dict] = {}
+        self._orders: Dict[str, dict] = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log_warning(f"Ignoring unreadable layer cache {self.path}: {e}")
+            return
+
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return
+        entries = data.get('entries')
+        if isinstance(entries, dict):
+            self._entries = entries
+        orders = data.get('orders')
+        if isinstance(orders, dict):
+            self._orders = orders
+
+    def lookup(self, filepath: str) -> Optional[dict]:
+        """Return the entry for filepath if the file is unchanged, else None"""
+        entry = self._entries.get(filepath)
+        if entry is None:
+            return None
+
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+
+        if entry.get('mtime_ns') == st.st_mtime_ns and entry.get('size') == st.st_size:
+            return entry
+
+        # Touched but possibly unchanged - fall back to the content hash
+        if entry.get('size') == st.st_size:
+            try:
+                digest = file_digest(filepath)
+            except OSError:
+                return None
+            if digest == entry.get('sha256'):
+                entry['mtime_ns'] = st.st_mtime_ns
+                self._dirty = True
+                return entry
+
+        return None
+
+    def store(self, filepath: str, raw: Optional[dict], error: Optional[str] = None) -> dict:
+        """Record the raw parse result of filepath, discarding any derived results"""
+        st = os.stat(filepath)
+        entry = {
+            'mtime_ns': st.st_mtime_ns,
+            'size': st.st_size,
+            'sha256': file_digest(filepath),
+            'raw': raw,
+            'error': error,
+            'derived': {},
+        }
+        self._entries[filepath] = entry
+        self._dirty = True
+        return entry
+
+    @staticmethod
+    def _derived_key(doc_mode: bool) -> str:
+        return 'doc' if doc_mode else 'build'
+
+    def get_derived(self, entry: dict, doc_mode: bool, environ=None) -> Optional[dict]:
+        """Return derived results for doc_mode if computed against environ (default os.environ)"""
+        derived = entry.get('derived', {}).get(self._derived_key(doc_mode))
+        if not derived:
+            return None
+        snapshot = derived.get('env', {})
+        if env_snapshot(snapshot.keys(), environ) != snapshot:
+            return None
+        return derived
+
+    def set_derived(self, entry: dict, doc_mode: bool, env_names, layer_info: Optional[dict],
+                    lint_results: Optional[dict], environ=None):
+        """Record derived results for doc_mode along with the values in environ they depend on"""
+        entry.setdefault('derived', {})[self._derived_key(doc_mode)] = {
+            'env': env_snapshot(env_names, environ),
+            'layer': layer_info,
+            'lint': lint_results or {},
+        }
+        self._dirty = True
+
+    @staticmethod
+    def _order_key(fingerprint: str, targets) -> str:
+        return hashlib.sha256('\0'.join([fingerprint, *targets]).encode()).hexdigest()
+
+    def get_order(self, fingerprint: str, targets) -> Optional[Tuple[Optional[list], Optional[str]]]:
+        """Return the (build order, error) stored for targets in the graph with fingerprint"""
+        order = self._orders.get(self._order_key(fingerprint, targets))
+        if not isinstance(order, dict):
+            return None
+        return order.get('order'), order.get('error')
+
+    def set_order(self, fingerprint: str, targets, build_order: Optional[list], error: Optional[str]):
+        """Record the build order of targets, or the error resolving it, in the graph with fingerprint"""
+        key = self._order_key(fingerprint, targets)
+        self._orders.pop(key, None)
+        self._orders[key] = {'order': build_order, 'error': error}
+        while len(self._orders) > self.MAX_ORDERS:
+            del self._orders[next(iter(self._orders))]
+        self._dirty = True
+
+    def save(self):
+        """Write the cache back to disk if anything changed"""
+        if not self._dirty or self.path is None:
+            return
+
+        # Drop entries for files which have gone away
+        entries = {p: e for p, e in self._entries.items() if os.path.exists(p)}
+
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.layer-cache-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.VERSION, 'entries': entries, 'orders': self._orders}, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            log_warning(f"Could not write layer cache {self.path}: {e}")
+
+
+class DocumentCache:
+    """
+    In-memory cache of parsed YAML layer documents, so each file is only
+    parsed once however many of its sections are looked up. Entries are
+    revalidated against the file's mtime and size.
+    """
+
+    def __init__(self):
+        self._docs: Dict[str, Tuple[int, int, Any]] = {}
+
+    def get(self, filepath: str) -> Any:
+        """Return the parsed YAML document in filepath, or None if unreadable or invalid"""
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+
+        cached = self._docs.get(filepath)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+
+        try:
+            with open(filepath, 'rb') as f:
+                doc = yaml_loader.safe_load(f)
+        except (OSError, yaml_loader.YAMLError):
+            doc = None
+        self._docs[filepath] = (st.st_mtime_ns, st.st_size, doc)
+        return doc
+
+
+# Shared by everything loading layer documents in this process
+documents = DocumentCache()
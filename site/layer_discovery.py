@@ -0,0 +1,98 @@
+import os
+from fnmatch import fnmatchcase
+from typing import Iterable, List, Optional, Set, Tuple
+
+
+# Per-directory file of patterns to exclude from discovery
+IGNORE_FILE = '.layerignore'
+
+
+def read_ignore_file(path: str) -> List[str]:
+    """Return the patterns in an ignore file, skipping blanks and comments"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+    except (OSError, UnicodeDecodeError):
+        return []
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def _is_ignored(rel_path: str, name: str, is_dir: bool, rules: List[Tuple[str, str]]) -> bool:
+    """
+    Check an entry against (scope, pattern) ignore rules. Patterns without a
+    '/' match the entry name at any depth below their scope, others match the
+    path relative to their scope. A trailing '/' restricts a pattern to
+    directories.
+    """
+    for scope, pattern in rules:
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip('/')
+
+        if '/' in pattern:
+            sub_path = rel_path[len(scope) + 1:] if scope else rel_path
+            if fnmatchcase(sub_path, pattern.lstrip('/')):
+                return True
+        elif fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def discover_files(root: str, patterns: Iterable[str], ignore: Iterable[str] = (),
+                   visited: Optional[List[str]] = None) -> List[str]:
+    """
+    Walk root once and return the paths of all files whose name matches any
+    of patterns. Like glob, hidden entries are skipped and symlinks are
+    followed. Directories matching ignore, or a pattern in an IGNORE_FILE
+    along the way, are pruned without being read. If given, visited is
+    extended with every directory read.
+    """
+    patterns = list(patterns)
+    found: List[str] = []
+    seen: Set[Tuple[int, int]] = set()  # (st_dev, st_ino) of visited directories
+
+    stack = [(str(root), '', [('', p) for p in ignore])]
+    while stack:
+        dirpath, rel_dir, rules = stack.pop()
+
+        try:
+            st = os.stat(dirpath)
+            entries = sorted(os.scandir(dirpath), key=lambda e: e.name)
+        except OSError:
+            continue
+
+        # Guard against symlink loops
+        if (st.st_dev, st.st_ino) in seen:
+            continue
+        seen.add((st.st_dev, st.st_ino))
+        if visited is not None:
+            visited.append(dirpath)
+
+        local_rules = read_ignore_file(os.path.join(dirpath, IGNORE_FILE))
+        if local_rules:
+            rules = rules + [(rel_dir, p) for p in local_rules]
+
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if rules and _is_ignored(rel_path, entry.name, is_dir, rules):
+                continue
+
+            if is_dir:
+                subdirs.append((entry.path, rel_path, rules))
+            elif any(fnmatchcase(entry.name, p) for p in patterns):
+                found.append(entry.path)
+
+        # Depth first, in name order
+        stack.extend(reversed(subdirs))
+
+    return found
@@ -0,0 +1,133 @@
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+def read_timings(timings_file: str) -> Dict[str, float]:
+    """
+    Read per-layer durations in seconds from a timing log of layer=seconds
+    lines, as recorded from a previous build. Blank lines and lines starting
+    with # are ignored.
+    """
+    timings: Dict[str, float] = {}
+    with open(timings_file, 'r', encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            layer, sep, seconds = line.partition('=')
+            try:
+                if not sep:
+                    raise ValueError
+                timings[layer.strip()] = float(seconds.strip().strip('"'))
+            except ValueError:
+                raise ValueError(f"{timings_file}:{lineno}: expected layer=seconds, got '{line}'") from None
+    return timings
+
+
+def layer_costs(manager, layer_name: str) -> Dict[str, int]:
+    """Count the packages a layer installs and the hooks it runs from its mmdebstrap section"""
+    mmdebstrap = manager._get_mmdebstrap_config(layer_name) or {}
+    packages = mmdebstrap.get('packages') or []
+    hooks = [v for k, v in mmdebstrap.items() if k.endswith('-hooks') and isinstance(v, list)]
+    return {
+        'packages': sum(len(str(p).split()) for p in packages) if isinstance(packages, list) else 0,
+        'hooks': sum(len(h) for h in hooks),
+    }
+
+
+def build_graph(manager, targets: List[str], timings: Optional[Dict[str, float]] = None) -> dict:
+    """
+    Resolve targets and return their dependency graph, each layer annotated
+    with its cost, together with the critical path through it.
+
+    Layers are weighted by their duration in timings if given, otherwise by
+    their package count plus hook count. The critical path is the chain of
+    dependencies with the greatest total weight, which bounds the build
+    however many layers run at once.
+    """
+    build_order = manager.get_build_order(targets)
+    graph = manager.graph
+    nodes = [graph.node(layer) for layer in build_order]
+    in_build = set(nodes)
+
+    layers = []
+    weights: Dict[int, float] = {}
+    for node, layer in zip(nodes, build_order):
+        costs = layer_costs(manager, layer)
+        duration = timings.get(layer) if timings is not None else None
+        if timings is not None:
+            weights[node] = duration or 0
+        else:
+            weights[node] = costs['packages'] + costs['hooks']
+        layers.append(OrderedDict([
+            ('name', layer),
+            ('path', manager.layer_files.get(layer)),
+            ('packages', costs['packages']),
+            ('hooks', costs['hooks']),
+            ('duration', duration),
+            ('weight', weights[node]),
+            ('depends', [graph.names[d] for d in graph.depends[node] if d in in_build]),
+            ('optional_depends', [graph.names[d] for d in graph.optional_depends[node] if d in in_build]),
+        ]))
+
+    path, weight = graph.critical_path(nodes, weights)
+    return OrderedDict([
+        ('targets', list(targets)),
+        ('weight_unit', 'seconds' if timings is not None else 'packages+hooks'),
+        ('layers', layers),
+        ('critical_path', OrderedDict([
+            ('layers', [graph.names[node] for node in path]),
+            ('weight', weight),
+        ])),
+    ])
+
+
+def graph_to_json(graph: dict) -> str:
+    return json.dumps(graph, indent=2)
+
+
+def _dot_escape(text: str) -> str:
+    """Escape text for use inside a double quoted DOT string"""
+    return text.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _dot_id(name: str) -> str:
+    return '"' + _dot_escape(name) + '"'
+
+
+def graph_to_dot(graph: dict) -> str:
+    """
+    Render a graph from build_graph in Graphviz DOT. Edges point from a layer
+    to what it depends on, optional dependencies dashed, and the critical
+    path is drawn in red.
+    """
+    critical = graph['critical_path']['layers']
+    on_path = set(critical)
+    critical_edges = set(zip(critical[1:], critical))
+
+    lines = ['digraph layers {', '  rankdir=BT;', '  node [shape=box];']
+    for layer in graph['layers']:
+        label = f"{_dot_escape(layer['name'])}\\n{layer['packages']} packages, {layer['hooks']} hooks"
+        if layer['duration'] is not None:
+            label += f"\\n{layer['duration']:g}s"
+        attrs = [f'label="{label}"']
+        if layer['name'] in on_path:
+            attrs += ['color=red', 'penwidth=2']
+        lines.append(f"  {_dot_id(layer['name'])} [{', '.join(attrs)}];")
+
+    for layer in graph['layers']:
+        for kind in ('depends', 'optional_depends'):
+            for dep in layer[kind]:
+                attrs = []
+                if kind == 'optional_depends':
+                    attrs.append('style=dashed')
+                if (layer['name'], dep) in critical_edges:
+                    attrs += ['color=red', 'penwidth=2']
+                suffix = f" [{', '.join(attrs)}]" if attrs else ''
+                lines.append(f"  {_dot_id(layer['name'])} -> {_dot_id(dep)}{suffix};")
+
+    lines.append(f"  label=\"Critical path: {_dot_escape(' -> '.join(critical))} "
+                 f"({graph['critical_path']['weight']:g} {graph['weight_unit']})\";")
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
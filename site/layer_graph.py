@@ -0,0 +1,473 @@
+import json
+import hashlib
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+
+class LayerGraph:
+    """
+    Dependency graph of loaded layers compiled to integer ids.
+
+    Layers are numbered in load order. Names which are only referenced as a
+    dependency are numbered after them and marked missing. Each layer's
+    depends, optional-depends, provides, provider-requires and conflicts are
+    held as tuples in declaration order, so walks over the graph visit layers in the
+    same order as walks over the layer info dicts.
+    """
+
+    def __init__(self, layer_info: Dict[str, Optional[dict]]):
+        self.names: List[str] = list(layer_info)
+        self.ids: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        self.num_layers = len(self.names)
+
+        self.depends: List[Tuple[int, ...]] = []
+        self.optional_depends: List[Tuple[int, ...]] = []
+        self.provides: List[Tuple[str, ...]] = []
+        self.provider_requires: List[Tuple[str, ...]] = []
+        self.conflicts: List[Tuple[str, ...]] = []
+
+        for name in list(self.names):
+            info = layer_info[name] or {}
+            self.depends.append(tuple(self._node(dep) for dep in info.get('depends', [])))
+            self.optional_depends.append(tuple(self._node(dep) for dep in info.get('optional_depends', [])))
+            self.provides.append(tuple(info.get('provides', [])))
+            self.provider_requires.append(tuple(info.get('provider_requires', [])))
+            self.conflicts.append(tuple(info.get('conflicts', [])))
+
+        # Missing layers have no edges of their own
+        for _ in range(self.num_layers, len(self.names)):
+            self.depends.append(())
+            self.optional_depends.append(())
+            self.provides.append(())
+            self.provider_requires.append(())
+            self.conflicts.append(())
+        self.all_provides: Set[str] = set(p for provides in self.provides for p in provides)
+
+        # Per include_optional: layers on a dependency cycle, and ordered transitive deps
+        self._cyclic: Dict[bool, Set[int]] = {}
+        self._components: Dict[bool, List[List[int]]] = {}
+        self._reverse: Dict[bool, List[Tuple[int, ...]]] = {}
+        self._edge_lists: Dict[bool, List[Tuple[int, ...]]] = {}
+        self._all_deps: Dict[bool, Dict[int, Tuple[int, ...]]] = {False: {}, True: {}}
+        self._fingerprint: Optional[str] = None
+
+        # Build order results keyed on target names, as (order, error)
+        self.orders: Dict[Tuple[str, ...], Tuple[Optional[List[str]], Optional[str]]] = {}
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Digest of everything a build order depends on: the layers in load order
+        and their expanded dependency, provider and conflict fields.
+        """
+        if self._fingerprint is None:
+            fields = [self.names, self.num_layers, self.depends, self.optional_depends,
+                      self.provides, self.provider_requires, self.conflicts]
+            self._fingerprint = hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+        return self._fingerprint
+
+    def _node(self, name: str) -> int:
+        node = self.ids.get(name)
+        if node is None:
+            node = len(self.names)
+            self.names.append(name)
+            self.ids[name] = node
+        return node
+
+    def node(self, name: str) -> Optional[int]:
+        """Return the id of a layer or referenced name, or None if unknown"""
+        return self.ids.get(name)
+
+    def is_layer(self, node: int) -> bool:
+        """Whether node is a loaded layer rather than a missing dependency"""
+        return node < self.num_layers
+
+    def _edges(self, node: int, include_optional: bool) -> Tuple[int, ...]:
+        """Layers node is expanded into: its depends, then any loaded optional depends"""
+        if not include_optional:
+            return self.depends[node]
+        edges = self._edge_lists.get(True)
+        if edges is None:
+            edges = [deps + tuple(d for d in opts if self.is_layer(d))
+                     for deps, opts in zip(self.depends, self.optional_depends)]
+            self._edge_lists[True] = edges
+        return edges[node]
+
+    def dependents(self, node: int, include_optional: bool = False) -> Tuple[int, ...]:
+        """Layers which directly depend on node, in load order"""
+        reverse = self._reverse.get(include_optional)
+        if reverse is None:
+            # Inverted once, then shared by every query
+            lists: List[List[int]] = [[] for _ in self.names]
+            for layer in range(self.num_layers):
+                for dep in self._edges(layer, include_optional):
+                    if not lists[dep] or lists[dep][-1] != layer:
+                        lists[dep].append(layer)
+            reverse = [tuple(deps) for deps in lists]
+            self._reverse[include_optional] = reverse
+        return reverse[node]
+
+    def all_dependents(self, node: int, include_optional: bool = False) -> List[int]:
+        """Layers which directly or transitively depend on node, in load order"""
+        seen = {node}
+        queue = [node]
+        for current in queue:
+            for dependent in self.dependents(current, include_optional):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    queue.append(dependent)
+        return sorted(queue[1:])
+
+    def cyclic_nodes(self, include_optional: bool = False) -> Set[int]:
+        """Layers on a dependency cycle"""
+        cyclic = self._cyclic.get(include_optional)
+        if cyclic is None:
+            cyclic = set(node for scc in self.cyclic_components(include_optional) for node in scc)
+            self._cyclic[include_optional] = cyclic
+        return cyclic
+
+    def cyclic_components(self, include_optional: bool = False) -> List[List[int]]:
+        """
+        Strongly connected components containing a dependency cycle, found
+        with a single iterative Tarjan pass over the whole graph. Components
+        are in order of their first layer, members in load order.
+        """
+        components = self._components.get(include_optional)
+        if components is not None:
+            return components
+
+        components = []
+        index: Dict[int, int] = {}
+        lowlink: Dict[int, int] = {}
+        on_stack: Set[int] = set()
+        scc_stack: List[int] = []
+
+        for root in range(self.num_layers):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = lowlink[node] = len(index)
+                    scc_stack.append(node)
+                    on_stack.add(node)
+                edges = self._edges(node, include_optional)
+                if i < len(edges):
+                    work.append((node, i + 1))
+                    dep = edges[i]
+                    if dep not in index:
+                        work.append((dep, 0))
+                    elif dep in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dep])
+                    continue
+
+                if lowlink[node] == index[node]:
+                    scc = []
+                    while True:
+                        member = scc_stack.pop()
+                        on_stack.discard(member)
+                        scc.append(member)
+                        if member == node:
+                            break
+                    if len(scc) > 1 or node in edges:
+                        components.append(sorted(scc))
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+        components.sort()
+        self._components[include_optional] = components
+        return components
+
+    def component_cycle(self, component: List[int], include_optional: bool = False) -> List[int]:
+        """
+        Return a shortest cycle through the first layer of a cyclic
+        component, as the path around it starting and ending at that layer.
+        """
+        start = component[0]
+        members = set(component)
+        parent: Dict[int, int] = {}
+        queue = [start]
+        for node in queue:
+            for dep in self._edges(node, include_optional):
+                if dep == start:
+                    path = [node]
+                    while path[-1] != start:
+                        path.append(parent[path[-1]])
+                    return path[::-1] + [start]
+                if dep in members and dep not in parent:
+                    parent[dep] = node
+                    queue.append(dep)
+        return []
+
+    def all_dependencies(self, node: int, include_optional: bool = True) -> Tuple[int, ...]:
+        """
+        Transitive dependencies of node in discovery order: each dependency
+        followed by its own transitive dependencies, optional ones after the
+        required. Each layer's result is computed by a single walk and
+        memoized for later queries.
+        """
+        if not self.is_layer(node):
+            return ()
+        memo = self._all_deps[include_optional]
+        if node in memo:
+            return memo[node]
+
+        cyclic = self.cyclic_nodes(include_optional)
+        if node in cyclic:
+            memo[node] = self._path_dependencies(node, frozenset(), include_optional)
+            return memo[node]
+
+        # Off any cycle the order is that of a preorder walk which doesn't
+        # revisit layers. Layers on a cycle depend on the path taken through
+        # it, so are expanded as a whole from their own result.
+        result = []
+        seen = set()
+        stack = [iter(self._edges(node, include_optional))]
+        while stack:
+            for dep in stack[-1]:
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                result.append(dep)
+                if dep in cyclic:
+                    for trans_dep in self.all_dependencies(dep, include_optional):
+                        if trans_dep not in seen:
+                            seen.add(trans_dep)
+                            result.append(trans_dep)
+                else:
+                    stack.append(iter(self._edges(dep, include_optional)))
+                break
+            else:
+                stack.pop()
+
+        memo[node] = tuple(result)
+        return memo[node]
+
+    def _path_dependencies(self, node: int, visited: FrozenSet[int], include_optional: bool) -> Tuple[int, ...]:
+        """Transitive dependencies of node not expanding anything already on the path"""
+        if node in visited or not self.is_layer(node):
+            return ()
+        if not visited and node in self._all_deps[include_optional]:
+            return self._all_deps[include_optional][node]
+        if node not in self.cyclic_nodes(include_optional):
+            return self.all_dependencies(node, include_optional)
+
+        visited = visited | {node}
+        result = []
+        seen = set()
+
+        def _add(dep):
+            if dep not in seen:
+                seen.add(dep)
+                result.append(dep)
+
+        for dep in self.depends[node]:
+            _add(dep)
+            for trans_dep in self._path_dependencies(dep, visited, include_optional):
+                _add(trans_dep)
+
+        if include_optional:
+            for opt_dep in self.optional_depends[node]:
+                if self.is_layer(opt_dep) and opt_dep not in seen:
+                    _add(opt_dep)
+                    for trans_dep in self._path_dependencies(opt_dep, visited, include_optional):
+                        _add(trans_dep)
+        return tuple(result)
+
+    def path_dependencies(self, node: int, visited: FrozenSet[int], include_optional: bool = True) -> Tuple[int, ...]:
+        """all_dependencies as seen from a walk which has already visited the given layers"""
+        if not visited:
+            return self.all_dependencies(node, include_optional)
+        return self._path_dependencies(node, visited, include_optional)
+
+    def build_order(self, targets: List[int], scope: Optional['BuildScope'] = None
+                    ) -> Tuple[List[int], List[int], List[List[int]]]:
+        """
+        Order targets and everything they depend on so each layer follows its
+        dependencies, in a single iterative depth first walk. Required
+        dependencies are visited before loaded optional ones, in declaration
+        order, and each layer is placed when its walk completes. If given,
+        scope checks each layer as it's placed.
+
+        Returns the order together with every missing dependency and every
+        dependency cycle found along the way. Cycles are given as the path
+        around them, starting and ending at the same layer.
+        """
+        order: List[int] = []
+        done: Set[int] = set()
+        missing: List[int] = []
+        cycles: List[List[int]] = []
+
+        for target in targets:
+            if target in done:
+                continue
+            if not self.is_layer(target):
+                missing.append(target)
+                done.add(target)
+                continue
+
+            path = [target]
+            on_path = {target}
+            stack = [iter(self._edges(target, True))]
+            while stack:
+                for dep in stack[-1]:
+                    if dep in done:
+                        continue
+                    if dep in on_path:
+                        cycles.append(path[path.index(dep):] + [dep])
+                        continue
+                    if not self.is_layer(dep):
+                        missing.append(dep)
+                        done.add(dep)
+                        continue
+                    path.append(dep)
+                    on_path.add(dep)
+                    stack.append(iter(self._edges(dep, True)))
+                    break
+                else:
+                    stack.pop()
+                    node = path.pop()
+                    on_path.discard(node)
+                    done.add(node)
+                    if scope is not None:
+                        scope.place(node)
+                    order.append(node)
+
+        return order, missing, cycles
+
+    def waves(self, order: List[int], counted: Optional[Set[int]] = None) -> List[List[int]]:
+        """
+        Group a build order into waves, where every layer follows all of its
+        dependencies in the order, so no layer in a wave depends on another
+        in that wave. Layers keep their build order within a wave.
+
+        If counted is given, only those layers open a new wave and only they
+        are returned. Dependencies through other layers are still honoured.
+        """
+        level: Dict[int, int] = {}
+        waves: List[List[int]] = []
+        for node in order:
+            wave = max((level[dep] for dep in self._edges(node, True) if dep in level), default=0)
+            if counted is None or node in counted:
+                wave += 1
+                if wave > len(waves):
+                    waves.append([])
+                waves[wave - 1].append(node)
+            level[node] = wave
+        return waves
+
+    def critical_path(self, order: List[int], weights: Dict[int, float]) -> Tuple[List[int], float]:
+        """
+        Return the heaviest chain of dependencies through a build order, from
+        the first layer built to the last, and its total weight. Layers with
+        no weight count as zero. Of equally heavy chains, the one through
+        earlier declared dependencies is taken.
+        """
+        total: Dict[int, float] = {}
+        via: Dict[int, Optional[int]] = {}
+        for node in order:
+            heaviest = None
+            for dep in self._edges(node, True):
+                if dep in total and (heaviest is None or total[dep] > total[heaviest]):
+                    heaviest = dep
+            via[node] = heaviest
+            total[node] = weights.get(node, 0) + (total[heaviest] if heaviest is not None else 0)
+
+        if not total:
+            return [], 0
+        end = max(order, key=lambda node: total[node])
+        path = [end]
+        while via[path[-1]] is not None:
+            path.append(via[path[-1]])
+        return path[::-1], total[end]
+
+    def find_cycle(self, node: int) -> List[int]:
+        """
+        Return the path from node to the first required dependency cycle
+        reachable from it, ending where the cycle closes, or [] if none.
+        """
+        if not self.is_layer(node):
+            return []
+
+        done: Set[int] = set()
+        path = [node]
+        on_path = {node}
+        stack = [iter(self.depends[node])]
+        while stack:
+            for dep in stack[-1]:
+                if dep in on_path:
+                    return path + [dep]
+                if dep in done or not self.is_layer(dep):
+                    continue
+                path.append(dep)
+                on_path.add(dep)
+                stack.append(iter(self.depends[dep]))
+                break
+            else:
+                stack.pop()
+                finished = path.pop()
+                on_path.discard(finished)
+                # Nothing reachable from here closes a cycle
+                done.add(finished)
+        return []
+
+
+class BuildScope:
+    """
+    Checks the provider and conflict rules of a build order incrementally,
+    as each layer is placed in it, keeping the first violation:
+    - two layers providing the same provider
+    - a layer declaring a conflict with another layer in the order
+    - a layer requiring a provider no loaded layer provides
+    finish() raises it as a ValueError, or reports requirements which no
+    later layer provided. Violations are kept rather than raised so that
+    the walk placing the layers still finds every missing dependency.
+    """
+
+    def __init__(self, graph: LayerGraph):
+        self.graph = graph
+        self.providers: Dict[str, int] = {}  # provider -> placed layer providing it
+        self.placed: Set[str] = set()
+        self.conflicted: Dict[str, int] = {}  # layer name -> placed layer conflicting with it
+        self.required: Dict[str, int] = {}  # provider -> first placed layer requiring it, until provided
+        self.error: Optional[str] = None
+
+    def place(self, node: int):
+        if self.error is None:
+            self.error = self._place(node)
+
+    def _place(self, node: int) -> Optional[str]:
+        graph = self.graph
+        name = graph.names[node]
+
+        for provider in graph.provides[node]:
+            existing = self.providers.get(provider)
+            if existing is not None:
+                return f"Provider conflict: '{provider}' is provided by multiple layers: {graph.names[existing]}, {name}"
+            self.providers[provider] = node
+            self.required.pop(provider, None)
+
+        if name in self.conflicted:
+            return f"Layer conflict: '{graph.names[self.conflicted[name]]}' conflicts with '{name}'"
+        for other in graph.conflicts[node]:
+            if other in self.placed:
+                return f"Layer conflict: '{name}' conflicts with '{other}'"
+            self.conflicted.setdefault(other, node)
+
+        for provider in graph.provider_requires[node]:
+            if provider in self.providers:
+                continue
+            if provider not in graph.all_provides:
+                return f"Layer '{name}' requires provider '{provider}' but no layer in the dependency chain provides it"
+            self.required.setdefault(provider, node)
+
+        self.placed.add(name)
+        return None
+
+    def finish(self):
+        """Raise the first violation, or any required provider no layer in the order provided"""
+        if self.error is not None:
+            raise ValueError(self.error)
+        for provider, node in self.required.items():
+            raise ValueError(f"Layer '{self.graph.names[node]}' requires provider '{provider}' but no layer in the dependency chain provides it")
@@ -0,0 +1,147 @@
+import os
+import sys
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import yaml_loader
+from layer_cache import documents
+
+
+# Hook phase a hook plan takes out of mmdebstrap
+PHASE = 'customize'
+HOOKS_KEY = f'{PHASE}-hooks'
+
+# mmdebstrap hooks starting with these are special commands, not shell
+_SPECIAL_HOOKS = ('copy-in', 'copy-out', 'tar-in', 'tar-out', 'upload', 'download', 'sync-in', 'sync-out')
+
+
+def layer_hooks(filepath: str) -> Optional[list]:
+    """Return the customize hooks in a layer file's mmdebstrap section, or None if it has none"""
+    doc = documents.get(filepath)
+    if not isinstance(doc, dict) or not isinstance(doc.get('mmdebstrap'), dict):
+        return None
+    return doc['mmdebstrap'].get(HOOKS_KEY) or None
+
+
+def _can_run_outside_mmdebstrap(hooks: list) -> bool:
+    return all(isinstance(hook, str) and (hook.split() or [''])[0] not in _SPECIAL_HOOKS
+               for hook in hooks)
+
+
+def hook_waves(manager, build_order: List[str]) -> List[List[str]]:
+    """
+    Return waves of layers in build_order whose customize hooks can be taken
+    out of mmdebstrap and run concurrently with the others in their wave.
+
+    Taken out hooks run after every hook left in mmdebstrap, so a layer only
+    qualifies if it declares X-Env-Layer-ParallelSafe, its hooks are all
+    shell, and nothing which depends on it still has hooks run by mmdebstrap.
+    Each wave only depends on the waves before it.
+    """
+    graph = manager.graph
+    nodes = [graph.node(layer) for layer in build_order]
+    in_build = set(nodes)
+
+    # Walking back from the end of the order, pinned layers have hooks left
+    # in mmdebstrap or are depended on by a layer which has
+    pinned: Set[int] = set()
+    deferred: Set[int] = set()
+    for node in reversed(nodes):
+        name = graph.names[node]
+        hooks = layer_hooks(manager.layer_files[name])
+        needed_first = any(dep in pinned for dep in graph.dependents(node, True) if dep in in_build)
+        if hooks is None:
+            if needed_first:
+                pinned.add(node)
+        elif (manager.layer_info[name].get('parallel_safe') and not needed_first
+                and _can_run_outside_mmdebstrap(hooks)):
+            deferred.add(node)
+        else:
+            pinned.add(node)
+
+    return [[graph.names[node] for node in wave] for wave in graph.waves(nodes, deferred)]
+
+
+def write_hook_plan(manager, build_order: List[str], output: str) -> int:
+    """
+    Write the hook plan for build_order to output and return the number of
+    layers in it. Each line is wave:layer:path:config, where config is a
+    copy of the layer's YAML without its customize hooks, written to the
+    directory output.d, for mmdebstrap to load in place of the layer file.
+    """
+    config_dir = f"{output}.d"
+    os.makedirs(config_dir, exist_ok=True)
+
+    lines = []
+    for wave, layers in enumerate(hook_waves(manager, build_order), 1):
+        for layer in layers:
+            path = manager.layer_files[layer]
+            doc = dict(documents.get(path))
+            doc['mmdebstrap'] = {k: v for k, v in doc['mmdebstrap'].items() if k != HOOKS_KEY}
+            config = os.path.join(config_dir, f"{layer}.yaml")
+            with open(config, 'w', encoding='utf-8') as f:
+                yaml_loader.safe_dump(doc, f)
+            lines.append(f"{wave}:{layer}:{path}:{config}")
+
+    with open(output, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + "\n")
+    return len(lines)
+
+
+def read_hook_plan(plan_file: str) -> List[Tuple[int, str, str, str]]:
+    """Return (wave, layer, path, config) for each layer in a hook plan"""
+    entries = []
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            wave, layer, path, config = line.split(':', 3)
+            entries.append((int(wave), layer, path, config))
+    return entries
+
+
+def _run_layer_hooks(layer: str, path: str, args: List[str]) -> Tuple[str, List[Tuple[str, bytes]], int]:
+    """Run a layer's customize hooks in turn as mmdebstrap would, returning their output and exit status"""
+    outputs: List[Tuple[str, bytes]] = []
+    for hook in layer_hooks(path) or []:
+        if os.path.isfile(hook) and os.access(hook, os.X_OK):
+            cmd = [hook, *args]
+        else:
+            cmd = ['sh', '-c', hook, 'exec', *args]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        outputs.append((hook, proc.stdout))
+        if proc.returncode != 0:
+            return layer, outputs, proc.returncode
+    return layer, outputs, 0
+
+
+def run_hook_plan(plan_file: str, args: List[str], jobs: int = 1) -> bool:
+    """
+    Run the customize hooks of the layers in a hook plan, wave by wave, with
+    up to jobs layers of a wave running at once. Each layer's output is
+    captured and printed once it finishes, in plan order. No further waves
+    are started once a layer fails.
+    """
+    waves: Dict[int, List[Tuple[str, str]]] = OrderedDict()
+    for wave, layer, path, _ in read_hook_plan(plan_file):
+        waves.setdefault(wave, []).append((layer, path))
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for wave, layers in waves.items():
+            results = pool.map(lambda entry: _run_layer_hooks(*entry, args), layers)
+            failed = False
+            for layer, outputs, status in results:
+                print(f"runner: layer {layer} [wave {wave}]")
+                for _, output in outputs:
+                    sys.stdout.write(output.decode(errors='replace'))
+                sys.stdout.flush()
+                if status != 0:
+                    print(f"runner: layer {layer} hook error ({status}): {outputs[-1][0]}", file=sys.stderr)
+                    failed = True
+            if failed:
+                return False
+    return True
@@ -0,0 +1,308 @@
+import os
+import json
+import tempfile
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from debian import deb822
+
+from metadata_parser import Metadata
+from env_types import MetadataContainer, XEnv
+from layer_discovery import IGNORE_FILE, discover_files
+from layer_cache import LayerCache, env_references, env_snapshot
+from logger import log_warning
+
+
+# Version of the compiled layer index file format
+INDEX_VERSION = 4
+
+# Prefix of the temporary file the index is written to before it replaces the old one
+_TMP_PREFIX = '.layer-index-'
+
+
+def layer_info_from_fields(fields, filepath: str, doc_mode: bool = False,
+                           environ: Optional[Mapping[str, str]] = None) -> Optional[dict]:
+    """
+    Return layer info built from X-Env-Layer-* fields, or None if not a layer.
+    ${VAR} in dependency fields is expanded from environ (default os.environ).
+    """
+    if not isinstance(fields, deb822.Deb822):
+        fields = deb822.Deb822({k: v for k, v in fields.items() if XEnv.is_layer_field(k)})
+    container = MetadataContainer.from_metadata_dict(fields, filepath, doc_mode, environ)
+    return container.layer.to_dict() if container.layer else None
+
+
+def dependency_env_names(raw_metadata, environ: Optional[Mapping[str, str]] = None) -> Set[str]:
+    """Environment variables referenced by ${VAR} in a layer's dependency fields, as expanded from environ"""
+    fields = {k.lower(): v for k, v in raw_metadata.items()}
+    dep_fields = (XEnv.layer_requires(), XEnv.layer_provides(),
+                  XEnv.layer_requires_provider(), XEnv.layer_conflicts())
+    return env_references((fields.get(f.lower()) for f in dep_fields), environ)
+
+
+def lint_env_names(raw_metadata: dict, meta: Optional[Metadata],
+                   environ: Optional[Mapping[str, str]] = None) -> Set[str]:
+    """Environment variables that parse and lint results of a layer file depend on"""
+    # ${VAR} expansion in dependency fields
+    names = dependency_env_names(raw_metadata, environ)
+
+    # Lazy variables overridden in the environment are exempt from default validation
+    if meta is not None:
+        names.update(name for name, var in meta._container.variables.items()
+                     if var.set_policy == "lazy")
+    return names
+
+
+def _lint_layer(metadata_file: str, fields: dict, doc_mode: bool,
+                environ: Optional[Mapping[str, str]] = None) -> dict:
+    """
+    Lint a layer's fields in doc_mode against environ, returning the results
+    with a snapshot of the environment variables they depend on.
+    """
+    try:
+        meta = Metadata(metadata_file, doc_mode=doc_mode, raw_metadata=fields, environ=environ)
+        lint_results = sorted(meta.lint_metadata_syntax(environ))
+    except Exception as e:
+        # Not loadable in this mode, so never used
+        meta, lint_results = None, [str(e)]
+    return {'env': env_snapshot(lint_env_names(fields, meta, environ), environ), 'lint': lint_results}
+
+
+def indexed_lint(entry: dict, doc_mode: bool, environ: Optional[Mapping[str, str]] = None) -> dict:
+    """
+    Return the lint results of an indexed layer for doc_mode, with the
+    environment snapshot they were made against. The layer is linted again
+    if the index holds no results for this mode and environment.
+    """
+    linted = entry['lint'].get(LayerCache._derived_key(doc_mode))
+    if linted is None or env_snapshot(linted['env'], environ) != linted['env']:
+        linted = _lint_layer(entry['path'], entry['fields'], doc_mode, environ)
+    return linted
+
+
+class LazyLayers(Mapping):
+    """
+    Mapping of layer name to Metadata where each layer's Metadata object is
+    only built on first access.
+
+    Layers are added either with a Metadata object already built, or by
+    file and optionally previously parsed X-Env fields. Unless added as
+    already linted, a layer is also linted when first accessed. Membership,
+    iteration and len() do not trigger parsing. A layer which fails to parse
+    or lint raises ValueError when accessed.
+    """
+
+    def __init__(self, doc_mode: bool = False, environ: Optional[Mapping[str, str]] = None):
+        self.doc_mode = doc_mode
+        self.environ = environ  # Expands ${VAR} in dependencies, default os.environ
+        self._files: Dict[str, str] = {}  # layer_name -> file_path
+        self._fields: Dict[str, dict] = {}  # layer_name -> previously parsed X-Env fields
+        self._linted: Set[str] = set()  # Layers known to pass lint
+        self._loaded: Dict[str, Metadata] = {}
+
+    def add(self, layer_name: str, filepath: str, raw_metadata: Optional[dict] = None, *, linted: bool = False):
+        """Index a layer without parsing it"""
+        self._files[layer_name] = filepath
+        if raw_metadata is not None:
+            self._fields[layer_name] = raw_metadata
+        if linted:
+            self._linted.add(layer_name)
+
+    def set(self, layer_name: str, filepath: str, meta: Metadata):
+        """Add a layer whose Metadata object is already built and linted"""
+        self._files[layer_name] = filepath
+        self._loaded[layer_name] = meta
+
+    def is_loaded(self, layer_name: str) -> bool:
+        return layer_name in self._loaded
+
+    def loaded(self) -> Iterator[Tuple[str, Metadata]]:
+        """(layer name, Metadata) for each layer built so far"""
+        return iter(self._loaded.items())
+
+    def __getitem__(self, layer_name: str) -> Metadata:
+        meta = self._loaded.get(layer_name)
+        if meta is not None:
+            return meta
+
+        filepath = self._files[layer_name]
+        try:
+            meta = Metadata(filepath, doc_mode=self.doc_mode, raw_metadata=self._fields.get(layer_name),
+                            environ=self.environ)
+        except Exception as e:
+            raise ValueError(f"Layer '{layer_name}' failed to load from {filepath}: {e}")
+
+        if layer_name not in self._linted and meta.lint_metadata_syntax(self.environ):
+            raise ValueError(f"Layer '{layer_name}' has syntax errors: {filepath}")
+
+        self._loaded[layer_name] = meta
+        self._fields.pop(layer_name, None)
+        return meta
+
+    def __contains__(self, layer_name) -> bool:
+        return layer_name in self._files
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._files)
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+
+def _stat_key(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def build_layer_index(output: str, search_paths: List[str], file_patterns: List[str],
+                      ignore_patterns: Optional[List[str]] = None) -> int:
+    """
+    Compile all layers found in search_paths into a single index file and
+    return the number of layers indexed. The index holds each layer's
+    declared dependency fields, its raw X-Env fields and its lint results
+    in doc and build mode against the current environment, together with
+    the state of every directory and candidate file so staleness can be
+    detected. Layers which fail lint are indexed but not counted, and are
+    skipped when the index is loaded, as they are when layers are
+    discovered.
+    """
+    ignore_patterns = ignore_patterns or []
+    dirs: Dict[str, int] = {}
+    files: Dict[str, Optional[List[int]]] = {}
+    layers: List[dict] = []
+    layer_paths: Dict[str, str] = {}
+
+    for sp_index, search_path in enumerate(search_paths):
+        if not os.path.exists(search_path):
+            continue
+
+        visited: List[str] = []
+        found = discover_files(search_path, file_patterns, ignore_patterns, visited)
+
+        for dirpath in visited:
+            dirs[dirpath] = os.stat(dirpath).st_mtime_ns
+            ignore_file = os.path.join(dirpath, IGNORE_FILE)
+            if os.path.exists(ignore_file):
+                files[ignore_file] = _stat_key(ignore_file)
+
+        for metadata_file in found:
+            files[metadata_file] = _stat_key(metadata_file)
+            try:
+                fields = dict(Metadata._load_metadata(metadata_file))
+                meta = Metadata(metadata_file, doc_mode=True, raw_metadata=fields)
+                layer_info = meta.get_layer_info()
+            except Exception:
+                # Malformed metadata – not a layer
+                continue
+            if not layer_info:
+                continue
+
+            layer_name = layer_info['name']
+            lint = {LayerCache._derived_key(doc_mode): _lint_layer(metadata_file, fields, doc_mode)
+                    for doc_mode in (True, False)}
+            lint_results = lint[LayerCache._derived_key(True)]['lint']
+            if not lint_results and layer_name in layer_paths:
+                raise ValueError(
+                    f"Duplicate layer name '{layer_name}' found in:\n  {layer_paths[layer_name]}\n  {metadata_file}"
+                )
+            if not lint_results:
+                layer_paths[layer_name] = metadata_file
+
+            layers.append({
+                'name': layer_name,
+                'path': metadata_file,
+                'search_path': sp_index,
+                'depends': layer_info['depends'],
+                'optional_depends': layer_info['optional_depends'],
+                'provides': layer_info['provides'],
+                'provider_requires': layer_info['provider_requires'],
+                'conflicts': layer_info['conflicts'],
+                'variables': sorted(k for k in fields if XEnv.is_base_var_field(k)),
+                'fields': fields,
+                'lint': lint,
+            })
+
+    index = {
+        'version': INDEX_VERSION,
+        'search_paths': [str(p) for p in search_paths],
+        'patterns': list(file_patterns),
+        'ignore': list(ignore_patterns),
+        'dirs': dirs,
+        'files': files,
+        'layers': layers,
+    }
+
+    out_dir = os.path.dirname(os.path.abspath(output))
+    # Writing the index inside an indexed directory changes its mtime, so
+    # that directory is checked by its entries instead.
+    if out_dir in dirs:
+        dirs[out_dir] = _dir_entries(out_dir, output)
+
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=_TMP_PREFIX)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1)
+    os.chmod(tmp_path, 0o644)  # Shared with read-only consumers
+    os.replace(tmp_path, output)
+
+    return len(layer_paths)
+
+
+def _dir_entries(dirpath: str, index_path: str) -> List[str]:
+    """Entries of the directory holding the index, other than the index and its temporary files"""
+    index_name = os.path.basename(index_path)
+    return sorted(name for name in os.listdir(dirpath)
+                  if name != index_name and not name.startswith(_TMP_PREFIX))
+
+
+def _index_is_fresh(index: dict, path: str) -> bool:
+    """Check no indexed directory or file has changed"""
+    # New, removed or renamed files change their directory's mtime, or its
+    # entries for the directory holding the index
+    for dirpath, state in index.get('dirs', {}).items():
+        try:
+            if isinstance(state, list):
+                if _dir_entries(dirpath, path) != state:
+                    return False
+            elif os.stat(dirpath).st_mtime_ns != state:
+                return False
+        except OSError:
+            return False
+
+    return all(_stat_key(filepath) == key for filepath, key in index.get('files', {}).items())
+
+
+def load_layer_index(path: str, search_paths: List[str], file_patterns: List[str],
+                     ignore_patterns: Optional[List[str]] = None) -> Optional[List[dict]]:
+    """
+    Return the indexed layers from path if the index was built for the same
+    search configuration and no directory or candidate file has changed
+    since, else None.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log_warning(f"Ignoring unreadable layer index {path}: {e}")
+        return None
+
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION:
+        log_warning(f"Ignoring layer index {path}: unsupported version")
+        return None
+
+    if (index.get('search_paths') != [str(p) for p in search_paths]
+            or index.get('patterns') != list(file_patterns)
+            or index.get('ignore') != list(ignore_patterns or [])):
+        log_warning(f"Ignoring layer index {path}: built for different search paths or patterns")
+        return None
+
+    if not _index_is_fresh(index, path):
+        log_warning(f"Ignoring stale layer index {path}")
+        return None
+
+    return index.get('layers', [])
@@ -1,23 +1,41 @@
 import os
-import glob
+import io
+import sys
+import json
 import shutil
+import copy
+import contextlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Mapping, MutableMapping, Optional, Set, Tuple
 from collections import OrderedDict
-import yaml
 
 
 from metadata_parser import Metadata
 from metadata_parser import print_env_var_descriptions
 
-from env_types import VariableResolver, EnvVariable
+from env_types import VariableResolver, Resolution
+from layer_cache import LayerCache, documents
+from env_expand import references
+from env_file import write_env_file, runenv_value
+from layer_index import (LazyLayers, layer_info_from_fields, build_layer_index, load_layer_index,
+                         indexed_lint, dependency_env_names, lint_env_names)
+from layer_discovery import discover_files
+from layer_graph import LayerGraph, BuildScope
+from layer_batch import plan_batch
+from layer_hooks import write_hook_plan, read_hook_plan, run_hook_plan
+from layer_export import read_timings, build_graph, graph_to_dot, graph_to_json
+from layer_scenarios import what_if, scenario_files, format_what_if
 from logger import log_warning, log_success, log_failure, log_error
 
 
 # Handles discovery, dependency resolution, and orchestration
 class LayerManager:
-    def __init__(self, search_paths: Optional[List[str]] = None, file_patterns: Optional[List[str]] = None, *, show_loaded: bool = False, doc_mode: bool = False):
+    # In-memory cache used when no cache_path is given, kept warm by 'ig serve'
+    shared_cache: Optional[LayerCache] = None
+
+    def __init__(self, search_paths: Optional[List[str]] = None, file_patterns: Optional[List[str]] = None, *, show_loaded: bool = False, doc_mode: bool = False, cache_path: Optional[str] = None, jobs: int = 1, lazy: bool = False, ignore_patterns: Optional[List[str]] = None, index_path: Optional[str] = None, environ: Optional[MutableMapping[str, str]] = None):
         if search_paths is None:
             search_paths = ['./layer']
         if file_patterns is None:
@@ -25,16 +43,40 @@ class LayerManager:
 
         self.search_paths = [Path(p).resolve() for p in search_paths]
         self.file_patterns = file_patterns
-        self.layers: Dict[str, Metadata] = {}  # layer_name -> Metadata object
+        self.ignore_patterns = ignore_patterns or []  # Entries to prune from discovery
+        # Variables layers are loaded, validated and applied against
+        self.environ: MutableMapping[str, str] = environ if environ is not None else os.environ
+        # When lazy, Metadata objects are only kept for layers that are used.
+        # Every layer is still linted on load, so both modes load the same layers.
+        self.lazy = lazy
+        self.layers: LazyLayers = LazyLayers(doc_mode, environ)  # layer_name -> Metadata object, built on first use
         self.layer_files: Dict[str, str] = {}  # layer_name -> file_path
+        self.layer_info: Dict[str, dict] = {}  # layer_name -> layer info
         self.show_loaded = show_loaded
         self.doc_mode = doc_mode  # When True, load all layers regardless of environment variables
         # provider index will be built after layers are loaded
         self.provider_index: Dict[str, str] = {}
         self.provider_conflicts: Dict[str, Set[str]] = {}
+        # ...as will the compiled dependency graph
+        self.graph = LayerGraph({})
+        # Optional persistent cache of parsed layer files
+        self.cache: Optional[LayerCache] = LayerCache(cache_path) if cache_path else LayerManager.shared_cache
+        # Metadata built from cached results (None until first used), reused
+        # by reloads while still valid
+        self._cached_metadata: Dict[str, Tuple[dict, Optional[Metadata]]] = {}
+        # Optional compiled layer index, used in place of discovery when fresh
+        self.index_path = index_path
+        # Files found by discovery, reused by reloads
+        self._discovered: Optional[List[Tuple[Path, str]]] = None
+        # Variables the loaded layers' ${VAR} dependency expansion depends on
+        self._env_names: Set[str] = set()
+        # Number of worker processes used to parse layer files (0: one per CPU)
+        self.jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
 
         # Tracks write-out order
         self.write_log: OrderedDict[str, str] = OrderedDict()
+        # Failures reported by the last apply, validate, check or plan
+        self.errors: List[str] = []
 
         for path in self.search_paths:
             if not path.exists():
@@ -42,15 +84,50 @@ class LayerManager:
 
         self.load_layers()
 
-        # now that self.layers is populated, build provider index
+        # now that self.layers is populated, build provider index and graph
+        self._build_provider_index()
+        self.graph = LayerGraph(self.layer_info)
+
+    def reload_layers(self):
+        """Reload all layers, eg to pick up environment changes affecting their dependencies"""
+        previous_info = self.layer_info
+        # Keep the Metadata built since loading with the results it was built for
+        for layer_name, meta in self.layers.loaded():
+            cached = self._cached_metadata.get(self.layer_files[layer_name])
+            if cached is not None and cached[1] is None:
+                self._cached_metadata[self.layer_files[layer_name]] = (cached[0], meta)
+        self.layers = LazyLayers(self.doc_mode, self.environ)
+        self.layer_files = {}
+        self.layer_info = {}
+        self.provider_index = {}
+        self.provider_conflicts = {}
+        self._env_names = set()
+        self.load_layers()
         self._build_provider_index()
+        # Keep the compiled graph, and its memoized results, if nothing it holds changed
+        if self.layer_info != previous_info:
+            self.graph = LayerGraph(self.layer_info)
+
+    def for_environ(self, environ: MutableMapping[str, str]) -> 'LayerManager':
+        """
+        Return a manager for the same layer files which loads, validates and
+        applies variables against environ instead. The loaded layers are
+        shared unless a variable their dependencies are expanded from differs
+        in environ, in which case the copy reloads them without discovering
+        the files again. Neither manager is changed by using the other.
+        """
+        other = copy.copy(self)
+        other.environ = environ
+        other.write_log = OrderedDict()
+        other.errors = []
+        other._cached_metadata = dict(self._cached_metadata)
+        if _env_differs(self._env_names, self.environ, environ):
+            other.reload_layers()
+        return other
 
     def _build_provider_index(self):
         """Index providers to unique layer names"""
-        for lname, layer in self.layers.items():
-            info = layer.get_layer_info()
-            if not info:
-                continue
+        for lname, info in self.layer_info.items():
             for prov in info.get('provides', []):
                 existing = self.provider_index.get(prov)
                 if existing and existing != lname:
@@ -63,126 +140,237 @@ class LayerManager:
         """Discover and load all layer files, creating Metadata objects for each"""
         loaded_layers = set()
 
-        for search_path in self.search_paths:
-            if not search_path.exists():
-                continue
-
-            # Find all matching files
-            all_files = []
-            for pattern in self.file_patterns:
-                files = glob.glob(str(search_path / "**" / pattern), recursive=True)
-                all_files.extend(files)
+        if self.index_path and self._load_layer_index():
+            return
 
-            for metadata_file in all_files:
-                try:
-                    meta = Metadata(metadata_file, doc_mode=self.doc_mode)
-                except Exception:
-                    # Malformed YAML or metadata – skip
+        # Find all matching files, once
+        if self._discovered is None:
+            discovered: List[Tuple[Path, str]] = []  # (search_path, file_path)
+            for search_path in self.search_paths:
+                if not search_path.exists():
                     continue
 
-                try:
-                    layer_info = meta.get_layer_info()
-                except ValueError:
-                    # Malformed X-Env-Layer fields; treat as non-layer file
-                    continue
-                if not layer_info:
-                    continue
+                files = discover_files(search_path, self.file_patterns, self.ignore_patterns)
+                discovered.extend((search_path, f) for f in files)
+            self._discovered = discovered
+        discovered = self._discovered
+
+        # Parse (possibly in parallel), then register in discovery order
+        results = self._load_layer_files([f for _, f in discovered])
 
-                layer_name = layer_info['name']
+        for (search_path, metadata_file), (meta, layer_info, lint_results, raw_metadata) in zip(discovered, results):
+            if not layer_info:
+                continue
+
+            layer_name = layer_info['name']
 
-                # lint on load
-                lint_results = meta.lint_metadata_syntax()
-                if lint_results:  # Any syntax errors found
-                    if self.show_loaded:
-                        relative_path = Path(metadata_file).relative_to(search_path)
-                        log_warning(f"  Skipped layer: {layer_name} from {relative_path} (syntax errors)")
-                    continue  # Don't add
+            # lint on load
+            if lint_results:  # Any syntax errors found
+                if self.show_loaded:
+                    relative_path = Path(metadata_file).relative_to(search_path)
+                    log_warning(f"  Skipped layer: {layer_name} from {relative_path} (syntax errors)")
+                continue  # Don't add
+
+            # Duplicate detection
+            if layer_name in self.layers:
+                prev_path = self.layer_files[layer_name]
+                raise ValueError(
+                    f"Duplicate layer name '{layer_name}' found in:\n  {prev_path}\n  {metadata_file}"
+                )
 
-                # Duplicate detection
-                if layer_name in self.layers:
-                    prev_path = self.layer_files[layer_name]
-                    raise ValueError(
-                        f"Duplicate layer name '{layer_name}' found in:\n  {prev_path}\n  {metadata_file}"
-                    )
+            if meta is not None and not self.lazy:
+                self.layers.set(layer_name, metadata_file, meta)
+            else:
+                # Already linted; Metadata is built on first use
+                self.layers.add(layer_name, metadata_file, raw_metadata, linted=True)
+            self.layer_files[layer_name] = metadata_file
+            self.layer_info[layer_name] = layer_info
+            loaded_layers.add(layer_name)
+
+            if self.show_loaded:
+                relative_path = Path(metadata_file).relative_to(search_path)
+                print(f"  Loaded layer: {layer_name} from {relative_path} (x-env-layer)")
+
+        if self.cache:
+            self.cache.save()
+
+    def _load_layer_index(self) -> bool:
+        """Load layers from the compiled layer index, returning False if it can't be used"""
+        entries = load_layer_index(self.index_path, [str(p) for p in self.search_paths],
+                                   self.file_patterns, self.ignore_patterns)
+        if entries is None:
+            return False
 
-                self.layers[layer_name] = meta
-                self.layer_files[layer_name] = metadata_file
-                loaded_layers.add(layer_name)
+        # Indexed layers are always loaded lazily
+        self.lazy = True
+        self.layers = LazyLayers(self.doc_mode, self.environ)
 
+        for entry in entries:
+            layer_name = entry['name']
+            metadata_file = entry['path']
+            self._env_names |= dependency_env_names(entry['fields'], self.environ)
+            try:
+                layer_info = layer_info_from_fields(entry['fields'], metadata_file, self.doc_mode, self.environ)
+            except ValueError:
+                # Malformed X-Env-Layer fields (eg unresolved env vars); treat as non-layer file
+                continue
+            if not layer_info:
+                continue
+
+            search_path = self.search_paths[entry['search_path']]
+            linted = indexed_lint(entry, self.doc_mode, self.environ)
+            self._env_names |= set(linted['env'])
+            if linted['lint']:
                 if self.show_loaded:
                     relative_path = Path(metadata_file).relative_to(search_path)
-                    metadata_type = 'x-env-layer' if meta.has_layer_info() else 'standard'
-                    print(f"  Loaded layer: {layer_name} from {relative_path} ({metadata_type})")
+                    log_warning(f"  Skipped layer: {layer_name} from {relative_path} (syntax errors)")
+                continue
+
+            # Duplicate detection
+            if layer_name in self.layers:
+                prev_path = self.layer_files[layer_name]
+                raise ValueError(
+                    f"Duplicate layer name '{layer_name}' found in:\n  {prev_path}\n  {metadata_file}"
+                )
+
+            self.layers.add(layer_name, metadata_file, entry['fields'], linted=True)
+            self.layer_files[layer_name] = metadata_file
+            self.layer_info[layer_name] = layer_info
+
+            if self.show_loaded:
+                relative_path = Path(metadata_file).relative_to(search_path)
+                print(f"  Loaded layer: {layer_name} from {relative_path} (x-env-layer)")
+
+        return True
+
+    def _load_layer_files(self, files: List[str]) -> List[Tuple[Optional[Metadata], Optional[dict], dict, Optional[dict]]]:
+        """
+        Load layer files, returning (Metadata, layer info, lint results, raw
+        fields) for each in order. Metadata is None where the file was parsed
+        elsewhere (in a worker, or previously as recorded in the cache), to be
+        built from the raw fields if the layer is used.
+        """
+        results: List[Optional[Tuple[Optional[Metadata], Optional[dict], dict, Optional[dict]]]] = [None] * len(files)
+        jobs: List[Tuple[int, tuple]] = []  # (index, job)
+        entries: Dict[int, Optional[dict]] = {}
+        # Workers inherit os.environ, so only pass on any other environment
+        environ = None if self.environ is os.environ else dict(self.environ)
+
+        for i, metadata_file in enumerate(files):
+            raw_metadata = None
+            if self.cache is not None:
+                entry = self.cache.lookup(metadata_file)
+                if entry is not None:
+                    if entry.get('error') is not None:
+                        results[i] = (None, None, {}, None)
+                        continue
+                    derived = self.cache.get_derived(entry, self.doc_mode, self.environ)
+                    if derived is not None:
+                        self._env_names.update(derived['env'])
+                        results[i] = self._from_cached(metadata_file, entry, derived)
+                        continue
+                    raw_metadata = entry['raw']
+                entries[i] = entry
+            jobs.append((i, (metadata_file, self.doc_mode, raw_metadata, environ)))
+
+        if self.jobs > 1 and len(jobs) > 1:
+            workers = min(self.jobs, len(jobs))
+            chunksize = max(1, len(jobs) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parsed = list(pool.map(_parse_layer_job_detached, [job for _, job in jobs], chunksize=chunksize))
+        else:
+            parsed = [_parse_layer_job(job) for _, job in jobs]
+
+        for (i, (metadata_file, *_)), result in zip(jobs, parsed):
+            self._env_names.update(result['env'])
+            entry = None
+            if self.cache is not None:
+                entry = self._cache_result(metadata_file, entries[i], result)
+
+            # Metadata objects don't pickle, so from a worker meta is None
+            meta = result['meta']
+            if entry is not None and result['layer'] and not result['lint']:
+                self._cached_metadata[metadata_file] = (self.cache.get_derived(entry, self.doc_mode, self.environ), meta)
+            results[i] = (meta, result['layer'], result['lint'], result['raw'])
+
+        return results
+
+    def _from_cached(self, metadata_file: str, entry: dict, derived: dict) -> Tuple[Optional[Metadata], Optional[dict], dict, Optional[dict]]:
+        """Return the load result for a layer file from its cache entry"""
+        layer_info, lint_results = derived['layer'], derived['lint']
+        if not layer_info or lint_results:
+            # Not a usable layer
+            return None, layer_info, lint_results, None
+
+        # The derived results only match if the environment the layer depends
+        # on is unchanged, so neither has any Metadata built alongside them
+        previous = self._cached_metadata.get(metadata_file)
+        if previous is None or previous[0] is not derived:
+            previous = self._cached_metadata[metadata_file] = (derived, None)
+        return previous[1], layer_info, lint_results, entry['raw']
+
+    def _cache_result(self, metadata_file: str, entry: Optional[dict], result: dict) -> Optional[dict]:
+        """Record a freshly parsed layer file in the cache, returning its entry"""
+        if entry is None:
+            if result['raw'] is None and result['error'] is None:
+                # Unreadable - don't cache
+                return None
+            try:
+                entry = self.cache.store(metadata_file, result['raw'], result['error'])
+            except OSError:
+                return None
+
+        if result['error'] is None:
+            self.cache.set_derived(entry, self.doc_mode, result['env'], result['layer'], result['lint'], self.environ)
+        return entry
 
     def get_layer_info(self, layer_name: str) -> Optional[dict]:
-        if layer_name not in self.layers:
-            return None
-        return self.layers[layer_name].get_layer_info()
+        """Return a copy of a layer's info, or None if not loaded"""
+        info = self.layer_info.get(layer_name)
+        return copy.deepcopy(info) if info is not None else None
 
 
 
     def get_dependencies(self, layer_name: str) -> List[str]:
         """Get hard deps"""
-        layer_info = self.get_layer_info(layer_name)
-        if not layer_info:
+        node = self.graph.node(layer_name)
+        if node is None:
             return []
-        return list(layer_info['depends'])
-
-    def get_reverse_dependencies(self, target_layer: str) -> List[str]:
-        """Get hard reverse deps"""
-        reverse_deps = []
+        return [self.graph.names[dep] for dep in self.graph.depends[node]]
 
+    def get_reverse_dependencies(self, target_layer: str, *, transitive: bool = False,
+                                 include_optional: bool = False) -> List[str]:
+        """Get reverse deps, hard only unless include_optional, direct only unless transitive"""
         # Resolve the target layer name first
         resolved_target = self.resolve_layer_name(target_layer)
         if not resolved_target:
             return []
 
-        # Search through all loaded layers
-        for layer_name, layer_obj in self.layers.items():
-            layer_info = layer_obj.get_layer_info()
-            if layer_info and layer_info.get('depends'):
-                # Check if target layer is in this layer's dependencies
-                if resolved_target in layer_info['depends']:
-                    reverse_deps.append(layer_name)
-
-        return sorted(reverse_deps)
+        node = self.graph.node(resolved_target)
+        if transitive:
+            dependents = self.graph.all_dependents(node, include_optional)
+        else:
+            dependents = self.graph.dependents(node, include_optional)
+        return sorted(self.graph.names[n] for n in dependents)
 
     def get_optional_dependencies(self, layer_name: str) -> List[str]:
         """Get optional deps"""
-        layer_info = self.get_layer_info(layer_name)
-        return layer_info['optional_depends'] if layer_info else []
+        node = self.graph.node(layer_name)
+        if node is None:
+            return []
+        return [self.graph.names[dep] for dep in self.graph.optional_depends[node]]
 
     def get_all_dependencies(self, layer_name: str, visited: Optional[Set[str]] = None, include_optional: bool = True) -> List[str]:
         """Get all deps (including transitive) for a layer"""
-        if visited is None:
-            visited = set()
-
-        if layer_name in visited or layer_name not in self.layers:
+        graph = self.graph
+        node = graph.node(layer_name)
+        if node is None:
             return []
 
-        visited.add(layer_name)
-        all_deps = []
-
-        # Add required dependencies
-        for dep in self.get_dependencies(layer_name):
-            if dep not in all_deps:
-                all_deps.append(dep)
-            # Add transitive dependencies
-            for trans_dep in self.get_all_dependencies(dep, visited.copy(), include_optional):
-                if trans_dep not in all_deps:
-                    all_deps.append(trans_dep)
-
-        # Add optional dependencies if requested and they exist
-        if include_optional:
-            for opt_dep in self.get_optional_dependencies(layer_name):
-                if opt_dep in self.layers and opt_dep not in all_deps:
-                    all_deps.append(opt_dep)
-                    # Add transitive dependencies of optional dependencies
-                    for trans_dep in self.get_all_dependencies(opt_dep, visited.copy(), include_optional):
-                        if trans_dep not in all_deps:
-                            all_deps.append(trans_dep)
-
-        return all_deps
+        # Closures are computed once per layer and shared across queries
+        visited_nodes = frozenset(graph.ids[name] for name in visited or () if name in graph.ids)
+        deps = graph.path_dependencies(node, visited_nodes, include_optional)
+        return [graph.names[dep] for dep in deps]
 
     def check_dependencies(self, layer_name: str) -> Tuple[bool, List[str]]:
         """Check if all dependencies for a layer are available"""
@@ -209,13 +397,14 @@ class LayerManager:
         if circular:
             missing_deps.append(f"Circular dependency detected: {' -> '.join(circular)}")
 
-        # Check provider requirements
-        try:
-            # Get all layers that would be included in the dependency chain
-            build_order = self.get_build_order([layer_name])
-            # Provider validation happens inside get_build_order now
-        except ValueError as e:
-            missing_deps.append(str(e))
+        # Check provider requirements and conflicts. Resolving the build order
+        # would only report the missing and circular dependencies found above
+        # again, so it's left until every dependency is available.
+        if not missing_deps:
+            try:
+                self.get_build_order([layer_name])
+            except ValueError as e:
+                missing_deps.append(str(e))
 
         if warnings:
             for warning in warnings:
@@ -223,117 +412,119 @@ class LayerManager:
 
         return len(missing_deps) == 0, missing_deps + warnings
 
-    def _check_circular_dependencies(self, layer_name: str, path: Optional[List[str]] = None) -> List[str]:
-        """Check for circular dependencies"""
-        if path is None:
-            path = []
+    def check_all_layers(self) -> bool:
+        """
+        Check the dependencies of every loaded layer in a single pass over the
+        graph, reporting all missing dependencies, unprovided providers and
+        dependency cycles rather than stopping at the first.
+        """
+        graph = self.graph
+        errors = []
+        warnings = []
 
-        if layer_name in path:
-            return path + [layer_name]  # Found cycle
+        for node in range(graph.num_layers):
+            layer_name = graph.names[node]
+            for dep in graph.depends[node]:
+                if not graph.is_layer(dep):
+                    errors.append(f"Layer '{layer_name}': Missing required dependency: {graph.names[dep]}")
+            for opt_dep in graph.optional_depends[node]:
+                if not graph.is_layer(opt_dep):
+                    warnings.append(f"Layer '{layer_name}': Optional dependency not available: {graph.names[opt_dep]}")
+            for required_provider in graph.provider_requires[node]:
+                if required_provider not in self.provider_index:
+                    errors.append(f"Layer '{layer_name}' requires provider '{required_provider}' but no layer provides it")
+
+        # Every strongly connected component is a group of layers which
+        # (optionally) depend on each other
+        for component in graph.cyclic_components(include_optional=True):
+            cycle = graph.component_cycle(component, include_optional=True)
+            message = f"Circular dependency detected: {' -> '.join(graph.names[n] for n in cycle)}"
+            if len(component) > len(cycle) - 1:
+                message += f" (cycle group: {', '.join(graph.names[n] for n in component)})"
+            errors.append(message)
+
+        for warning in warnings:
+            print(f"[WARN] {warning}")
+        for error in errors:
+            log_failure(error)
+
+        if errors:
+            print(f"{len(errors)} problem(s) found in {graph.num_layers} layers")
+            return False
+        log_success(f"All {graph.num_layers} layers have their dependencies satisfied")
+        return True
 
-        if layer_name not in self.layers:
+    def _check_circular_dependencies(self, layer_name: str) -> List[str]:
+        """Check for circular dependencies"""
+        node = self.graph.node(layer_name)
+        if node is None:
             return []
-
-        path = path + [layer_name]
-
-        for dep in self.get_dependencies(layer_name):
-            cycle = self._check_circular_dependencies(dep, path)
-            if cycle:
-                return cycle
-
-        return []
+        return [self.graph.names[n] for n in self.graph.find_cycle(node)]
 
     def get_build_order(self, target_layers: List[str]) -> List[str]:
         """Get the correct build order for target layers"""
-        build_order = []
-        processed = set()
+        graph = self.graph
 
-        def check_missing_dependencies(layer_name: str, checked: set = None):
-            """Recursively check for missing dependencies and raise ValueError if any are found"""
-            if checked is None:
-                checked = set()
-
-            if layer_name in checked:  # Avoid infinite recursion
-                return
-            checked.add(layer_name)
-
-            if layer_name not in self.layers:
-                raise ValueError(f"Missing required dependency: {layer_name}")
-
-            # Recurse
-            for dep in self.get_dependencies(layer_name):
-                check_missing_dependencies(dep, checked)
-
-        def add_layer_and_deps(layer_name: str):
-            if layer_name in processed:
-                return
-
-            # Add required dependencies first
-            for dep in self.get_dependencies(layer_name):
-                add_layer_and_deps(dep)
-
-            # Add optional dependencies if they exist and are available
-            for opt_dep in self.get_optional_dependencies(layer_name):
-                if opt_dep in self.layers:
-                    add_layer_and_deps(opt_dep)
-
-            if layer_name not in processed:
-                build_order.append(layer_name)
-                processed.add(layer_name)
-
-        # First, validate that all required dependencies exist
-        for layer in target_layers:
-            check_missing_dependencies(layer)
-
-        # Then build the order
+        targets = []
         for layer in target_layers:
-            add_layer_and_deps(layer)
-
-        # Validate that all required providers are satisfied by the build order
-        self._validate_provider_requirements(build_order)
-
-        return build_order
-
-    def _validate_provider_requirements(self, build_order: List[str]) -> None:
-        """Validate that all required providers are satisfied by layers in the build order"""
-        # Check for provider conflicts within the build order scope
-        self._check_provider_conflicts_in_scope(build_order)
-
-        # Collect all providers available in the build order
-        available_providers = set()
-        for layer_name in build_order:
-            layer_info = self.get_layer_info(layer_name)
-            if layer_info:
-                available_providers.update(layer_info.get('provides', []))
+            node = graph.node(layer)
+            if node is None:
+                raise ValueError(f"Missing required dependency: {layer}")
+            targets.append(node)
+
+        # Results are memoized on the graph, and in the layer cache for other
+        # processes and reloads which compile the same graph
+        key = tuple(graph.names[node] for node in targets)
+        result = graph.orders.get(key)
+        if result is None and self.cache is not None:
+            result = self.cache.get_order(graph.fingerprint, key)
+        if result is None:
+            result = self._resolve_order(targets)
+            if self.cache is not None:
+                # Saved along with the rest of the cache by the caller
+                self.cache.set_order(graph.fingerprint, key, *result)
+        graph.orders[key] = result
+
+        build_order, error = result
+        if error is not None:
+            raise ValueError(error)
+
+        # Fully parse lazily indexed layers now they're known to be needed
+        for layer in build_order:
+            self.layers[layer]
+
+        return list(build_order)
+
+    def get_build_waves(self, target_layers: List[str]) -> List[List[str]]:
+        """Get the build order for target layers grouped into waves of mutually independent layers"""
+        build_order = self.get_build_order(target_layers)
+        graph = self.graph
+        waves = graph.waves([graph.node(layer) for layer in build_order])
+        return [[graph.names[node] for node in wave] for wave in waves]
+
+    def _resolve_order(self, targets: List[int]) -> Tuple[Optional[List[str]], Optional[str]]:
+        """Walk the graph from targets, returning (build order, None) or (None, error)"""
+        graph = self.graph
+
+        # One walk orders the layers, finds any missing or circular deps and
+        # checks providers and conflicts as each layer is placed
+        scope = BuildScope(graph)
+        try:
+            build_order, missing, cycles = graph.build_order(targets, scope)
+            errors = [f"Missing required dependency: {graph.names[node]}" for node in missing]
+            errors += [f"Circular dependency detected: {' -> '.join(graph.names[n] for n in cycle)}"
+                       for cycle in cycles]
+            if errors:
+                return None, '; '.join(errors)
+            scope.finish()
+        except ValueError as e:
+            return None, str(e)
 
-        # Check each layer's provider requirements
-        for layer_name in build_order:
-            layer_info = self.get_layer_info(layer_name)
-            if layer_info:
-                for required_provider in layer_info.get('provider_requires', []):
-                    if required_provider not in available_providers:
-                        raise ValueError(f"Layer '{layer_name}' requires provider '{required_provider}' but no layer in the dependency chain provides it")
-
-    def _check_provider_conflicts_in_scope(self, layer_names: List[str]) -> None:
-        """Validate that no provider conflicts exist within the given scope of layers."""
-        # Build provider mapping only for the layers in scope
-        scope_providers = {}
-        for layer_name in layer_names:
-            layer_info = self.get_layer_info(layer_name)
-            if layer_info:
-                for provider in layer_info.get('provides', []):
-                    if provider in scope_providers:
-                        # Found a conflict within scope
-                        existing_layer = scope_providers[provider]
-                        raise ValueError(f"Provider conflict: '{provider}' is provided by multiple layers: {existing_layer}, {layer_name}")
-                    scope_providers[provider] = layer_name
+        return [graph.names[node] for node in build_order], None
 
     def _load_layer_yaml(self, filepath: str) -> Optional[dict]:
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return yaml.safe_load(f)
-        except (FileNotFoundError, yaml.YAMLError, UnicodeDecodeError):
-            return None
+        doc = documents.get(filepath)
+        return doc if isinstance(doc, dict) else None
 
     def _get_mmdebstrap_config(self, layer_name: str) -> Optional[dict]:
         """Get mmdebstrap configuration if present """
@@ -367,77 +558,31 @@ class LayerManager:
 
         return None
 
-    def _collect_all_variable_definitions(self, build_order: List[str]) -> Dict[str, List[EnvVariable]]:
-        """Collect all variable definitions from all layers in dependency order."""
-        variable_definitions = {}
-
-        for position, layer_name in enumerate(build_order):
-            layer = self.layers[layer_name]
-
-            # Get all variables from this layer's metadata container
-            for var_name, env_var in layer._container.variables.items():
-                # Create a new EnvVariable with position and source layer info
-                var_with_position = EnvVariable(
-                    name=env_var.name,
-                    value=env_var.value,
-                    description=env_var.description,
-                    required=env_var.required,
-                    validator=env_var.validator,
-                    set_policy=env_var.set_policy,
-                    source_layer=layer_name,
-                    position=position
-                )
-
-                if var_name not in variable_definitions:
-                    variable_definitions[var_name] = []
-                variable_definitions[var_name].append(var_with_position)
-
-        return variable_definitions
-
-    def _apply_resolved_variables(self, resolved_variables: Dict[str, EnvVariable]):
-        """Apply resolved variables to environment and record for file writing."""
-        import os
-
-        # The resolver provides variables in the correct dependency order.
-        all_vars = list(resolved_variables.values())
-
-        for env_var in all_vars:
-            var_name = env_var.name
-            value = env_var.value
-            policy = env_var.set_policy
-            layer_name = env_var.source_layer
-
-            if policy == "force":
-                os.environ[var_name] = value
-                self._log_env_action("FORCE", var_name, value, layer_name)
-                self.write_log[var_name] = value
-
-            elif policy == "immediate":
-                if var_name not in os.environ:
-                    os.environ[var_name] = value
-                    self._log_env_action("SET", var_name, value, layer_name)
-                    self.write_log[var_name] = value
-                else:
-                    print(f"  [SKIP]  {var_name} (already set)")
-
-            elif policy == "lazy":
-                if var_name not in os.environ:
-                    os.environ[var_name] = value
-                    self._log_env_action("LAZY", var_name, value, layer_name)
-                    self.write_log[var_name] = value
-                else:
-                    print(f"  [SKIP]  {var_name} (already set)")
-
-            elif policy == "already_set":
-                # Variable was already in environment before we started
-                print(f"  [SKIP]  {var_name} (already set)")
+    def resolve_env(self, build_order: List[str], environ: Mapping[str, str]) -> Resolution:
+        """
+        Resolve the variables of the layers in build order against environ
+        and return the result, without changing os.environ or this manager.
+        """
+        resolver = VariableResolver()
+        return resolver.resolve_env(((layer_name, self.layers[layer_name]._container.variables)
+                                     for layer_name in build_order), environ)
+
+    def _apply_resolution(self, resolution: Resolution):
+        """Log a resolution and apply it to the environment, recording it for file writing."""
+        for decision in resolution.log:
+            if decision.tag == "SKIP":
+                print(f"  [SKIP]  {decision.name} ({decision.reason})")
+            else:
+                self._log_env_action(decision.tag, decision.name, decision.value, decision.source_layer)
 
-            elif policy == "skip":
-                if var_name in os.environ:
-                    print(f"  [SKIP]  {var_name} (already set)")
-                else:
-                    print(f"  [SKIP]  {var_name} (Set: false/skip)")
+        self.environ.update(resolution.changes)
+        self.write_log.update(resolution.changes)
 
+    def _fail(self, message: str, silent: bool = False, log=print):
+        """Report a failure, and record it in self.errors"""
+        self.errors.append(message)
+        if not silent:
+            log(message)
 
     def _log_env_action(self, tag: str, var: str, value: str, layer_name: str):
         """Log environment variable action."""
@@ -453,24 +598,21 @@ class LayerManager:
         # Pre-flight validation: ensure all layers exist and schemas are valid
         for layer_name in build_order:
             if layer_name not in self.layers:
-                print(f"Layer '{layer_name}' not found")
+                self._fail(f"Layer '{layer_name}' not found")
                 return False
 
             if not self.validate_single_layer_env_vars(layer_name, silent=False, ignore_missing_required=True):
-                print(f"Validation failed for layer '{layer_name}' – aborting apply-env")
+                self._fail(f"Validation failed for layer '{layer_name}' – aborting apply-env")
                 return False
 
         self.write_log = OrderedDict()
 
-        # Phase 1: Collect all variable definitions from all layers in build order
-        variable_definitions = self._collect_all_variable_definitions(build_order)
-
-        # Phase 2: Resolve final values using policy rules
-        resolver = VariableResolver()
-        resolved_variables = resolver.resolve(variable_definitions)
+        # Phase 1 and 2: Fold the variable definitions of all layers in build
+        # order into their final values against the current environment
+        resolution = self.resolve_env(build_order, self.environ)
 
         # Phase 3: Apply resolved variables to environment and file
-        self._apply_resolved_variables(resolved_variables)
+        self._apply_resolution(resolution)
 
         print("Environment variables applied successfully")
         return True
@@ -478,34 +620,29 @@ class LayerManager:
     def validate_single_layer_env_vars(self, layer_name: str, silent: bool = False, *, ignore_missing_required: bool = False) -> bool:
         """Validate environment variables for a single layer (no dependency resolution)"""
         if layer_name not in self.layers:
-            if not silent:
-                print(f"Layer '{layer_name}' not found")
+            self._fail(f"Layer '{layer_name}' not found", silent)
             return False
 
         layer = self.layers[layer_name]
-        results = layer.validate_env_vars()
+        results = layer.validate_env_vars(self.environ)
 
         layer_valid = True
         for var, result in results.items():
             if result["status"] == "missing_required":
                 if ignore_missing_required:
                     continue
-                if not silent:
-                    print(f"[FAIL] {var} - REQUIRED but not set (layer: {layer_name})")
+                self._fail(f"[FAIL] {var} - REQUIRED but not set (layer: {layer_name})", silent)
                 layer_valid = False
             elif result["status"] == "missing_required_var":
                 if ignore_missing_required:
                     continue
-                if not silent:
-                    print(f"[FAIL] {result['required_var']} - REQUIRED but not set (layer: {layer_name})")
+                self._fail(f"[FAIL] {result['required_var']} - REQUIRED but not set (layer: {layer_name})", silent)
                 layer_valid = False
             elif result["status"] == "validated" and not result["valid"]:
-                if not silent:
-                    print(f"[FAIL] {var}={result['value']} (invalid, layer: {layer_name})")
+                self._fail(f"[FAIL] {var}={result['value']} (invalid, layer: {layer_name})", silent)
                 layer_valid = False
             elif result["status"] == "required_validated" and not result["valid"]:
-                if not silent:
-                    print(f"[FAIL] {result['required_var']}={result['value']} (invalid, layer: {layer_name})")
+                self._fail(f"[FAIL] {result['required_var']}={result['value']} (invalid, layer: {layer_name})", silent)
                 layer_valid = False
             # Handle other statuses for info output
             elif not silent:
@@ -521,8 +658,7 @@ class LayerManager:
         unsupported_layer = layer._check_unsupported_layer_fields()
         if unsupported_layer:
             for fld, msg in unsupported_layer.items():
-                if not silent:
-                    print(f"[ERROR] {msg} (layer: {layer_name})")
+                self._fail(f"[ERROR] {msg} (layer: {layer_name})", silent)
             layer_valid = False
 
         return layer_valid
@@ -594,8 +730,15 @@ class LayerManager:
 
         return None
 
-    def process_layers(self, layer_ids: List[str], operation: str, **kwargs) -> bool:
-        """Top level API for processing multiple layers with coordinated dependency resolution"""
+    def dependency_env_names(self, layer_names: List[str]) -> Set[str]:
+        """Environment variables referenced by ${VAR} in the dependency fields of layers"""
+        names: Set[str] = set()
+        for layer_name in layer_names:
+            names |= dependency_env_names(self.layers[layer_name].get_metadata(), self.environ)
+        return names
+
+    def _resolve_build_order(self, layer_ids: List[str], operation: str) -> Optional[Tuple[List[str], List[str]]]:
+        """Resolve target layers and their combined build order, or None on failure"""
         # Resolve all target layers first
         resolved_layers = []
         for layer_id in layer_ids:
@@ -603,21 +746,47 @@ class LayerManager:
             if layer_name:
                 resolved_layers.append(layer_name)
             else:
-                if operation == "check":
-                    print(f"✗ Layer '{layer_id}' not found")
-                else:
-                    log_failure(f"Layer '{layer_id}' not found")
-                return False
+                self._fail(f"Layer '{layer_id}' not found", log=log_failure)
+                return None
 
         # Get build order for ALL target layers together (validates providers and dependencies)
         try:
             build_order = self.get_build_order(resolved_layers)
         except ValueError as e:
-            if operation == "check":
-                log_failure(f"Dependency resolution failed: {e}")
+            self._fail(f"Dependency resolution failed: {e}", log=log_failure)
+            return None
+
+        return resolved_layers, build_order
+
+    def _validate_layers(self, layer_names: List[str]) -> bool:
+        """Validate each layer individually, reporting the outcome for each"""
+        all_valid = True
+        for layer_name in layer_names:
+            if self.validate_single_layer_env_vars(layer_name):
+                log_success(f"Layer '{layer_name}' validation passed")
             else:
-                log_failure(f"Dependency resolution failed: {e}")
+                self._fail(f"Layer '{layer_name}' validation failed", log=log_failure)
+                all_valid = False
+        return all_valid
+
+    def _write_env(self, write_out: Optional[str]) -> bool:
+        """Write variables set by apply to file if requested"""
+        if write_out and self.write_log:
+            try:
+                write_env_file(self.write_log, write_out)
+                print(f"Environment variables written to: {write_out}")
+            except Exception as e:
+                self._fail(f"Error writing to file {write_out}: {e}")
+                return False
+        return True
+
+    def process_layers(self, layer_ids: List[str], operation: str, **kwargs) -> bool:
+        """Top level API for processing multiple layers with coordinated dependency resolution"""
+        self.errors = []
+        resolved = self._resolve_build_order(layer_ids, operation)
+        if resolved is None:
             return False
+        resolved_layers, build_order = resolved
 
         # Delegate to appropriate operation
         if operation == "apply":
@@ -626,33 +795,15 @@ class LayerManager:
             # Final validation for all target layers
             failed_layers = [layer for layer in resolved_layers if not self.validate_single_layer_env_vars(layer)]
             if failed_layers:
-                print(f"Validation failed for layers: {', '.join(failed_layers)}; skipping write-out")
+                self._fail(f"Validation failed for layers: {', '.join(failed_layers)}; skipping write-out")
                 return False
 
             # Write variables to file if requested
-            write_out = kwargs.get('write_out')
-            if write_out and self.write_log:
-                try:
-                    with open(write_out, 'w') as f:
-                        for var_name, value in self.write_log.items():
-                            f.write(f'{var_name}="{value}"\n')
-                    print(f"Environment variables written to: {write_out}")
-                except Exception as e:
-                    print(f"Error writing to file {write_out}: {e}")
-                    return False
-
-            return True
+            return self._write_env(kwargs.get('write_out'))
 
         elif operation == "validate":
             # Validate each target layer individually
-            all_valid = True
-            for layer_name in resolved_layers:
-                if self.validate_single_layer_env_vars(layer_name):
-                    log_success(f"Layer '{layer_name}' validation passed")
-                else:
-                    log_failure(f"Layer '{layer_name}' validation failed")
-                    all_valid = False
-            return all_valid
+            return self._validate_layers(resolved_layers)
 
         elif operation == "check":
             # If we get here, all dependencies and providers are satisfied
@@ -663,6 +814,45 @@ class LayerManager:
         else:
             raise ValueError(f"Unknown operation: {operation}")
 
+    def plan_layers(self, layer_ids: List[str], write_out: Optional[str] = None) -> Optional[List[str]]:
+        """
+        Apply environment variables, validate and compute the build order for
+        layers in one pass, equivalent to running apply, validate and build
+        order in turn with the applied variables passed on to each. Returns
+        the build order, or None on failure with the reasons in self.errors.
+        """
+        self.errors = []
+        resolved = self._resolve_build_order(layer_ids, "plan")
+        if resolved is None:
+            return None
+        resolved_layers, build_order = resolved
+
+        if not self.apply_env_vars_for_build_order(build_order):
+            return None
+
+        # Pass the written variables on as runenv would to a later stage
+        for var_name, value in self.write_log.items():
+            self.environ[var_name] = runenv_value(value)
+
+        # Dependencies expanded from a variable which was just applied may
+        # now resolve differently. Only layers in the order can affect it.
+        applied = set(self.write_log)
+        if applied & self.dependency_env_names(build_order):
+            self.reload_layers()
+            resolved = self._resolve_build_order(layer_ids, "plan")
+            if resolved is None:
+                return None
+            resolved_layers, build_order = resolved
+
+        if not self._validate_layers(resolved_layers):
+            self._fail("Validation failed; skipping write-out")
+            return None
+
+        if not self._write_env(write_out):
+            return None
+
+        return build_order
+
     def get_layer_documentation_data(self, layer_name: str):
         """Extract structured layer data for documentation generation"""
         if layer_name not in self.layers:
@@ -845,6 +1035,112 @@ class LayerManager:
 
 
 
+def mmdebstrap_layers(order_file: str, hook_plan: Optional[str] = None) -> List[Tuple[str, str]]:
+    """
+    Return (layer, path) for each layer in a --full-paths build order file
+    whose YAML document has an mmdebstrap section. Layers in hook_plan are
+    given the path of their config without the hooks the plan runs.
+    """
+    configs = {layer: config for _, layer, _, config in read_hook_plan(hook_plan)} if hook_plan else {}
+    layers = []
+    with open(order_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if '=' not in line or line.startswith('#'):
+                continue
+
+            layer, filepath = line.split('=', 1)
+            filepath = filepath.strip('"')
+
+            doc = documents.get(filepath)
+            if isinstance(doc, dict) and doc.get('mmdebstrap'):
+                layers.append((layer, configs.get(layer, filepath)))
+    return layers
+
+
+def warm_layer_cache(search_paths: List[str], file_patterns: Optional[List[str]] = None):
+    """
+    Load the layers under search_paths into LayerManager.shared_cache for
+    both doc and build mode. Unchanged files reuse their existing entries, so
+    this is cheap to repeat to pick up edits.
+    """
+    if LayerManager.shared_cache is None:
+        LayerManager.shared_cache = LayerCache()
+
+    for doc_mode in (False, True):
+        # Problems are reported to whoever loads the layers for real
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            try:
+                LayerManager(search_paths, file_patterns, doc_mode=doc_mode)
+            except ValueError:
+                pass
+
+
+def _parse_layer_file(metadata_file: str, doc_mode: bool, raw_metadata: Optional[dict] = None,
+                      environ: Optional[Mapping[str, str]] = None) -> Tuple[Optional[Metadata], Optional[dict], dict]:
+    """Parse and lint a layer file against environ, returning (Metadata, layer info, lint results)"""
+    try:
+        meta = Metadata(metadata_file, doc_mode=doc_mode, raw_metadata=raw_metadata, environ=environ)
+    except Exception:
+        # Malformed YAML or metadata – skip
+        return None, None, {}
+
+    try:
+        layer_info = meta.get_layer_info()
+    except ValueError:
+        # Malformed X-Env-Layer fields; treat as non-layer file
+        return None, None, {}
+    if not layer_info:
+        return None, None, {}
+
+    return meta, layer_info, meta.lint_metadata_syntax(environ)
+
+
+def _env_differs(names, environ: Mapping[str, str], other: Mapping[str, str]) -> bool:
+    """Check whether any of names, or a variable their values refer to by ${VAR}, differs between two environments"""
+    seen: Set[str] = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        value = environ.get(name)
+        if value != other.get(name):
+            return True
+        if value and '${' in value:
+            pending.extend(references(value))
+    return False
+
+
+def _parse_layer_job(job: tuple) -> dict:
+    """Parse a layer file from disk, or from previously read raw fields"""
+    metadata_file, doc_mode, raw_metadata, environ = job
+    result = {'raw': raw_metadata, 'error': None, 'meta': None, 'layer': None, 'lint': {}, 'env': set()}
+
+    if raw_metadata is None:
+        try:
+            result['raw'] = dict(Metadata._load_metadata(metadata_file))
+        except OSError:
+            return result
+        except Exception as e:
+            # Malformed YAML or metadata – skip
+            result['error'] = str(e)
+            return result
+
+    meta, result['layer'], result['lint'] = _parse_layer_file(metadata_file, doc_mode, result['raw'], environ)
+    result['meta'] = meta
+    result['env'] = lint_env_names(result['raw'], meta, environ)
+    return result
+
+
+def _parse_layer_job_detached(job: tuple) -> dict:
+    """Process pool entry point for _parse_layer_job"""
+    result = _parse_layer_job(job)
+    result['meta'] = None
+    return result
+
+
 def _generate_layer_boilerplate():
     """Generate boilerplate example layer with metadata"""
     boilerplate = """# METABEGIN
@@ -929,6 +1225,18 @@ def LayerManager_register_parser(subparsers, root=None):
     parser.add_argument('--path', '-p', default=default_paths, help=help_text)
     parser.add_argument('--patterns', nargs='+', default=['*.yaml', '*.yml'],
                        help='File patterns to search (default: *.yaml *.yml)')
+    parser.add_argument('--ignore', nargs='+', metavar='PATTERN', default=[],
+                       help='Skip files and directories matching PATTERN during discovery (see also .layerignore)')
+    parser.add_argument('--index', metavar='FILE', default=os.environ.get('IG_LAYER_INDEX'),
+                       help='Load layers from a compiled layer index if it is up to date (default: $IG_LAYER_INDEX)')
+    parser.add_argument('--build-index', metavar='FILE',
+                       help='Compile all layers in the search paths into an index file')
+    parser.add_argument('--cache', metavar='FILE', default=os.environ.get('IG_LAYER_CACHE'),
+                       help='Persistent cache of parsed layer files (default: $IG_LAYER_CACHE)')
+    parser.add_argument('--lazy', action='store_true',
+                       help='Only keep parsed metadata for layers that are used (all layers are still linted on load)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                       help='Parse layer files using N worker processes (0: one per CPU, default: 1)')
     parser.add_argument('--list', '-l', action='store_true',
                        help='List all available layers')
     parser.add_argument('--describe', metavar='LAYER',
@@ -937,22 +1245,60 @@ def LayerManager_register_parser(subparsers, root=None):
                        help='Validate one or more layer(s) metadata and environment variables (use layer names)')
     parser.add_argument('--check', '-c', nargs='+', metavar='LAYER',
                        help='Check dependencies for one or more layer(s) (use layer names)')
-    parser.add_argument('--rdep', '--reverse-deps', metavar='LAYER',
-                       help='Show layers that depend on the specified layer')
+    parser.add_argument('--check-all', action='store_true',
+                       help='Check dependencies of all layers in one pass, reporting every problem and cycle found')
+    parser.add_argument('--rdep', '--reverse-deps', nargs='+', metavar='LAYER',
+                       help='Show layers that depend on one or more layer(s)')
+    parser.add_argument('--transitive', action='store_true',
+                       help='With --rdep, include layers which depend on them indirectly')
+    parser.add_argument('--include-optional', action='store_true',
+                       help='With --rdep, include layers which optionally depend on them')
     # Build-order related options
     parser.add_argument('--build-order', '-b', nargs='+', metavar='LAYER',
                        help='Show build order for layers (use layer names)')
+    parser.add_argument('--waves', nargs='+', metavar='LAYER',
+                       help='Show the build order for layers as waves of layers which do not depend on each other')
+    parser.add_argument('--graph', nargs='+', metavar='LAYER',
+                       help='Export the dependency graph of layers with per-layer costs and the critical path')
+    parser.add_argument('--format', choices=['dot', 'json'], default='dot',
+                       help='Format for --graph (default: dot)')
+    parser.add_argument('--timings', metavar='FILE',
+                       help='With --graph, weight layers by the durations in FILE (layer=seconds lines) '
+                            'rather than by package and hook counts')
     parser.add_argument('--full-paths', action='store_true',
                        help='Include full file paths when showing build order')
     parser.add_argument('--output', metavar='FILE',
-                       help='Write build-order list to file (works with --build-order)')
+                       help='Write build-order list to file (works with --build-order, --waves, --graph and --plan)')
     parser.add_argument('--show-paths', action='store_true',
                        help='Show search paths')
     parser.add_argument('--apply-env', nargs='+', metavar='LAYER',
                        help='Apply environment variables from one or more layers (use layer names, not file paths)')
+    parser.add_argument('--scenarios', metavar='DIR',
+                       help='With --apply-env, show how each override file in DIR of IGconf_key=value lines would '
+                            'change the resolved variables, without applying them')
+
+    parser.add_argument('--mmdebstrap-layers', metavar='ORDER_FILE',
+                       help='List layer:path for layers in a --full-paths build order file which have an mmdebstrap section')
+    parser.add_argument('--plan', nargs='+', metavar='LAYER',
+                       help='Apply environment variables, validate and show build order for layers in one pass')
+    parser.add_argument('--hook-plan', metavar='FILE',
+                       help='With --plan, write the waves of parallel-safe layers whose customize hooks can run '
+                            'concurrently to FILE. With --mmdebstrap-layers, list those layers without the hooks')
+    parser.add_argument('--run-hooks', nargs='+', metavar=('PLAN', 'ARG'),
+                       help='Run the customize hooks in a hook plan with ARGs, as mmdebstrap would, '
+                            'running up to --jobs layers of each wave at once')
 
     parser.add_argument('--write-out', metavar='FILE',
-                       help='Write key=value pairs (changed vars) to file (works with --apply-env)')
+                       help='Write key=value pairs (changed vars) to file (works with --apply-env and --plan)')
+    parser.add_argument('--batch', nargs='+', metavar='TARGET',
+                       help='Plan many targets in one pass and print the build orders and environments as JSON. '
+                            'Each target is a comma separated list of layers, NAME=VALUE assignments and '
+                            'at most one config file, eg config/trixie-minbase.yaml,IGconf_device_layer=rpi4')
+    parser.add_argument('--config-path', metavar='DIRS', default='./config',
+                       help='Colon-separated search path for --batch config files and their includes')
+    parser.add_argument('--base-layer', action='append', default=[], metavar='LAYER', dest='base_layers',
+                       help='Layer built first for every --batch target with a config file, as rpi-image-gen '
+                            'builds essential (may be repeated)')
 
     parser.add_argument('--gen', action='store_true',
                        help='Generate boilerplate layer template with  metadata')
@@ -978,6 +1324,10 @@ Dependencies:
   X-Env-Layer-Requires           Comma-separated concrete layer names this layer needs
   X-Env-Layer-Conflicts          Layers that cannot co-exist with this one
 
+Execution:
+  X-Env-Layer-ParallelSafe       y/n (default n). The layer's customize hooks are independent of
+                                 other layers, so they may run concurrently (see --hook-plan)
+
 Virtual capabilities:
   X-Env-Layer-Provides           Comma-separated capability tokens this layer offers
   X-Env-Layer-RequiresProvider   Comma-separated capability tokens this layer requires;
@@ -995,6 +1345,74 @@ Notes:
     print(help_text)
 
 
+def _show_build_order(manager: LayerManager, build_order: List[str], full_paths: bool, output: Optional[str]):
+    """Print a build order, optionally also writing it to a file"""
+    # Prepare output lines
+    output_display = []  # what goes to stdout
+    output_file = []     # what goes to --output file
+    if build_order:
+        print("Build order:")
+
+        # Compute dynamic column widths
+        num_width = len(str(len(build_order)))
+        name_width = max(len(l) for l in build_order) if full_paths else 0
+
+        for i, layer in enumerate(build_order, 1):
+            if full_paths:
+                path = manager.layer_files.get(layer, "<unknown>")
+                display_line = (
+                    f"  {i:{num_width}d}. "
+                    f"{layer:<{name_width}}  "
+                    f"{path}"
+                )
+                file_line = f"{layer}=\"{path}\""
+            else:
+                display_line = f"  {i:{num_width}d}. {layer}"
+                file_line = layer
+
+            print(display_line)
+            output_display.append(display_line)
+            output_file.append(file_line)
+    else:
+        print("No layers to build")
+
+    # Optionally write to file
+    if output and output_file:
+        try:
+            with open(output, 'w') as f:
+                for line in output_file:
+                    f.write(line + "\n")
+            print(f"Build order written to: {output}")
+        except Exception as e:
+            print(f"Error writing build order to {output}: {e}")
+
+
+def _show_build_waves(manager: LayerManager, waves: List[List[str]], full_paths: bool, output: Optional[str]):
+    """Print build waves, optionally also writing them to a file as wave:layer lines"""
+    output_file = []
+    if waves:
+        print("Build waves:")
+        num_width = len(str(len(waves)))
+        for i, wave in enumerate(waves, 1):
+            print(f"  {i:{num_width}d}. {', '.join(wave)}")
+            for layer in wave:
+                if full_paths:
+                    output_file.append(f"{i}:{layer}=\"{manager.layer_files.get(layer, '<unknown>')}\"")
+                else:
+                    output_file.append(f"{i}:{layer}")
+    else:
+        print("No layers to build")
+
+    if output and output_file:
+        try:
+            with open(output, 'w') as f:
+                for line in output_file:
+                    f.write(line + "\n")
+            print(f"Build waves written to: {output}")
+        except Exception as e:
+            print(f"Error writing build waves to {output}: {e}")
+
+
 def _layer_main(args):
     """Main function for layer management CLI"""
 
@@ -1007,33 +1425,103 @@ def _layer_main(args):
         return
 
     # Check if any action argument was provided
-    action_args = ['list', 'describe', 'validate', 'check', 'rdep', 'build_order', 'show_paths', 'apply_env']
+    action_args = ['list', 'describe', 'validate', 'check', 'check_all', 'rdep', 'build_order', 'waves', 'graph', 'show_paths', 'apply_env', 'plan',
+                   'build_index', 'mmdebstrap_layers', 'run_hooks', 'batch']
     if not any(getattr(args, arg, None) for arg in action_args):
         print("Error: No action specified. Use -h or --help for available options.")
         exit(1)
 
+    if args.scenarios and not args.apply_env:
+        print("Error: --scenarios requires --apply-env.")
+        exit(1)
+
     # Create default manager (non-doc-mode) for general operations
     search_paths = [p.strip() for p in args.path.split(':') if p.strip()]
 
+    if args.build_index:
+        try:
+            count = build_layer_index(args.build_index, [str(Path(p).resolve()) for p in search_paths],
+                                      args.patterns, args.ignore)
+        except (OSError, ValueError) as e:
+            log_error(f"Failed to build layer index: {e}")
+            exit(1)
+        print(f"Indexed {count} layers to: {args.build_index}")
+        return
+
+    if args.mmdebstrap_layers:
+        # Only needs the layer files named in the order, not a full layer load
+        try:
+            layers = mmdebstrap_layers(args.mmdebstrap_layers, args.hook_plan)
+        except (OSError, ValueError) as e:
+            log_error(f"Failed to read build order {args.mmdebstrap_layers}: {e}")
+            exit(1)
+        for layer, filepath in layers:
+            print(f"{layer}:{filepath}")
+        return
+
+    if args.run_hooks:
+        plan_file, hook_args = args.run_hooks[0], args.run_hooks[1:]
+        jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+        try:
+            ok = run_hook_plan(plan_file, hook_args, jobs)
+        except (OSError, ValueError) as e:
+            log_error(f"Failed to run hook plan {plan_file}: {e}")
+            exit(1)
+        if not ok:
+            exit(1)
+        return
+
+    if args.batch:
+        # Keep stdout for the JSON document. Targets share parsed layers
+        # through an in-memory cache unless a persistent one is given.
+        if not args.cache and LayerManager.shared_cache is None:
+            LayerManager.shared_cache = LayerCache()
+        with contextlib.redirect_stdout(sys.stderr):
+            manager = LayerManager(search_paths, args.patterns, cache_path=args.cache, jobs=args.jobs,
+                                   lazy=args.lazy, ignore_patterns=args.ignore, index_path=args.index)
+        results = plan_batch(manager, args.batch, [p for p in args.config_path.split(':') if p], args.base_layers)
+        if manager.cache:
+            manager.cache.save()
+        print(json.dumps(results, indent=2))
+        if any(result['status'] != 'ok' for result in results.values()):
+            exit(1)
+        return
+
     # Use a doc-mode manager if listing so that layers with dynamic deps
     # can be shown. Using doc-mode is more relaxed, but we still lint.
     list_only = bool(args.list) and not any([
-        args.describe, args.validate, args.check, args.rdep,
-        args.build_order, args.show_paths, args.apply_env
+        args.describe, args.validate, args.check, args.check_all, args.rdep,
+        args.build_order, args.waves, args.graph, args.show_paths, args.apply_env, args.plan
     ])
 
     if list_only:
-        list_manager = LayerManager(search_paths, args.patterns, show_loaded=True, doc_mode=True)
+        list_manager = LayerManager(search_paths, args.patterns, show_loaded=True, doc_mode=True,
+                                    cache_path=args.cache, jobs=args.jobs, lazy=args.lazy,
+                                    ignore_patterns=args.ignore, index_path=args.index)
         print()
         list_manager.show_search_paths()
         print()
         list_manager.list_layers()
         return
 
-    # ..else generic instantiation.
-    manager = LayerManager(search_paths, args.patterns)
+    # ..else generic instantiation. Scenarios share parsed layers through an
+    # in-memory cache when their overrides make layers be parsed again.
+    if args.scenarios and not args.cache and LayerManager.shared_cache is None:
+        LayerManager.shared_cache = LayerCache()
+    manager = LayerManager(search_paths, args.patterns, cache_path=args.cache, jobs=args.jobs,
+                           lazy=args.lazy, ignore_patterns=args.ignore, index_path=args.index)
     print()
 
+    try:
+        _layer_actions(args, manager, search_paths)
+    finally:
+        # Build orders resolved along the way are written out once
+        if manager.cache:
+            manager.cache.save()
+
+
+def _layer_actions(args, manager: LayerManager, search_paths: List[str]):
+    """Run the requested actions against the loaded layers"""
     if args.show_paths:
         manager.show_search_paths()
         print()
@@ -1041,7 +1529,9 @@ def _layer_main(args):
     if args.list:
         # Always show the search paths when listing layers
         # Use a doc-mode manager for listing so unresolved env-based layers are included
-        list_manager = LayerManager(search_paths, args.patterns, show_loaded=True, doc_mode=True)
+        list_manager = LayerManager(search_paths, args.patterns, show_loaded=True, doc_mode=True,
+                                    cache_path=args.cache, jobs=args.jobs, lazy=args.lazy,
+                                    ignore_patterns=args.ignore, index_path=args.index)
         list_manager.show_search_paths()
         print()
         list_manager.list_layers()
@@ -1052,6 +1542,12 @@ def _layer_main(args):
             print(f"✗ Layer '{args.describe}' not found")
             exit(1)
 
+        try:
+            meta_obj = manager.layers[layer_name]
+        except ValueError as e:
+            log_failure(str(e))
+            exit(1)
+
         layer_info = manager.get_layer_info(layer_name)
         if layer_info:
             print(f"Layer: {layer_info['name']}")
@@ -1107,6 +1603,8 @@ def _layer_main(args):
                 print(f"Optional-Depends: {', '.join(layer_info['optional_depends'])}")
             if layer_info['conflicts']:
                 print(f"Conflicts: {', '.join(layer_info['conflicts'])}")
+            if layer_info.get('parallel_safe'):
+                print("Parallel-Safe: yes")
 
             # Show mmdebstrap configuration if any
             # TODO can extend for other maps
@@ -1126,8 +1624,7 @@ def _layer_main(args):
                         print(f"  - {package}")
 
             # Print environment variables for this layer
-            meta_obj = manager.layers.get(layer_name)
-            if meta_obj and meta_obj.get_all_env_vars():
+            if meta_obj.get_all_env_vars():
                 print()
                 print_env_var_descriptions(meta_obj, indent=2)
 
@@ -1139,26 +1636,40 @@ def _layer_main(args):
         if not manager.process_layers(args.check, "check"):
             exit(1)
 
-    if args.rdep:
-        layer_name = manager.resolve_layer_name(args.rdep)
-        if not layer_name:
-            print(f"✗ Layer '{args.rdep}' not found")
+    if args.check_all:
+        if not manager.check_all_layers():
             exit(1)
 
-        reverse_deps = manager.get_reverse_dependencies(layer_name)
+    if args.rdep:
+        resolved_layers = []
+        for layer_id in args.rdep:
+            layer_name = manager.resolve_layer_name(layer_id)
+            if not layer_name:
+                print(f"✗ Layer '{layer_id}' not found")
+                exit(1)
+            resolved_layers.append(layer_name)
+
+        affected = set()
+        for layer_name in resolved_layers:
+            reverse_deps = manager.get_reverse_dependencies(layer_name, transitive=args.transitive,
+                                                            include_optional=args.include_optional)
+            affected.update(reverse_deps)
+
+            if reverse_deps:
+                print(f"Reverse dependencies for '{layer_name}':")
+                print()
+                for dep_layer in reverse_deps:
+                    dep_info = manager.get_layer_info(dep_layer)
+                    if dep_info:
+                        print(f"Layer: {dep_info['name']}")
+                        print(f"Category: {dep_info.get('category', 'unknown')}")
+                        print(f"Description: {dep_info.get('description', 'No description')}")
+                        print()
 
-        if reverse_deps:
-            print(f"Reverse dependencies for '{layer_name}':")
-            print()
-            for dep_layer in reverse_deps:
-                dep_info = manager.get_layer_info(dep_layer)
-                if dep_info:
-                    print(f"Layer: {dep_info['name']}")
-                    print(f"Category: {dep_info.get('category', 'unknown')}")
-                    print(f"Description: {dep_info.get('description', 'No description')}")
-                    print()
+                print(f"{len(reverse_deps)} layer(s) depend on '{layer_name}'")
 
-            print(f"{len(reverse_deps)} layer(s) depend on '{layer_name}'")
+        if len(resolved_layers) > 1:
+            print(f"{len(affected)} layer(s) depend on any of: {', '.join(resolved_layers)}")
 
     if args.build_order:
         # Resolve all layer names
@@ -1171,46 +1682,87 @@ def _layer_main(args):
                 print(f"✗ Layer '{layer_id}' not found")
                 exit(1)
 
-        build_order = manager.get_build_order(resolved_layers)
-
-        # Prepare output lines
-        output_display = []  # what goes to stdout
-        output_file = []     # what goes to --output file
-        if build_order:
-            print("Build order:")
-
-            # Compute dynamic column widths
-            num_width = len(str(len(build_order)))
-            name_width = max(len(l) for l in build_order) if args.full_paths else 0
-
-            for i, layer in enumerate(build_order, 1):
-                if args.full_paths:
-                    path = manager.layer_files.get(layer, "<unknown>")
-                    display_line = (
-                        f"  {i:{num_width}d}. "
-                        f"{layer:<{name_width}}  "
-                        f"{path}"
-                    )
-                    file_line = f"{layer}=\"{path}\""
-                else:
-                    display_line = f"  {i:{num_width}d}. {layer}"
-                    file_line = layer
+        try:
+            build_order = manager.get_build_order(resolved_layers)
+        except ValueError as e:
+            log_failure(f"Dependency resolution failed: {e}")
+            exit(1)
 
-                print(display_line)
-                output_display.append(display_line)
-                output_file.append(file_line)
-        else:
-            print("No layers to build")
+        _show_build_order(manager, build_order, args.full_paths, args.output)
 
-        # Optionally write to file
-        if args.output and output_file:
+    if args.waves:
+        resolved_layers = []
+        for layer_id in args.waves:
+            layer_name = manager.resolve_layer_name(layer_id)
+            if not layer_name:
+                print(f"✗ Layer '{layer_id}' not found")
+                exit(1)
+            resolved_layers.append(layer_name)
+
+        try:
+            waves = manager.get_build_waves(resolved_layers)
+        except ValueError as e:
+            log_failure(f"Dependency resolution failed: {e}")
+            exit(1)
+
+        _show_build_waves(manager, waves, args.full_paths, args.output)
+
+    if args.graph:
+        resolved_layers = []
+        for layer_id in args.graph:
+            layer_name = manager.resolve_layer_name(layer_id)
+            if not layer_name:
+                print(f"✗ Layer '{layer_id}' not found")
+                exit(1)
+            resolved_layers.append(layer_name)
+
+        try:
+            timings = read_timings(args.timings) if args.timings else None
+            graph = build_graph(manager, resolved_layers, timings)
+        except OSError as e:
+            log_error(f"Failed to read timings {args.timings}: {e}")
+            exit(1)
+        except ValueError as e:
+            log_failure(f"Dependency graph failed: {e}")
+            exit(1)
+
+        rendered = graph_to_json(graph) + "\n" if args.format == 'json' else graph_to_dot(graph)
+        if args.output:
             try:
                 with open(args.output, 'w') as f:
-                    for line in output_file:
-                        f.write(line + "\n")
-                print(f"Build order written to: {args.output}")
-            except Exception as e:
-                print(f"Error writing build order to {args.output}: {e}")
+                    f.write(rendered)
+            except OSError as e:
+                log_error(f"Failed to write graph to {args.output}: {e}")
+                exit(1)
+            critical = graph['critical_path']
+            print(f"Critical path: {' -> '.join(critical['layers'])} ({critical['weight']:g} {graph['weight_unit']})")
+            print(f"Dependency graph written to: {args.output}")
+        else:
+            sys.stdout.write(rendered)
+
+    if args.plan:
+        build_order = manager.plan_layers(args.plan, write_out=args.write_out)
+        if build_order is None:
+            exit(1)
+        _show_build_order(manager, build_order, args.full_paths, args.output)
+        if args.hook_plan:
+            try:
+                count = write_hook_plan(manager, build_order, args.hook_plan)
+            except OSError as e:
+                log_error(f"Failed to write hook plan {args.hook_plan}: {e}")
+                exit(1)
+            print(f"Hook plan for {count} layer(s) written to: {args.hook_plan}")
+
+    if args.apply_env and args.scenarios:
+        try:
+            results = what_if(manager, args.apply_env, scenario_files(args.scenarios))
+        except (OSError, ValueError) as e:
+            log_error(f"Failed to evaluate scenarios in {args.scenarios}: {e}")
+            exit(1)
+        sys.stdout.write(format_what_if(results))
+        if any(result['status'] != 'ok' for result in results.values()):
+            exit(1)
+        return
 
     if args.apply_env:
         if not manager.process_layers(args.apply_env, "apply", write_out=getattr(args, 'write_out', None)):
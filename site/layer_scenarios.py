@@ -0,0 +1,118 @@
+import io
+import os
+import contextlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config_loader import load_overrides
+
+
+def scenario_files(scenario_dir: str) -> List[str]:
+    """Return the override files in a scenario directory, sorted by name"""
+    return sorted(os.path.join(scenario_dir, name) for name in os.listdir(scenario_dir)
+                  if os.path.isfile(os.path.join(scenario_dir, name)) and not name.startswith('.'))
+
+
+def env_diff(before: Dict[str, str], after: Dict[str, str], names: List[str]) -> List[Tuple[str, str, Optional[str], Optional[str]]]:
+    """Return (change, name, old, new) for each of names whose value differs between two environments"""
+    diff = []
+    for name in names:
+        old, new = before.get(name), after.get(name)
+        if old == new:
+            continue
+        change = '+' if old is None else '-' if new is None else '~'
+        diff.append((change, name, old, new))
+    return diff
+
+
+def _resolve_order(manager, layer_ids: List[str]) -> Tuple[Optional[List[str]], List[str]]:
+    """Return the build order of layer_ids and the reasons it couldn't be resolved"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        resolved = manager._resolve_build_order(layer_ids, "apply")
+    return (resolved[1] if resolved else None), manager.errors
+
+
+def _validate_order(manager, order: List[str]) -> List[str]:
+    """Return the reasons the variables of the layers in order fail validation, as checked by --apply-env"""
+    errors: List[str] = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for layer_name in order:
+            if not manager.validate_single_layer_env_vars(layer_name, silent=True, ignore_missing_required=True):
+                errors.extend(manager.errors)
+                manager.errors = []
+    return errors
+
+
+def what_if(manager, layer_ids: List[str], scenarios: List[str]) -> Dict[str, dict]:
+    """
+    Resolve the variables of layer_ids against each override file in
+    scenarios and return how each would change the resolved environment
+    compared with the manager's environment, keyed by scenario file.
+    Override files are loaded and expanded as by ig config --overrides,
+    and the layers' variables are validated as by --apply-env.
+
+    Each scenario is resolved against its own copy of the environment.
+    Layers are parsed once and shared by all scenarios unless their
+    overrides change a layer's dependencies, in which case only the layer
+    files depending on them are parsed again. Neither the environment nor
+    the manager is changed.
+    """
+    base_env = dict(manager.environ)
+    base_order, errors = _resolve_order(manager.for_environ(base_env), layer_ids)
+    if base_order is None:
+        raise ValueError('; '.join(errors))
+    baseline = manager.resolve_env(base_order, base_env)
+
+    results: Dict[str, dict] = OrderedDict()
+    for scenario in scenarios:
+        result: dict = {'status': 'failed'}
+        results[scenario] = result
+        try:
+            overrides = load_overrides(scenario, base_env)
+            environ = {**base_env, **overrides}
+            with contextlib.redirect_stdout(io.StringIO()):
+                scenario_manager = manager.for_environ(environ)
+        except (OSError, ValueError) as e:
+            result['errors'] = [str(e)]
+            continue
+
+        order, errors = _resolve_order(scenario_manager, layer_ids)
+        if order is None:
+            result['errors'] = errors
+            continue
+
+        errors = _validate_order(scenario_manager, order)
+        if errors:
+            result['errors'] = errors
+            continue
+
+        resolution = scenario_manager.resolve_env(order, environ)
+        names = list(OrderedDict.fromkeys([*baseline.changes, *overrides, *resolution.changes]))
+        result['status'] = 'ok'
+        result['build_order'] = order
+        result['order_changed'] = order != base_order
+        result['diff'] = env_diff(baseline.env, resolution.env, names)
+
+    return results
+
+
+def format_what_if(results: Dict[str, dict]) -> str:
+    """Render what_if results as a compact diff per scenario"""
+    lines = []
+    for scenario, result in results.items():
+        lines.append(f"Scenario: {os.path.basename(scenario)}")
+        if result['status'] != 'ok':
+            lines.extend(f"  ✗ {error}" for error in result['errors'] or ['failed'])
+            continue
+        if result['order_changed']:
+            lines.append(f"  order: {' '.join(result['build_order'])}")
+        for change, name, old, new in result['diff']:
+            if change == '+':
+                lines.append(f"  + {name}={new}")
+            elif change == '-':
+                lines.append(f"  - {name}")
+            else:
+                lines.append(f"  ~ {name}: {old} -> {new}")
+        if not result['diff'] and not result['order_changed']:
+            lines.append("  (no changes)")
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -1,5 +1,6 @@
 import os
 import argparse
+from typing import Mapping, MutableMapping, Optional
 from debian import deb822
 from validators import parse_validator
 from env_types import EnvVariable, EnvLayer, MetadataContainer, XEnv
@@ -98,6 +99,7 @@ SUPPORTED_FIELD_PATTERNS = {
     XEnv.layer_category(): {"type": "single", "description": "Layer category"},
     XEnv.layer_provides(): {"type": "single", "description": "Capabilities provided by this layer"},
     XEnv.layer_requires_provider(): {"type": "single", "description": "Capabilities required (virtual)"},
+    XEnv.layer_parallel_safe(): {"type": "single", "description": "Whether customize hooks may run concurrently"},
 
     # Variable definition patterns (these match multiple fields)
     f"{XEnv.VAR_PREFIX}": {"type": "pattern", "description": "Environment variable definition"},
@@ -152,17 +154,24 @@ def get_supported_fields_list() -> list:
 class Metadata:
     """Metadata parser with modular classes."""
 
-    def __init__(self, filepath, doc_mode: bool = False):
+    def __init__(self, filepath, doc_mode: bool = False, *, raw_metadata: Optional[dict] = None,
+                 environ: Optional[Mapping[str, str]] = None):
         self.filepath = filepath
-        raw_metadata = self._load_metadata(filepath)
+        if raw_metadata is None:
+            raw_metadata = self._load_metadata(filepath)
+        else:
+            # Previously parsed fields (eg from the layer cache)
+            raw_metadata = deb822.Deb822(raw_metadata)
 
-        # Create the container (applies placeholder substitutions internally)
-        self._container = MetadataContainer.from_metadata_dict(raw_metadata, filepath, doc_mode)
+        # Create the container (applies placeholder substitutions internally),
+        # expanding ${VAR} in layer dependencies from environ
+        self._container = MetadataContainer.from_metadata_dict(raw_metadata, filepath, doc_mode, environ)
 
         # Create validation result builder
         self._result_builder = ValidationResultBuilder(filepath)
 
-    def _validate_deb822_format(self, meta_lines):
+    @staticmethod
+    def _validate_deb822_format(meta_lines):
         """
         Validate that metadata lines follow proper DEB822 format.
         Python deb822 is very forgiving and tries hard to avoid parsing errors
@@ -192,28 +201,26 @@ class Metadata:
                 if not field_name or not field_name.replace('-', '').replace('_', '').isalnum():
                     raise ValueError(f"Invalid field name '{field_name}': field names must contain only letters, numbers, hyphens, and underscores")
 
-    def _load_metadata(self, path):
-        """Load metadata from file"""
+    @staticmethod
+    def _read_meta_lines(path):
+        """Read the metadata lines from file, reading no further than METAEND"""
         if not os.path.isfile(path):
             raise FileNotFoundError(f"Metadata source not found: {path}")
 
+        meta_lines = []
+        # Direct X-Env-* fields (no comment wrapper), used if there is no METABEGIN
+        direct_lines = []
+        in_meta = False
+        ended = False  # METAEND seen before any METABEGIN
+
         with open(path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        # Extract metadata block if embedded
-        if any(line.strip() == '# METABEGIN' for line in lines):
-            # Find METABEGIN and METAEND markers in comment blocks
-            in_meta = False
-            meta_lines = []
-
-            for line in lines:
-                stripped = line.strip()
-                if stripped == '# METABEGIN':
-                    in_meta = True
-                    continue
-                elif stripped == '# METAEND':
-                    break
-                elif in_meta:
+            for line in f:
+                if in_meta:
+                    stripped = line.strip()
+                    if stripped == '# METAEND':
+                        break
+                    if stripped == '# METABEGIN':
+                        continue
                     # Extract everything between them (remove '# ' from each line)
                     if line.startswith('# '):
                         clean_line = line[2:].rstrip()
@@ -225,24 +232,38 @@ class Metadata:
                         clean_line = line[1:].rstrip()
                         if clean_line.strip():
                             meta_lines.append(clean_line)
+                    continue
 
-            # Validate before parsing
-            self._validate_deb822_format(meta_lines)
-            meta_str = "\n".join(meta_lines)
-        else:
-            # Handle files with direct X-Env-* fields (no comment wrapper)
-            meta_lines = []
-            for line in lines:
-                line = line.rstrip()
-                # Only keep non-comment, non-empty lines that look like metadata
-                if line and not line.startswith('#') and ':' in line:
-                    field_name = line.split(':', 1)[0].strip()
-                    if field_name.startswith('X-Env-'):
-                        meta_lines.append(line)
-
-            # Validate before parsing
-            self._validate_deb822_format(meta_lines)
-            meta_str = "\n".join(meta_lines)
+                if '# META' in line:
+                    stripped = line.strip()
+                    if stripped == '# METABEGIN':
+                        if ended:
+                            # Embedded block which ended before it began
+                            return []
+                        in_meta = True
+                        continue
+                    if stripped == '# METAEND':
+                        ended = True
+                        continue
+
+                if 'X-Env-' in line:
+                    line = line.rstrip()
+                    # Only keep non-comment, non-empty lines that look like metadata
+                    if line and not line.startswith('#') and ':' in line:
+                        field_name = line.split(':', 1)[0].strip()
+                        if field_name.startswith('X-Env-'):
+                            direct_lines.append(line)
+
+        return meta_lines if in_meta else direct_lines
+
+    @classmethod
+    def _load_metadata(cls, path):
+        """Load metadata from file"""
+        meta_lines = cls._read_meta_lines(path)
+
+        # Validate before parsing
+        cls._validate_deb822_format(meta_lines)
+        meta_str = "\n".join(meta_lines)
 
         # Throw directly at deb822 module
         try:
@@ -378,8 +399,11 @@ class Metadata:
                 unsupported_fields[field_name] = f"'{field_name}' is not supported"
         return unsupported_fields
 
-    def validate_env_vars(self):
-        """Validate environment variables - now broken into focused smaller methods"""
+    def validate_env_vars(self, environ: Optional[Mapping[str, str]] = None):
+        """Validate variables against environ (default os.environ) - now broken into focused smaller methods"""
+        if environ is None:
+            environ = os.environ
+
         # Schema validation first
         schema_errors = self._validate_schema()
         if schema_errors:
@@ -393,11 +417,11 @@ class Metadata:
             return prefix_errors
 
         # Validate defined variables
-        results.update(self._validate_defined_variables())
+        results.update(self._validate_defined_variables(environ))
 
         # Validate required/optional variables
-        results.update(self._validate_required_variables())
-        results.update(self._validate_optional_variables())
+        results.update(self._validate_required_variables(environ))
+        results.update(self._validate_optional_variables(environ))
 
         # Check layer-level unsupported fields
         results.update(self._validate_layer_fields())
@@ -441,12 +465,12 @@ class Metadata:
 
         return results
 
-    def _validate_defined_variables(self):
+    def _validate_defined_variables(self, environ: Mapping[str, str]):
         """Validate all defined variables from the metadata."""
         results = {}
 
         for var_name, env_var in self._container.variables.items():
-            current_value = os.environ.get(var_name)
+            current_value = environ.get(var_name)
 
             # First check for unsupported validation rules - this should always be checked
             var_short_name = var_name.split('_')[-1].upper()
@@ -506,7 +530,7 @@ class Metadata:
 
         return results
 
-    def _validate_required_variables(self):
+    def _validate_required_variables(self, environ: Mapping[str, str]):
         """Validate required environment variables (X-Env-VarRequires)."""
         results = {}
 
@@ -515,7 +539,7 @@ class Metadata:
             valid_rules = [r.strip() for r in required_valid_rules.split(',') if r.strip()] if required_valid_rules.strip() else []
 
             for i, req_var in enumerate(self._container.required_vars):
-                current_value = os.environ.get(req_var)
+                current_value = environ.get(req_var)
                 valid_rule = valid_rules[i] if i < len(valid_rules) else None
 
                 if current_value is None:
@@ -563,7 +587,7 @@ class Metadata:
 
         return results
 
-    def _validate_optional_variables(self):
+    def _validate_optional_variables(self, environ: Mapping[str, str]):
         """Validate optional environment variables (X-Env-VarOptional)."""
         results = {}
 
@@ -572,7 +596,7 @@ class Metadata:
             valid_rules = [r.strip() for r in optional_valid_rules.split(',') if r.strip()] if optional_valid_rules.strip() else []
 
             for i, opt_var in enumerate(self._container.optional_vars):
-                current_value = os.environ.get(opt_var)
+                current_value = environ.get(opt_var)
                 valid_rule = valid_rules[i] if i < len(valid_rules) else None
 
                 if current_value is None:
@@ -626,10 +650,10 @@ class Metadata:
 
         return results
 
-    def lint_metadata_syntax(self):
+    def lint_metadata_syntax(self, environ: Optional[Mapping[str, str]] = None):
         """Lint metadata for syntax errors by filtering validation results that don't require environment variables."""
         # Reuse existing validation infrastructure
-        all_results = self.validate_env_vars()
+        all_results = self.validate_env_vars(environ)
 
         # Filter to only syntax-related errors (don't require environment variables)
         lint_statuses = {
@@ -656,8 +680,10 @@ class Metadata:
             }
         return results
 
-    def set_env_vars(self):
-        """Set environment variables from metadata defaults using new classes"""
+    def set_env_vars(self, environ: Optional[MutableMapping[str, str]] = None):
+        """Set variables from metadata defaults in environ (default os.environ)"""
+        if environ is None:
+            environ = os.environ
         results = {}
 
         # Check for unsupported fields first
@@ -670,7 +696,7 @@ class Metadata:
             raise ValueError("Cannot process variables: X-Env-Var-* fields are defined but X-Env-VarPrefix is missing. Environment variables require a valid prefix.")
 
         for var_name, env_var in self._container.variables.items():
-            current_value = os.environ.get(var_name)
+            current_value = environ.get(var_name)
 
             if env_var.set_policy == "skip":
                 results[var_name] = {
@@ -687,7 +713,7 @@ class Metadata:
                         "reason": "empty value with string-or-unset validation"
                     }
                 else:
-                    os.environ[var_name] = env_var.value
+                    environ[var_name] = env_var.value
                     results[var_name] = {
                         "status": "force_set",
                         "value": env_var.value,
@@ -695,7 +721,7 @@ class Metadata:
                     }
             elif env_var.set_policy == "immediate":
                 if current_value is None:
-                    os.environ[var_name] = env_var.value
+                    environ[var_name] = env_var.value
                     results[var_name] = {
                         "status": "set",
                         "value": env_var.value,
@@ -717,7 +743,7 @@ class Metadata:
                             "reason": "empty value with string-or-unset validation"
                         }
                     else:
-                        os.environ[var_name] = env_var.value
+                        environ[var_name] = env_var.value
                         results[var_name] = {
                             "status": "set",
                             "value": env_var.value,
@@ -791,6 +817,9 @@ def _generate_boilerplate():
 # X-Env-Layer-Requires:
 # X-Env-Layer-Conflicts:
 #
+# Customize hooks are independent of other layers (y/n)
+# X-Env-Layer-ParallelSafe: n
+#
 # Environment Variables
 # X-Env-VarPrefix: my
 #
@@ -1101,6 +1130,9 @@ def _main(args):
                     conflicts = ', '.join(layer_info['conflicts']) if layer_info['conflicts'] else 'none'
                     print(f"  Conflicts: {conflicts}")
 
+                    if layer_info.get('parallel_safe'):
+                        print("  Parallel-Safe: yes")
+
                     print(f"  Filename: {layer_info['config_file']}")
 
                     # Show required environment variables if any
@@ -0,0 +1,20 @@
+import yaml
+
+# Prefer the libyaml based loader, which is several times faster than the
+# pure Python one, falling back if PyYAML was built without libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+YAMLError = yaml.YAMLError
+
+
+def safe_load(stream):
+    """Drop-in replacement for yaml.safe_load using the fastest available loader"""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def safe_dump(data, stream=None):
+    """yaml.safe_dump using the fastest available dumper, keeping mapping key order"""
+    return yaml.dump(data, stream, Dumper=SafeDumper, sort_keys=False)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark get_build_order on long synthetic dependency chains and wide
+layered graphs, comparing the iterative walk used by ig against the
+previous recursive resolver. Orders are checked to match on the shipped
+layers and on random acyclic graphs.
+
+Usage: build-order.py [--sizes N,...]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+import io
+
+igroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(igroot, 'site'))
+
+from layer_graph import LayerGraph
+from layer_manager import LayerManager
+
+
+def reference_build_order(layer_info, targets):
+    """Previous implementation, recursing once per dependency edge"""
+    build_order = []
+    processed = set()
+
+    def check_missing_dependencies(layer_name, checked):
+        if layer_name in checked:
+            return
+        checked.add(layer_name)
+        if layer_name not in layer_info:
+            raise ValueError(f"Missing required dependency: {layer_name}")
+        for dep in layer_info[layer_name]['depends']:
+            check_missing_dependencies(dep, checked)
+
+    def add_layer_and_deps(layer_name):
+        if layer_name in processed:
+            return
+        for dep in layer_info[layer_name]['depends']:
+            add_layer_and_deps(dep)
+        for opt_dep in layer_info[layer_name]['optional_depends']:
+            if opt_dep in layer_info:
+                add_layer_and_deps(opt_dep)
+        if layer_name not in processed:
+            build_order.append(layer_name)
+            processed.add(layer_name)
+
+    for layer in targets:
+        check_missing_dependencies(layer, set())
+    for layer in targets:
+        add_layer_and_deps(layer)
+    return build_order
+
+
+def graph_build_order(layer_info, targets, graph=None):
+    graph = graph or LayerGraph(layer_info)
+    order, missing, cycles = graph.build_order([graph.node(t) for t in targets])
+    if missing or cycles:
+        raise ValueError("Unresolvable dependencies")
+    return [graph.names[n] for n in order]
+
+
+def chain(size):
+    """Each layer requires the one before it"""
+    info = {'chain-0': {'depends': [], 'optional_depends': []}}
+    for i in range(1, size):
+        info[f'chain-{i}'] = {'depends': [f'chain-{i - 1}'], 'optional_depends': []}
+    return info
+
+
+def layered(size, width=10, seed=0):
+    """Levels of width layers, each depending on a few layers of the level below"""
+    rng = random.Random(seed)
+    info = {}
+    below = []
+    for i in range(size):
+        name = f'layer-{i}'
+        info[name] = {'depends': rng.sample(below, min(3, len(below))),
+                      'optional_depends': rng.sample(below, min(1, len(below)))}
+        if i % width == width - 1:
+            below = [f'layer-{j}' for j in range(i - width + 1, i + 1)]
+    return info
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    try:
+        func(*args)
+    except RecursionError:
+        return '  recursion'
+    return f"{(time.perf_counter() - start) * 1000:8.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark build order resolution")
+    parser.add_argument('--sizes', default='100,900,5000,50000')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        shipped = LayerManager([os.path.join(igroot, d) for d in ('layer', 'device', 'image')])
+    info = shipped.layer_info
+    for name in info:
+        try:
+            expected = reference_build_order(info, [name])
+        except ValueError:
+            continue
+        if graph_build_order(info, [name]) != expected:
+            print(f"Error: build order differs for {name}", file=sys.stderr)
+            sys.exit(1)
+    rng = random.Random(0)
+    for seed in range(200):
+        info = layered(rng.randint(1, 60), width=rng.randint(1, 6), seed=seed)
+        targets = list(info)[-3:]
+        if graph_build_order(info, targets) != reference_build_order(info, targets):
+            print(f"Error: build order differs for random graph {seed}", file=sys.stderr)
+            sys.exit(1)
+    print("Build orders match on shipped layers and 200 random graphs")
+
+    print(f"{'graph':>8}  {'layers':>6}  {'previous':>12}  {'iterative':>12}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        for label, info in (('chain', chain(size)), ('layered', layered(size))):
+            targets = [list(info)[-1]]
+            # The graph is built once when layers are loaded
+            graph = LayerGraph(info)
+            print(f"{label:>8}  {size:>6}  {timed(reference_build_order, info, targets):>12}  "
+                  f"{timed(graph_build_order, info, targets, graph):>12}")
+
+
+if __name__ == "__main__":
+    main()
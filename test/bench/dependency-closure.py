@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark transitive dependency queries (get_all_dependencies) on deep
+synthetic diamond graphs, comparing the single walk per layer used by ig
+against the previous per-path recursion. A single query is linear in the
+size of the graph; querying every layer is bounded by the total size of the
+results, which grows quadratically with depth. Results are checked to match on
+the shipped layers and on random graphs with cycles and missing layers.
+
+Usage: dependency-closure.py [--depths N,...] [--reference-max-depth N] [--all-max-depth N]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+import io
+
+igroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(igroot, 'site'))
+
+from layer_graph import LayerGraph
+from layer_manager import LayerManager
+
+
+def reference_all_dependencies(layer_info, layer_name, visited=None, include_optional=True):
+    """Previous implementation, copying the path at every edge"""
+    if visited is None:
+        visited = set()
+    if layer_name in visited or layer_name not in layer_info:
+        return []
+    visited.add(layer_name)
+    all_deps = []
+    for dep in layer_info[layer_name]['depends']:
+        if dep not in all_deps:
+            all_deps.append(dep)
+        for trans_dep in reference_all_dependencies(layer_info, dep, visited.copy(), include_optional):
+            if trans_dep not in all_deps:
+                all_deps.append(trans_dep)
+    if include_optional:
+        for opt_dep in layer_info[layer_name]['optional_depends']:
+            if opt_dep in layer_info and opt_dep not in all_deps:
+                all_deps.append(opt_dep)
+                for trans_dep in reference_all_dependencies(layer_info, opt_dep, visited.copy(), include_optional):
+                    if trans_dep not in all_deps:
+                        all_deps.append(trans_dep)
+    return all_deps
+
+
+def graph_all_dependencies(graph, layer_name, include_optional=True):
+    return [graph.names[d] for d in graph.all_dependencies(graph.node(layer_name), include_optional)]
+
+
+def diamond(depth):
+    """Two layers per level, each depending on both layers of the level below"""
+    info = {'base': {'depends': [], 'optional_depends': []}}
+    below = ['base']
+    for level in range(depth):
+        names = [f'l{level}-a', f'l{level}-b']
+        for name in names:
+            info[name] = {'depends': list(below), 'optional_depends': []}
+        below = names
+    info['top'] = {'depends': below, 'optional_depends': []}
+    return info
+
+
+def random_graph(rng, size):
+    names = [f'n{i}' for i in range(size)]
+    info = {}
+    for name in names:
+        pick = lambda k: [rng.choice(names + ['missing-a', 'missing-b']) for _ in range(rng.randint(0, k))]
+        info[name] = {'depends': pick(3), 'optional_depends': pick(2)}
+    return info
+
+
+def check(info, label):
+    graph = LayerGraph(info)
+    for name in info:
+        for include_optional in (False, True):
+            expected = reference_all_dependencies(info, name, include_optional=include_optional)
+            if graph_all_dependencies(graph, name, include_optional) != expected:
+                print(f"Error: results differ for {name} in {label}", file=sys.stderr)
+                sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transitive dependency queries")
+    parser.add_argument('--depths', default='8,12,16,100,1000,10000')
+    parser.add_argument('--reference-max-depth', type=int, default=16,
+                        help='Deepest graph to run the exponential reference on')
+    parser.add_argument('--all-max-depth', type=int, default=1000,
+                        help='Deepest graph to query every layer of')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        shipped = LayerManager([os.path.join(igroot, d) for d in ('layer', 'device', 'image')])
+        test_layers = LayerManager([os.path.join(igroot, 'test', 'layer')])
+    check(shipped.layer_info, 'shipped layers')
+    check(test_layers.layer_info, 'test layers')
+    rng = random.Random(0)
+    for _ in range(200):
+        check(random_graph(rng, rng.randint(1, 12)), 'random graph')
+    print("Results match on shipped layers, test layers and 200 random graphs")
+
+    print(f"{'depth':>6}  {'layers':>6}  {'previous':>12}  {'top layer':>12}  {'all layers':>12}")
+    for depth in (int(d) for d in args.depths.split(',')):
+        info = diamond(depth)
+        start = time.perf_counter()
+        graph_all_dependencies(LayerGraph(info), 'top')
+        top = time.perf_counter() - start
+
+        # Every layer queried, as check_dependencies and the docs generator do
+        every = '-'
+        if depth <= args.all_max_depth:
+            start = time.perf_counter()
+            graph = LayerGraph(info)
+            for name in info:
+                graph_all_dependencies(graph, name)
+            every = f"{(time.perf_counter() - start) * 1000:9.1f} ms"
+
+        previous = '-'
+        if depth <= args.reference_max_depth:
+            start = time.perf_counter()
+            for name in info:
+                reference_all_dependencies(info, name)
+            previous = f"{(time.perf_counter() - start) * 1000:9.1f} ms"
+        print(f"{depth:>6}  {len(info):>6}  {previous:>12}  {top * 1000:9.1f} ms  {every:>12}")
+
+
+if __name__ == "__main__":
+    main()
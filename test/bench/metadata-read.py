@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark reading the metadata header of layer files with the streaming
+reader used by ig against the previous whole-file reader, checking both
+return the same lines for the shipped layers and some edge cases.
+
+Usage: metadata-read.py [--rounds N] [--body-kib N] [--files N]
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+
+igroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(igroot, 'site'))
+
+from metadata_parser import Metadata
+
+
+def _read_meta_lines_whole_file(path):
+    """Previous implementation, reading and scanning the whole file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+
+    if any(line.strip() == '# METABEGIN' for line in lines):
+        in_meta = False
+        meta_lines = []
+        for line in lines:
+            stripped = line.strip()
+            if stripped == '# METABEGIN':
+                in_meta = True
+                continue
+            elif stripped == '# METAEND':
+                break
+            elif in_meta:
+                if line.startswith('# '):
+                    clean_line = line[2:].rstrip()
+                    if clean_line.strip():
+                        meta_lines.append(clean_line)
+                elif line.startswith('#'):
+                    clean_line = line[1:].rstrip()
+                    if clean_line.strip():
+                        meta_lines.append(clean_line)
+    else:
+        meta_lines = []
+        for line in lines:
+            line = line.rstrip()
+            if line and not line.startswith('#') and ':' in line:
+                field_name = line.split(':', 1)[0].strip()
+                if field_name.startswith('X-Env-'):
+                    meta_lines.append(line)
+    return meta_lines
+
+
+HEADER = """# METABEGIN
+# X-Env-Layer-Name: bench-{n}
+# X-Env-Layer-Desc: Synthetic layer with a large body
+# X-Env-Layer-Version: 1.0.0
+# X-Env-Layer-Category: test
+# X-Env-VarPrefix: bench
+# X-Env-Var-size: {n}
+# X-Env-Var-size-Desc: A variable
+#  continued description
+#
+# X-Env-Var-size-Valid: int
+# METAEND
+"""
+
+EDGE_CASES = {
+    'no-markers.yaml': "X-Env-Layer-Name: direct\n  X-Env-Var-a: 1\n# X-Env-Var-b: 2\nfoo: bar\n",
+    'end-before-begin.yaml': "# METAEND\n# METABEGIN\n# X-Env-Layer-Name: x\n# METAEND\n",
+    'end-only.yaml': "X-Env-Layer-Name: direct\n# METAEND\nX-Env-Var-a: 1\n",
+    'no-end.yaml': "X-Env-Var-z: 0\n# METABEGIN\n#X-Env-Layer-Name: open\n  # not meta\n",
+    'repeat-begin.yaml': "# METABEGIN\n# X-Env-Layer-Name: r\n  # METABEGIN\n# X-Env-Var-a: 1\n# METAEND\n# X-Env-Var-b: 2\n",
+    'empty.yaml': "",
+}
+
+
+def _make_body(kib):
+    lines = ["mmdebstrap:", "  packages:"]
+    lines += [f"    - package-{i}" for i in range(kib * 4)]
+    lines += ["  customize-hooks:", "    - |"]
+    lines += [f"      echo 'step {i}' > /dev/null" for i in range(kib * 16)]
+    return "\n".join(lines) + "\n"
+
+
+def _time(fn, paths, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for path in paths:
+            fn(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark layer metadata header reading")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--body-kib', type=int, default=512, help='Approximate YAML body size per file')
+    parser.add_argument('--files', type=int, default=50)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, content in EDGE_CASES.items():
+            with open(os.path.join(tmpdir, name), 'w') as f:
+                f.write(content)
+        shipped = []
+        for d in ('layer', 'device', 'image', 'examples', os.path.join('test', 'layer')):
+            shipped += glob.glob(os.path.join(igroot, d, '**', '*.yaml'), recursive=True)
+
+        mismatches = [path for path in shipped + glob.glob(os.path.join(tmpdir, '*.yaml'))
+                      if Metadata._read_meta_lines(path) != _read_meta_lines_whole_file(path)]
+        if mismatches:
+            print("Error: readers disagree for:\n  " + "\n  ".join(mismatches), file=sys.stderr)
+            sys.exit(1)
+        print(f"Readers agree on {len(shipped)} shipped files and {len(EDGE_CASES)} edge cases")
+
+        body = _make_body(args.body_kib)
+        synthetic = []
+        for n in range(args.files):
+            path = os.path.join(tmpdir, f'bench-{n}.yaml')
+            with open(path, 'w') as f:
+                f.write(HEADER.format(n=n) + body)
+            synthetic.append(path)
+
+        size = sum(os.path.getsize(p) for p in synthetic)
+        print(f"{len(synthetic)} synthetic layers, {size // len(synthetic) // 1024} KiB each, best of {args.rounds}")
+        for label, paths in (('synthetic', synthetic), ('shipped', shipped)):
+            old = _time(_read_meta_lines_whole_file, paths, args.rounds)
+            new = _time(Metadata._read_meta_lines, paths, args.rounds)
+            print(f"  {label:9}  whole file: {old * 1000:8.1f} ms  streaming: {new * 1000:8.1f} ms  ({old / new:.1f}x)")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark YAML loading of layer files with the pure Python loader against
+the loader used by ig (libyaml when available), checking both agree.
+
+Usage: yaml-load.py [--rounds N] [DIR...]   (default: the shipped layer/ tree)
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+
+igroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(igroot, 'site'))
+
+import yaml
+import yaml_loader
+
+
+def _load(data, loader):
+    try:
+        return yaml.load(data, Loader=loader)
+    except yaml.YAMLError:
+        # ig treats unparseable documents as having no content
+        return None
+
+
+def _load_all(files, loader):
+    return [_load(data, loader) for data in files]
+
+
+def _time(files, loader, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        _load_all(files, loader)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark YAML loading of layer files")
+    parser.add_argument('dirs', nargs='*', default=[os.path.join(igroot, 'layer')])
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    paths = []
+    for d in args.dirs:
+        paths += sorted(glob.glob(os.path.join(d, '**', '*.yaml'), recursive=True))
+    files = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            files.append(f.read())
+
+    if _load_all(files, yaml.SafeLoader) != _load_all(files, yaml_loader.SafeLoader):
+        print("Error: loaders disagree", file=sys.stderr)
+        sys.exit(1)
+
+    size = sum(len(data) for data in files)
+    print(f"{len(files)} files, {size // 1024} KiB, best of {args.rounds}")
+    python_time = _time(files, yaml.SafeLoader, args.rounds)
+    print(f"  yaml.SafeLoader:         {python_time * 1000:8.1f} ms")
+    if yaml_loader.SafeLoader is yaml.SafeLoader:
+        print("  libyaml not available, ig uses yaml.SafeLoader")
+        return
+    fast_time = _time(files, yaml_loader.SafeLoader, args.rounds)
+    print(f"  yaml_loader.SafeLoader:  {fast_time * 1000:8.1f} ms  ({python_time / fast_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
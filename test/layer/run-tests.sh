@@ -107,6 +107,25 @@ setup_test_env() {
     export IGconf_valfail_required=""
 }
 
+# Write layer NAME to DIR/NAME.yaml. Further arguments are header fields
+# as Field=value, eg Requires=a,b, then after -- the lines of the body.
+make_layer() {
+    local dir=$1 name=$2
+    shift 2
+    {
+        printf '# METABEGIN\n# X-Env-Layer-Name: %s\n# X-Env-Layer-Desc: Test layer\n# X-Env-Layer-Version: 1.0.0\n' "$name"
+        while [ $# -gt 0 ] && [ "$1" != -- ]; do
+            printf '# X-Env-Layer-%s: %s\n' "${1%%=*}" "${1#*=}"
+            shift
+        done
+        printf '# METAEND\n'
+        if [ $# -gt 0 ]; then
+            shift
+            printf '%s\n' "$@"
+        fi
+    } > "$dir/$name.yaml"
+}
+
 
 # Valid basic metadata
 print_header "VALID METADATA TESTS"
@@ -288,6 +307,90 @@ run_test "layer-build-order-circular" \
     1 \
     "Build order should fail for circular dependencies"
 
+run_test "layer-build-order-circular-reported" \
+    "ig layer --path ${LAYERS} --build-order test-circular-a | grep -q 'Circular dependency detected: test-circular-a -> test-circular-b -> test-circular-a'" \
+    0 \
+    "Build order should report the dependency cycle"
+
+# Declared layer conflicts and duplicate providers within a build order
+tmp_conflict=$(mktemp -d)
+make_layer "$tmp_conflict" ntp-a Provides=ntp Conflicts=ntp-legacy
+make_layer "$tmp_conflict" ntp-b Provides=ntp
+make_layer "$tmp_conflict" ntp-legacy
+make_layer "$tmp_conflict" both-conflict Requires=ntp-legacy,ntp-a
+make_layer "$tmp_conflict" both-provider Requires=ntp-a,ntp-b
+make_layer "$tmp_conflict" conflict-missing Requires=ntp-legacy,ntp-a,ntp-unknown
+
+run_test "layer-build-order-declared-conflict" \
+    "ig layer --path $tmp_conflict --build-order both-conflict | grep -q \"Layer conflict: 'ntp-a' conflicts with 'ntp-legacy'\"" \
+    0 \
+    "Build order should fail for layers declared to conflict"
+
+run_test "layer-build-order-declared-conflict-targets" \
+    "ig layer --path $tmp_conflict --build-order ntp-a ntp-legacy" \
+    1 \
+    "Build order should fail for conflicting target layers in either order"
+
+run_test "layer-build-order-provider-conflict" \
+    "ig layer --path $tmp_conflict --build-order both-provider | grep -q \"Provider conflict: 'ntp' is provided by multiple layers: ntp-a, ntp-b\"" \
+    0 \
+    "Build order should fail for layers providing the same provider"
+
+run_test "layer-build-order-missing-before-conflict" \
+    "ig layer --path $tmp_conflict --build-order conflict-missing > $tmp_conflict/out; test \$? = 1 && \
+     grep -q 'Missing required dependency: ntp-unknown' $tmp_conflict/out && ! grep -q 'Layer conflict' $tmp_conflict/out" \
+    0 \
+    "Build order should report a missing dependency before a conflict"
+rm -rf "$tmp_conflict"
+
+# Checking the whole tree reports every cycle in one run
+tmp_cycles=$(mktemp -d)
+make_layer "$tmp_cycles" ring-a Requires=ring-b
+make_layer "$tmp_cycles" ring-b Requires=ring-a
+make_layer "$tmp_cycles" loop-a Requires=loop-b
+make_layer "$tmp_cycles" loop-b Requires=loop-c
+make_layer "$tmp_cycles" loop-c Requires=loop-a
+run_test "layer-check-all-cycles" \
+    "ig layer --path $tmp_cycles --check-all > $tmp_cycles/out; test \$? = 1 && \
+     grep -q 'Circular dependency detected: ring-a -> ring-b -> ring-a' $tmp_cycles/out && \
+     grep -q 'Circular dependency detected: loop-a -> loop-b -> loop-c -> loop-a' $tmp_cycles/out" \
+    0 \
+    "Check-all should report all dependency cycles at once"
+rm -rf "$tmp_cycles"
+
+run_test "layer-check-all-valid" \
+    "ig layer --path ${LAYERS} --patterns 'valid-*.yaml' 'test-dependency-*.yaml' --check-all" \
+    0 \
+    "Check-all should pass for layers with satisfied dependencies"
+
+# Reverse dependencies
+run_test "layer-rdep-direct" \
+    "ig layer --path ${LAYERS} --rdep test-dependency-bottom | grep -q \"1 layer(s) depend on 'test-dependency-bottom'\"" \
+    0 \
+    "Reverse dependencies should list direct dependents only"
+
+tmp_rdep=$(mktemp)
+run_test "layer-rdep-transitive-multiple" \
+    "ig layer --path ${LAYERS} --rdep test-dependency-bottom test-basic --transitive > $tmp_rdep && \
+     grep -q \"2 layer(s) depend on 'test-dependency-bottom'\" $tmp_rdep && \
+     grep -q '3 layer(s) depend on any of: test-dependency-bottom, test-basic' $tmp_rdep" \
+    0 \
+    "Reverse dependencies should include indirect dependents of several layers"
+rm -f "$tmp_rdep"
+
+# Dependency chains deeper than the interpreter's recursion limit
+tmp_chain=$(mktemp -d)
+make_layer "$tmp_chain" chain-0
+for i in $(seq 1 1500); do
+    make_layer "$tmp_chain" chain-$i Requires=chain-$((i - 1))
+done
+run_test "layer-build-order-deep-chain" \
+    "ig layer --path $tmp_chain --check chain-1500 && \
+     test \"\$(ig layer --path $tmp_chain --build-order chain-1500 | grep -c '^ *[0-9]*\\. chain-')\" = 1501" \
+    0 \
+    "Build order should resolve dependency chains of any depth"
+rm -rf "$tmp_chain"
+
 
 # Duplicate layer name detection uses a temp dir to avoid side effects
 tmp_dup_dir=$(mktemp -d)
@@ -299,10 +402,372 @@ run_test "layer-duplicate-name-detection" \
     1 \
     "Duplicate layer names should cause discovery to fail"
 
+run_test "layer-duplicate-name-detection-parallel" \
+    "ig layer --path $tmp_dup_dir --jobs 2 --list >/dev/null 2>&1" \
+    1 \
+    "Duplicate layer names should cause parallel discovery to fail"
+
 # Clean up temporary directory
 rm -rf "$tmp_dup_dir"
 
 
+# Lazily indexed layers are linted when used
+tmp_lint_dir=$(mktemp -d)
+sed 's/^# X-Env-Var-port-Valid:.*/# X-Env-Var-port-Valid: int:1024-65535\n# X-Env-Var-port-Bogus: y/' \
+    "${LAYERS}/valid-basic.yaml" > "$tmp_lint_dir/layer.yaml"
+
+run_test "layer-lazy-lint-on-use" \
+    "ig layer --path $tmp_lint_dir --lazy --build-order test-basic" \
+    1 \
+    "Lazy build order should fail for a layer with syntax errors"
+
+run_test "layer-lazy-lint-describe" \
+    "ig layer --path $tmp_lint_dir --lazy --describe test-basic 2>&1 | grep -q Traceback" \
+    1 \
+    "Lazy describe of a layer with syntax errors should fail cleanly"
+
+# A layer with syntax errors is left out, so a valid layer of the same name is not a duplicate
+cp "${LAYERS}/valid-basic.yaml" "$tmp_lint_dir/valid.yaml"
+
+run_test "layer-lazy-lint-list" \
+    "ig layer --path $tmp_lint_dir --list > $tmp_lint_dir/eager.out && \
+     ig layer --path $tmp_lint_dir --lazy --list | diff -q $tmp_lint_dir/eager.out -" \
+    0 \
+    "Lazy listing should leave out layers with syntax errors as eager listing does"
+
+run_test "layer-lazy-lint-describe-valid" \
+    "ig layer --path $tmp_lint_dir --lazy --describe test-basic | grep -q 'Path: valid.yaml'" \
+    0 \
+    "Lazy describe should use the valid layer of a name"
+
+run_test "layer-lazy-lint-check-all" \
+    "ig layer --path $tmp_lint_dir --lazy --check-all" \
+    0 \
+    "Lazy check of all layers should ignore layers with syntax errors"
+
+run_test "layer-index-lint" \
+    "ig layer --path $tmp_lint_dir --build-index $tmp_lint_dir/index && \
+     ig layer --path $tmp_lint_dir --index $tmp_lint_dir/index --list | diff -q $tmp_lint_dir/eager.out -" \
+    0 \
+    "Layers loaded from an index should leave out layers with syntax errors"
+
+# Lint results held in an index are only trusted for the environment they were made in
+cat > "$tmp_lint_dir/lazy.yaml" <<'EOF'
+# METABEGIN
+# X-Env-Layer-Name: lazy-lint
+# X-Env-Layer-Desc: Test layer
+# X-Env-Layer-Version: 1.0.0
+# X-Env-VarPrefix: lz
+# X-Env-Var-port: none
+# X-Env-Var-port-Valid: int
+# X-Env-Var-port-Set: lazy
+# METAEND
+EOF
+run_test "layer-index-lint-env" \
+    "ig layer --path $tmp_lint_dir --build-index $tmp_lint_dir/index && \
+     ! ig layer --path $tmp_lint_dir --index $tmp_lint_dir/index --describe lazy-lint && \
+     IGconf_lz_port=2000 ig layer --path $tmp_lint_dir --index $tmp_lint_dir/index --describe lazy-lint" \
+    0 \
+    "Layers loaded from an index should be linted again against a different environment"
+
+rm -rf "$tmp_lint_dir"
+
+
+# Discovery honours --ignore and .layerignore
+tmp_ignore_dir=$(mktemp -d)
+mkdir -p "$tmp_ignore_dir/docs" "$tmp_ignore_dir/layers"
+cp "${LAYERS}/valid-basic.yaml" "$tmp_ignore_dir/docs/example.yaml"
+cp "${LAYERS}/valid-basic.yaml" "$tmp_ignore_dir/layers/basic.yaml"
+
+run_test "layer-discovery-ignore-option" \
+    "ig layer --path $tmp_ignore_dir --ignore docs/ --describe test-basic" \
+    0 \
+    "Ignored directories should be pruned from discovery"
+
+echo "docs/" > "$tmp_ignore_dir/.layerignore"
+run_test "layer-discovery-ignore-file" \
+    "ig layer --path $tmp_ignore_dir --describe test-basic" \
+    0 \
+    "Directories listed in .layerignore should be pruned from discovery"
+
+rm -rf "$tmp_ignore_dir"
+
+
+# Layer cache must not change results, either cold or warm
+tmp_cache=$(mktemp -u)
+run_test "layer-cache-consistency" \
+    "ig layer --path ${LAYERS} --build-order test-with-deps > ${tmp_cache}.ref && \
+     ig layer --path ${LAYERS} --cache ${tmp_cache} --build-order test-with-deps | diff -q ${tmp_cache}.ref - && \
+     test -s ${tmp_cache} && \
+     ig layer --path ${LAYERS} --cache ${tmp_cache} --build-order test-with-deps | diff -q ${tmp_cache}.ref -" \
+    0 \
+    "Cached layer loading should produce the same build order as uncached"
+
+run_test "layer-parallel-consistency" \
+    "ig layer --path ${LAYERS} --build-order test-with-deps > ${tmp_cache}.ref && \
+     ig layer --path ${LAYERS} --jobs 2 --build-order test-with-deps | diff -q ${tmp_cache}.ref - && \
+     ig layer --path ${LAYERS} --jobs 2 --cache ${tmp_cache} --build-order test-with-deps | diff -q ${tmp_cache}.ref -" \
+    0 \
+    "Parallel layer loading should produce the same build order as serial"
+
+run_test "layer-lazy-consistency" \
+    "ig layer --path ${LAYERS} --build-order test-with-deps > ${tmp_cache}.ref && \
+     ig layer --path ${LAYERS} --lazy --build-order test-with-deps | diff -q ${tmp_cache}.ref -" \
+    0 \
+    "Lazy layer loading should produce the same build order as eager"
+
+run_test "layer-index-consistency" \
+    "ig layer --path ${LAYERS} --build-order test-with-deps > ${tmp_cache}.ref && \
+     ig layer --path ${LAYERS} --build-index ${tmp_cache}.idx && \
+     ig layer --path ${LAYERS} --index ${tmp_cache}.idx --build-order test-with-deps | diff -q ${tmp_cache}.ref -" \
+    0 \
+    "Loading layers from a compiled index should produce the same build order"
+rm -f "${tmp_cache}" "${tmp_cache}.ref" "${tmp_cache}.idx"
+
+# Build orders stored in the cache are not reused once their inputs change
+tmp_memo=$(mktemp -d)
+make_layer "$tmp_memo" memo-a 'Requires=${MEMO_DEP}'
+make_layer "$tmp_memo" memo-b
+make_layer "$tmp_memo" memo-c
+
+run_test "layer-build-order-memo-env" \
+    "MEMO_DEP=memo-b ig layer --path $tmp_memo --cache $tmp_memo/cache --build-order memo-a | grep -q memo-b && \
+     MEMO_DEP=memo-c ig layer --path $tmp_memo --cache $tmp_memo/cache --build-order memo-a | grep -q memo-c && \
+     MEMO_DEP=memo-b ig layer --path $tmp_memo --cache $tmp_memo/cache --build-order memo-a > $tmp_memo/out && \
+     grep -q memo-b $tmp_memo/out && ! grep -q memo-c $tmp_memo/out" \
+    0 \
+    "Cached build orders should follow variables expanded in dependencies"
+
+run_test "layer-build-order-memo-edit" \
+    "MEMO_DEP=memo-b ig layer --path $tmp_memo --cache $tmp_memo/cache --build-order memo-a > /dev/null && \
+     sed -i 's/^# X-Env-Layer-Requires: .*/# X-Env-Layer-Requires: memo-x/' $tmp_memo/memo-a.yaml && \
+     MEMO_DEP=memo-b ig layer --path $tmp_memo --cache $tmp_memo/cache --build-order memo-a | grep -q 'Missing required dependency: memo-x'" \
+    0 \
+    "Cached build orders should not be reused after a layer file changes"
+rm -rf "$tmp_memo"
+
+
+# A single --plan pass must match separate apply-env, validate and build-order runs
+tmp_plan=$(mktemp -d)
+run_test "layer-plan-consistency" \
+    "ig layer --path ${LAYERS} --build-order test-with-deps --full-paths --output ${tmp_plan}/order.ref && \
+     ig layer --path ${LAYERS} --apply-env test-with-deps --write-out ${tmp_plan}/env.ref && \
+     ig layer --path ${LAYERS} --plan test-with-deps --full-paths --output ${tmp_plan}/order --write-out ${tmp_plan}/env && \
+     diff -q ${tmp_plan}/order.ref ${tmp_plan}/order && diff -q ${tmp_plan}/env.ref ${tmp_plan}/env" \
+    0 \
+    "Plan should write the same env and build order as separate runs"
+
+run_test "layer-plan-missing-layer" \
+    "ig layer --path ${LAYERS} --plan nonexistent-layer" \
+    1 \
+    "Plan should fail for a missing layer"
+
+# Resolving against a given environment must match --apply-env and leave os.environ alone
+cat > "${tmp_plan}/resolve.py" <<PY
+import contextlib, io, os, sys
+sys.path.insert(0, '${IGTOP}/site')
+from layer_manager import LayerManager
+with contextlib.redirect_stdout(io.StringIO()):
+    manager = LayerManager(['${LAYERS}'])
+before = dict(os.environ)
+resolution = manager.resolve_env(manager.get_build_order([sys.argv[1]]), {})
+assert dict(os.environ) == before and not manager.write_log
+for name, value in resolution.changes.items():
+    print(f'{name}="{value}"')
+PY
+run_test "layer-resolve-env-pure" \
+    "env -i PATH=\"\$PATH\" ig layer --path ${LAYERS} --apply-env test-with-deps --write-out ${tmp_plan}/env.ref && \
+     python3 ${tmp_plan}/resolve.py test-with-deps | diff -q ${tmp_plan}/env.ref -" \
+    0 \
+    "Resolving against an environment mapping should match --apply-env without changing os.environ"
+
+# Each scenario is diffed against the environment ig was run with
+mkdir "${tmp_plan}/scenarios"
+printf 'IGconf_envtest_feature="disabled"\n' > "${tmp_plan}/scenarios/a-feature"
+printf '# No overrides\n' > "${tmp_plan}/scenarios/b-none"
+printf 'DISTRO=nonexistent\n' > "${tmp_plan}/scenarios/c-distro"
+cp "${tmp_plan}/scenarios/a-feature" "${tmp_plan}/scenarios/d-feature"
+printf 'IGconf_envtest_feature=${FEATURE}\n' > "${tmp_plan}/scenarios/e-expanded"
+printf 'IGconf_envtest_feature=sometimes\n' > "${tmp_plan}/scenarios/f-invalid"
+printf 'IGconf_envtest_feature=${UNDEFINED_FEATURE}\n' > "${tmp_plan}/scenarios/g-undefined"
+run_test "layer-apply-env-scenarios" \
+    "ARCH=arm64 DISTRO=debian FEATURE=disabled ig layer --path ${LAYERS} --apply-env test-env-var-deps --scenarios ${tmp_plan}/scenarios > ${tmp_plan}/whatif; test \$? = 1 && \
+     grep -A1 '^Scenario: a-feature' ${tmp_plan}/whatif | grep -q '~ IGconf_envtest_feature: enabled -> disabled' && \
+     grep -A1 '^Scenario: b-none' ${tmp_plan}/whatif | grep -q '(no changes)' && \
+     grep -A1 '^Scenario: c-distro' ${tmp_plan}/whatif | grep -q 'Missing required dependency: nonexistent-packages' && \
+     grep -A1 '^Scenario: d-feature' ${tmp_plan}/whatif | grep -q '~ IGconf_envtest_feature: enabled -> disabled' && \
+     grep -A1 '^Scenario: e-expanded' ${tmp_plan}/whatif | grep -q '~ IGconf_envtest_feature: enabled -> disabled' && \
+     grep -A1 '^Scenario: f-invalid' ${tmp_plan}/whatif | grep -q 'IGconf_envtest_feature=sometimes (invalid' && \
+     grep -A1 '^Scenario: g-undefined' ${tmp_plan}/whatif | grep -q 'Undefined variable in override: \${UNDEFINED_FEATURE}'" \
+    0 \
+    "Scenarios should each give the variables their overrides change, or why they fail"
+run_test "layer-scenarios-without-apply-env" \
+    "ig layer --path ${LAYERS} --build-order test-basic --scenarios ${tmp_plan}/scenarios" \
+    1 \
+    "Scenarios without --apply-env should be rejected"
+rm -rf "$tmp_plan"
+
+# A batch must plan each target as a separate --plan run would
+tmp_batch=$(mktemp -d)
+cat > "${tmp_batch}/result.py" <<'PY'
+# Print a batch target's build order, or its env as written by --write-out
+import json, sys
+result = json.load(open(sys.argv[1]))[sys.argv[2]]
+if sys.argv[3] == 'order':
+    print('\n'.join(result['build_order']))
+else:
+    for name, value in result['env'].items():
+        print(f'{name}="{value}"')
+PY
+run_test "layer-batch-consistency" \
+    "ig layer --path ${LAYERS} --plan test-with-deps --output ${tmp_batch}/order.ref --write-out ${tmp_batch}/env.ref && \
+     ig layer --path ${LAYERS} --batch test-with-deps test-dependency-top > ${tmp_batch}/batch.json && \
+     python3 ${tmp_batch}/result.py ${tmp_batch}/batch.json test-with-deps order | diff -q ${tmp_batch}/order.ref - && \
+     python3 ${tmp_batch}/result.py ${tmp_batch}/batch.json test-with-deps env | diff -q ${tmp_batch}/env.ref -" \
+    0 \
+    "Batch should give the same build order and env as a separate plan"
+
+# Config targets build the config's layers after 'essential'
+make_layer "$tmp_batch" essential
+cp "${LAYERS}/valid-basic.yaml" "${LAYERS}/valid-with-deps.yaml" "${tmp_batch}/"
+printf 'device:\n  layer: test-basic\nlayer:\n  extra: test-with-deps\n' > ${tmp_batch}/matrix.yaml
+run_test "layer-batch-config" \
+    "ig layer --path ${tmp_batch} --config-path ${tmp_batch} --base-layer essential --batch matrix.yaml matrix.yaml,IGconf_layer_extra=test-basic > ${tmp_batch}/batch.json && \
+     test \"\$(python3 ${tmp_batch}/result.py ${tmp_batch}/batch.json matrix.yaml order | xargs)\" = 'essential test-basic test-with-deps' && \
+     test \"\$(python3 ${tmp_batch}/result.py ${tmp_batch}/batch.json matrix.yaml,IGconf_layer_extra=test-basic order | xargs)\" = 'essential test-basic'" \
+    0 \
+    "Batch should plan the layers named by each config"
+
+run_test "layer-batch-failed-target" \
+    "ig layer --path ${LAYERS} --batch test-with-deps nonexistent-layer > ${tmp_batch}/batch.json; test \$? = 1 && \
+     grep -q '\"status\": \"failed\"' ${tmp_batch}/batch.json && \
+     grep -q \"\\\"Layer 'nonexistent-layer' not found\\\"\" ${tmp_batch}/batch.json" \
+    0 \
+    "Batch should report failed targets and exit non-zero"
+rm -rf "$tmp_batch"
+
+# Only layers in the build order with an mmdebstrap section are listed
+tmp_mmdeb=$(mktemp -d)
+cp "${LAYERS}/valid-basic.yaml" "${LAYERS}/valid-with-deps.yaml" "$tmp_mmdeb/"
+printf '\nmmdebstrap:\n  packages:\n    - curl\n' >> "$tmp_mmdeb/valid-with-deps.yaml"
+run_test "layer-mmdebstrap-layers" \
+    "ig layer --path $tmp_mmdeb --build-order test-with-deps --full-paths --output $tmp_mmdeb/order && \
+     test \"\$(ig layer --mmdebstrap-layers $tmp_mmdeb/order)\" = \"test-with-deps:$tmp_mmdeb/valid-with-deps.yaml\"" \
+    0 \
+    "Should list only layers with an mmdebstrap section"
+rm -rf "$tmp_mmdeb"
+
+# Build waves and running customize hooks of parallel-safe layers from a hook plan
+tmp_hooks=$(mktemp -d)
+make_layer "$tmp_hooks" hook-base ParallelSafe=n -- mmdebstrap: '  customize-hooks:' '    - echo base > $1/base'
+make_layer "$tmp_hooks" hook-harden Requires=hook-base ParallelSafe=y -- mmdebstrap: '  customize-hooks:' '    - echo harden >> $1/log'
+make_layer "$tmp_hooks" hook-sbom Requires=hook-base ParallelSafe=y -- mmdebstrap: '  customize-hooks:' '    - echo sbom >> $1/log'
+make_layer "$tmp_hooks" hook-report Requires=hook-harden,hook-sbom ParallelSafe=y -- mmdebstrap: '  customize-hooks:' '    - sort $1/log > $1/report'
+mkdir "$tmp_hooks/root"
+
+run_test "layer-build-waves" \
+    "ig layer --path $tmp_hooks --waves hook-report --output $tmp_hooks/waves && \
+     test \"\$(xargs < $tmp_hooks/waves)\" = '1:hook-base 2:hook-harden 2:hook-sbom 3:hook-report'" \
+    0 \
+    "Build waves should group layers which do not depend on each other"
+
+run_test "layer-hook-plan-run" \
+    "ig layer --path $tmp_hooks --plan hook-report --full-paths --output $tmp_hooks/order --hook-plan $tmp_hooks/plan && \
+     test \"\$(cut -d: -f1,2 $tmp_hooks/plan | xargs)\" = '1:hook-harden 1:hook-sbom 2:hook-report' && \
+     ig layer --mmdebstrap-layers $tmp_hooks/order --hook-plan $tmp_hooks/plan | grep -q \"hook-sbom:$tmp_hooks/plan.d/hook-sbom.yaml\" && \
+     ig layer --jobs 2 --run-hooks $tmp_hooks/plan $tmp_hooks/root && \
+     test \"\$(xargs < $tmp_hooks/root/report)\" = 'harden sbom' && test ! -e $tmp_hooks/root/base" \
+    0 \
+    "Hook plan should run the hooks of parallel-safe layers in dependency order"
+
+make_layer "$tmp_hooks" hook-top Requires=hook-report ParallelSafe=n -- mmdebstrap: '  customize-hooks:' '    - true'
+run_test "layer-hook-plan-pinned" \
+    "ig layer --path $tmp_hooks --plan hook-top --hook-plan $tmp_hooks/plan && test ! -s $tmp_hooks/plan" \
+    0 \
+    "Hooks needed before those of a layer run by mmdebstrap should stay in mmdebstrap"
+
+make_layer "$tmp_hooks" hook-report Requires=hook-harden,hook-sbom ParallelSafe=y -- mmdebstrap: '  customize-hooks:' '    - exit 3'
+run_test "layer-hook-plan-failure" \
+    "ig layer --path $tmp_hooks --plan hook-report --hook-plan $tmp_hooks/plan && \
+     ig layer --run-hooks $tmp_hooks/plan $tmp_hooks/root" \
+    1 \
+    "Running a hook plan should fail if a hook fails"
+rm -rf "$tmp_hooks"
+
+# Dependency graph export and its critical path, by cost or by measured durations
+tmp_graph=$(mktemp -d)
+make_layer "$tmp_graph" graph-a -- mmdebstrap: '  packages:' '    - '{p1,p2,p3,p4,p5}
+make_layer "$tmp_graph" graph-b Requires=graph-a -- mmdebstrap: '  packages:' '    - p6'
+make_layer "$tmp_graph" graph-c -- mmdebstrap: '  packages:' '    - '{p1,p2,p3,p4,p5,p6,p7,p8}
+make_layer "$tmp_graph" graph-top Requires=graph-b,graph-c -- mmdebstrap: '  packages:' '    - p9'
+printf 'graph-a=30\ngraph-b=5\ngraph-c=20\ngraph-top=1\n' > "$tmp_graph/timings"
+critical_path="import json, sys; print(' '.join(json.load(sys.stdin)['critical_path']['layers']))"
+
+run_test "layer-graph-critical-path" \
+    "test \"\$(ig layer --path $tmp_graph --graph graph-top --format json | python3 -c \"$critical_path\")\" = 'graph-c graph-top' && \
+     test \"\$(ig layer --path $tmp_graph --graph graph-top --format json --timings $tmp_graph/timings | python3 -c \"$critical_path\")\" = 'graph-a graph-b graph-top'" \
+    0 \
+    "Graph export should follow the heaviest chain of dependencies"
+
+run_test "layer-graph-dot" \
+    "ig layer --path $tmp_graph --graph graph-top --output $tmp_graph/graph.dot && \
+     grep -q '\"graph-top\" -> \"graph-c\" \\[color=red' $tmp_graph/graph.dot && \
+     grep -q '\"graph-b\" -> \"graph-a\";' $tmp_graph/graph.dot" \
+    0 \
+    "DOT export should draw the critical path in red"
+rm -rf "$tmp_graph"
+
+# Commands forwarded to a resident server must behave as when run directly
+tmp_sock=$(mktemp -u)
+IG_SOCKET=${tmp_sock} ig serve --idle-timeout 60 >/dev/null 2>&1 &
+server_pid=$!
+for _ in $(seq 50); do [ -S "$tmp_sock" ] && break; sleep 0.1; done
+
+run_test "serve-consistency" \
+    "test -S ${tmp_sock} && \
+     IG_NO_SERVER=1 ig layer --path ${LAYERS} --build-order test-with-deps > ${tmp_sock}.ref && \
+     IG_SOCKET=${tmp_sock} ig layer --path ${LAYERS} --build-order test-with-deps | diff -q ${tmp_sock}.ref -" \
+    0 \
+    "Server should produce the same build order as a direct run"
+
+run_test "serve-exit-status" \
+    "IG_SOCKET=${tmp_sock} ig layer --path ${LAYERS} --describe nonexistent-layer" \
+    1 \
+    "Server should return the command's exit status"
+
+kill "$server_pid" 2>/dev/null
+wait "$server_pid" 2>/dev/null
+
+# A bad reply after the request was sent must not run the command again locally
+python3 -c "
+import socket, sys
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(sys.argv[1])
+server.listen(1)
+conn, _ = server.accept()
+socket.recv_fds(conn, 1, 3)
+conn.recv(65536)
+conn.sendall(b'not json\\n')
+" "$tmp_sock" >/dev/null 2>&1 &
+server_pid=$!
+for _ in $(seq 50); do [ -S "$tmp_sock" ] && break; sleep 0.1; done
+
+run_test "serve-bad-reply" \
+    "IG_SOCKET=${tmp_sock} ig layer --path ${LAYERS} --build-order test-with-deps > ${tmp_sock}.out 2>&1; \
+     test \$? -eq 1 && grep -q 'malformed reply' ${tmp_sock}.out && ! grep -q test-with-deps ${tmp_sock}.out" \
+    0 \
+    "A malformed server reply should be an error, not a local rerun"
+
+run_test "serve-opt-out" \
+    "IG_NO_SERVER=1 IG_SOCKET=${tmp_sock} ig layer --path ${LAYERS} --build-order test-with-deps | grep -q test-with-deps" \
+    0 \
+    "IG_NO_SERVER=1 should run commands locally even with a server listening"
+
+kill "$server_pid" 2>/dev/null
+wait "$server_pid" 2>/dev/null
+rm -f "${tmp_sock}" "${tmp_sock}.ref" "${tmp_sock}.out"
+
+
 print_header "OTHER TESTS"
 
 
@@ -697,5 +1162,78 @@ run_test "env-var-deps-apply-env" \
     0 \
     "Environment variable dependencies should work with apply-env"
 
+# Test variables referring to other variables in dependencies
+cleanup_env
+export ARCH='${TARGET_ARCH}'
+export TARGET_ARCH=arm64
+export DISTRO=debian
+run_test "env-var-deps-nested" \
+    "ig layer --path ${LAYERS} --build-order test-env-var-deps | grep -q arm64-toolchain" \
+    0 \
+    "Variables referred to by environment variable dependencies should be expanded in turn"
+cleanup_env
+unset ARCH TARGET_ARCH DISTRO
+
+# Overrides may refer to the config and to earlier overrides
+tmp_ovr=$(mktemp -d)
+printf 'device:\n  layer: rpi5\n' > "${tmp_ovr}/cfg.yaml"
+printf 'IGconf_image_base=${IGconf_device_layer}\nIGconf_image_name=${IGconf_image_base}-x\n' > "${tmp_ovr}/previous"
+printf 'IGconf_image_name=${IGconf_image_undefined}-x\n' > "${tmp_ovr}/undefined"
+run_test "config-overrides-previous-ref" \
+    "ig config ${tmp_ovr}/cfg.yaml --overrides ${tmp_ovr}/previous --write-to ${tmp_ovr}/out.env && \
+     grep -qx 'IGconf_image_name=\"rpi5-x\"' ${tmp_ovr}/out.env" \
+    0 \
+    "Overrides should be expanded with the config and earlier overrides"
+run_test "config-overrides-undefined" \
+    "ig config ${tmp_ovr}/cfg.yaml --overrides ${tmp_ovr}/undefined --write-to ${tmp_ovr}/out.env 2>&1 | \
+     grep -q 'Undefined variable in override: \${IGconf_image_undefined}'" \
+    0 \
+    "Overrides referring to an undefined variable should be reported"
+
+# Print the variables an env file assigns as bash gives them after sourcing it strictly
+sourced_env() {
+    env -i bash -c 'set -aeu; source "$1"
+        for v in $(sed -nE "s/^(export[[:space:]]+)?([A-Za-z_][A-Za-z0-9_]*)=.*/\2/p" "$1" | awk "!seen[\$0]++"); do
+            printf "%s=\"%s\"\n" "$v" "${!v}"
+        done' _ "$1" </dev/null
+}
+
+# The final env must be as bash gives when sourcing the env file strictly
+printf '%s\n' 'IGconf_a_base="/work"' 'IGconf_a_dir="${IGconf_a_base}/x"' 'IGconf_a_bare="$IGconf_a_dir-y"' \
+    'IGconf_a_esc="\$IGconf_a_base \\ \x"' "IGconf_a_single='\${literal}'" 'IGconf_a_word=$IGconf_a_base/z' \
+    'IGconf_a_cmd="$(echo v1)"' 'IGconf_a_default="${IGconf_a_unset:-fallback}"' 'IGconf_a_base="/work2"' \
+    'IGconf_a_alt="${IGconf_a_base:+${IGconf_a_dir}/alt}${IGconf_a_unset+never}${IGconf_a_unset-}"' \
+    'IGconf_a_after="${IGconf_a_base}-${IGconf_a_cmd}"' 'export IGconf_a_path="${PATH}:${SHLVL}"' \
+    $'IGconf_a_lines="${IGconf_a_base}\n  $(echo v2) \'q\'"' > "${tmp_ovr}/ig.env"
+run_test "env-expand-final" \
+    "ig env --expand ${tmp_ovr}/ig.env --write-to ${tmp_ovr}/final.env --json ${tmp_ovr}/final.json && \
+     sourced_env ${tmp_ovr}/ig.env | diff -q - ${tmp_ovr}/final.env && \
+     python3 -c 'import json,sys; assert json.load(open(sys.argv[1]))[\"IGconf_a_after\"] == \"/work2-v1\"' ${tmp_ovr}/final.json" \
+    0 \
+    "Final env should match sourcing the env file with bash"
+printf '%s\n' 'IGconf_a_base="/work"' 'IGconf_a_dir="${IGconf_a_base}/${IGconf_a_later}"' 'IGconf_a_later="x"' > "${tmp_ovr}/unbound.env"
+run_test "env-expand-unbound" \
+    "ig env --expand ${tmp_ovr}/unbound.env 2>&1 | grep -q 'unbound.env:2: IGconf_a_dir: unbound variable IGconf_a_later'" \
+    0 \
+    "Final env should name the variable referring to an unset variable"
+rm -rf "$tmp_ovr"
+
+# So must the env file rpi-image-gen assembles from a real config and the
+# layers it names. Its suite layer needs a systemd provider none of them
+# select, so only the device and image layers are planned.
+tmp_real=$(mktemp -d)
+ig config --path "${IGTOP}/config" "${IGTOP}/config/trixie-minbase.yaml" --write-to "${tmp_real}/ig.env" > /dev/null
+printf 'LAYER_HOOKS="%s"\n' "${IGTOP}/layer-hooks" >> "${tmp_real}/ig.env"
+run_test "env-expand-real" \
+    "env \$(sed 's/\"//g' ${tmp_real}/ig.env) IGconf_device_hostname=pi5-test \
+         ig layer --path ${IGTOP}/device:${IGTOP}/image:${IGTOP}/layer --plan essential rpi5 image-rpios \
+         --write-out ${tmp_real}/layer.env > /dev/null && \
+     cat ${tmp_real}/layer.env >> ${tmp_real}/ig.env && grep -q '\$(' ${tmp_real}/ig.env && \
+     ig env --expand ${tmp_real}/ig.env --write-to ${tmp_real}/final.env && \
+     sourced_env ${tmp_real}/ig.env | diff - ${tmp_real}/final.env" \
+    0 \
+    "Final env of a generated env file should match sourcing it with bash"
+rm -rf "$tmp_real"
+
 
 print_summary